@@ -1,21 +1,36 @@
 import numpy as np
 import time
 import threading 
-import h5py
 import datetime
 import logging
 import config
 
 import drivers.MMA as MMA
-from drivers.OLED import OLED
-
-from Stimulus import AudioStimulus
+from clock import RealClock
+from scheduler import DeadlineScheduler
+from sinks import HDFSink, RedisSink
+from ringbuffer import ChunkRing, SAMPLE_DTYPE
+from pipeline import Pipeline, Stage
+from acquisition import AcquisitionProcess, END
+import compaction
+import live
+
+def _no_mark():
+    return 0.0
 
 class SleepLogger:
-    def __init__(self):
+    def __init__(self, bus=None, clock=None, h5_filename=None, background_io=True):
         """
         Sleep logger with adaptive sampling and various logging methods.
         Provides current sleep state data to other objects.
+
+        :param bus: I2C bus of the accelerometer, defaults to the Pi's bus 1.
+            Use `drivers.MMA_sim.SimulatedMMA8452Q` to run without hardware.
+        :param clock: clock used for timestamps and sampling delays, defaults to the
+            system clock. A `clock.VirtualClock` replays faster than real time.
+        :param h5_filename: hdf file to log to, defaults to `config.HDF_FILE` in /home/pi/accel
+        :param background_io: log and draw each chunk in the worker threads of the pipeline. If False,
+            chunks are processed in order in the acquisition thread (used for replays).
         """
         # Initiate sleep state variables
         self.diff = None # current movement magnitude
@@ -25,45 +40,103 @@ class SleepLogger:
         
         # Initiate control variables
         self._run = False
+        self.clock = RealClock() if clock is None else clock
+        # sampling deadlines and monotonic timestamps
+        self.scheduler = DeadlineScheduler(self.clock)
+        self.background_io = background_io
+        self.thread = None
+        self.pipeline = Pipeline() # workers of the display and the sinks, see make_pipeline
+        self.profiler = None # e.g. benchmark.LoopProfiler, records stage timings of every sample
+        self.live_state = None # shared memory of the acquisition process, see acquisition.py
+        self.live_channel = live.channel # newest state for the web interface, see live.py
         
         # Initiate accelerometer
-        self.mma8452q = MMA.MMA8452Q()
+        self.fast_read = config.ACCELEROMETER_FAST_READ
+        self.mma8452q = MMA.MMA8452Q(bus=bus, fast_read=self.fast_read)
+        # fast read values are scaled to 12 bit counts, so the threshold is the same in both modes
         self.activity_threshold = config.ACCELEROMETER_ACTIVITY_THRESHOLD
+        self.stale_reads = 0 # fast reads without a new sample from the accelerometer
+
+        # Event driven acquisition
+        self.event_driven = config.EVENT_DRIVEN
+        if self.event_driven:
+            self.mma8452q.transient_configuration(threshold=config.ACCELEROMETER_TRANSIENT_THRESHOLD,
+                                                  count=config.ACCELEROMETER_TRANSIENT_COUNT)
+            if config.ACCELEROMETER_INT_PIN is not None:
+                import RPi.GPIO as GPIO
+                GPIO.setmode(GPIO.BCM)
+                GPIO.setup(config.ACCELEROMETER_INT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            logging.info("Event driven acquisition enabled.")
         
         # Initiate logging
-        self.dataset_name = datetime.datetime.now().strftime("%Y-%m-%d-%HH-%MM-%SS")
+        self.dataset_name = datetime.datetime.fromtimestamp(self.clock.time()).strftime("%Y-%m-%d-%HH-%MM-%SS")
         logging.info(f"Recording name: {self.dataset_name}")
 
         config.LOG_TO_REDIS = config.LOG_TO_REDIS     
         if config.LOG_TO_REDIS:
-            import redis
-            self.r = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+            self.redis_sink = RedisSink()
             logging.info(f"Logging to Redis server {config.REDIS_HOST}:{config.REDIS_PORT}")
         
         config.LOG_TO_HDF = config.LOG_TO_HDF 
+        self.hdf_sink = None # opened with the first chunk
+        self.recorded_runs = [] # runs recorded since the last stop, compacted after it
         if config.LOG_TO_HDF :
-            self.H5_FILENAME = f"/home/pi/accel/{config.HDF_FILE}"
-            self.H5_INIT = False
+            self.H5_FILENAME = f"/home/pi/accel/{config.HDF_FILE}" if h5_filename is None else h5_filename
             logging.info("Logging to HDF file: {}.".format(self.H5_FILENAME))
             
         # Initiate Display
         if config.OLED_DISPLAY:
+            from drivers.OLED import OLED
             self.oled = OLED()
             logging.info(f"OLED initialized.")
 
         # Initiate Stimulus module
         if config.STIMULUS_ACTIVE:
+            from Stimulus import AudioStimulus
             self.audiostim = AudioStimulus()
             logging.info("Stimulus module loaded")
 
         logging.info("Sleep tracker initialized.")
         
-    def get_accel_data(self, mma8452q):
-        acc = mma8452q.read_accl()
-        accl = [acc['x'], acc['y'], acc['z']]
-        millis = int(round(time.time() * 1000))
-        t = millis
-        return t, accl
+    def get_accel_data(self, mma8452q, out=None):
+        """Current time in ms and x, y, z values of the accelerometer.
+        The values are written into the list `out`, so the loop does not allocate per sample."""
+        if out is None:
+            out = [0, 0, 0]
+        if self.fast_read:
+            if not mma8452q.read_accl_fast(out):
+                # no new sample yet, the next one is at most one output period away
+                self.clock.sleep(mma8452q.sample_period)
+                if not mma8452q.read_accl_fast(out):
+                    # still the previous sample, the diff will be zero
+                    self.stale_reads += 1
+        else:
+            mma8452q.read_accl(out)
+        t = self.scheduler.time_ms()
+        return t, out
+
+    def wait_for_motion(self, timeout):
+        """Wait up to `timeout` seconds for a transient interrupt of the accelerometer,
+        either on the INT1 pin or by polling INT_SOURCE. Returns True if something moved."""
+        if config.ACCELEROMETER_INT_PIN is not None:
+            import RPi.GPIO as GPIO
+            # INT1 is active low
+            channel = GPIO.wait_for_edge(config.ACCELEROMETER_INT_PIN, GPIO.FALLING, timeout=int(timeout * 1000))
+            if channel is None:
+                return False
+            # clear the latched event
+            self.mma8452q.transient_detected()
+            return True
+
+        end = self.clock.monotonic() + timeout
+        while self._run:
+            if self.mma8452q.transient_detected():
+                return True
+            remaining = end - self.clock.monotonic()
+            if remaining <= 0:
+                break
+            self.clock.sleep(min(config.EVENT_POLL_DELAY / 1000.0, remaining))
+        return False
 
     def integrate_activity(self, activity, diff, dt, now, last_spike):
         """
@@ -131,9 +204,16 @@ class SleepLogger:
                 
 
     def adaptive_logger(self, sample_size = 128, \
-                        init_delay = 2, init_activity = 0.0, init_acc = [0.0, 0.0, 0.0],
-                        last_spike = -1e10, \
-                        return_delay = False):
+                        init_delay = 2, init_activity = 0.0, init_acc = None,
+                        last_spike = -1e10, init_t = None, \
+                        return_delay = False, out = None):
+        """
+        Sample `sample_size` values with adaptive delays and integrate the activity.
+
+        :param out: structured array with `ringbuffer.SAMPLE_DTYPE` of at least `sample_size` rows
+            the samples are written into, e.g. a slot of the ring buffer. Allocated if None.
+        :return: the columns of the chunk (views of `out`) and the time of the last spike
+        """
         # activity variable integrated in time
         activity = init_activity
         #last_spike = -1e10
@@ -146,29 +226,59 @@ class SleepLogger:
         min_delay = config.LOGGER_MIN_DELAY
         max_delay = config.LOGGER_MAX_DELAY #maximum delay ms
 
-        # prepare arrays for storing results
-        raw_data = np.zeros((sample_size, 3)) # raw xyz data 
-        ts_data = np.zeros((raw_data.shape[0]))
-        ts_realtime_data = np.zeros((raw_data.shape[0]))
-        delays = np.zeros((raw_data.shape[0]))
-        acts = np.zeros((raw_data.shape[0])) # activity data
-        diffs = np.zeros((raw_data.shape[0]))
-        states = np.zeros((raw_data.shape[0]))
+        # arrays for storing results, columns of the chunk
+        if out is None:
+            out = np.zeros(sample_size, dtype=SAMPLE_DTYPE)
+        raw_data = out['raw'] # raw xyz data
+        ts_data = out['ts']
+        ts_realtime_data = out['ts_realtime']
+        delays = out['delays']
+        acts = out['acts'] # activity data
+        diffs = out['diffs']
+        states = out['states']
+        lateness = out['lateness'] # ms after the sample's deadline
 
         # start of integration
-        start_milli = int(round(time.time() * 1000))
-
-        # get one sample
-        last_t, acc = self.get_accel_data(self.mma8452q)
-        last_acc = acc
-        last_draw = last_t
+        start_milli = self.scheduler.time_ms()
 
+        # two buffers for the current and last xyz values, swapped after every sample
+        acc = [0, 0, 0]
+        if init_t is None or init_acc is None:
+            # get one sample
+            last_t, last_acc = self.get_accel_data(self.mma8452q, out=[0, 0, 0])
+        else:
+            # continue from the last sample of the previous chunk so that the stored
+            # diffs and timestamps fully determine the activity (see activity.py)
+            last_t, last_acc = init_t, list(init_acc)
+
+        # current state for the main process if this runs in the acquisition process
+        live = self.live_state
+        # and for the viewers of the web interface, a few times per second
+        channel = self.live_channel
+        push_interval = config.LIVE_PUSH_INTERVAL * 1000.0
+        last_push = -1e18
+
+        # timestamps between the stages of a sample for benchmarking
+        profiler = self.profiler
+        mark = time.perf_counter if profiler is not None else _no_mark
+        if profiler is not None:
+            profiler.start_chunk()
+
+        n_samples = sample_size
         for i in range(sample_size):
-            t, acc = self.get_accel_data(self.mma8452q)
+            if not self._run:
+                # stopped in the middle of a chunk, return what we have
+                n_samples = i
+                break
+            m_start = mark()
+            late = self.scheduler.lateness()
+            t, acc = self.get_accel_data(self.mma8452q, out=acc)
+            m_read = mark()
 
             # calcuate diff value
             # fast versin of np.abs(np.mean(acc-last_acc, axis =1)) or so, much faster without numpy
             diff = abs(((acc[0] - last_acc[0]) + (acc[1] - last_acc[1]) + (acc[2] - last_acc[2])) / 3)
+            m_diff = mark()
 
             # dt for this sample
             dt = t - last_t
@@ -189,10 +299,27 @@ class SleepLogger:
                 if current_delay > max_delay:
                     current_delay = max_delay
 
+            # in event driven mode, wait for movements instead of polling when it is quiet
+            idle = self.event_driven and current_delay >= max_delay
+            period = config.EVENT_IDLE_DELAY if idle else current_delay
+
+            m_integrate = mark()
+
             # detect sleep state from activity level
             state = self.detect_state(activity)
             
             self.update_state_variables(diff=diff, activity=activity, state=state)
+            if live is not None:
+                # seqlock, odd while writing
+                live[0] += 1
+                live[1] = t
+                live[2] = diff
+                live[3] = activity
+                live[4] = state
+                live[0] += 1
+            if channel is not None and t - last_push >= push_interval:
+                channel.publish(running=True, t=t, diff=diff, activity=activity, state=state, delay=period)
+                last_push = t
             
             if config.STIMULUS_ACTIVE:
                 self.trigger_stimulus()
@@ -200,6 +327,7 @@ class SleepLogger:
             if config.VERBOSE_OUTPUT:
                 print("\rDelay: {}, activity: {:.2}, diff: {:.4}, state: {}          "\
                       .format(int(current_delay), activity, diff, state), end='\r')
+            m_state = mark()
             
             # store data in time chunks
             raw_data[i, 0] = acc[0]
@@ -207,128 +335,230 @@ class SleepLogger:
             raw_data[i, 2] = acc[2]
             ts_data[i] = t - start_milli        
             ts_realtime_data[i] = t
-            delays[i] = current_delay
+            delays[i] = period
             diffs[i] = diff
             states[i] = state
+            lateness[i] = late
             acts[i] = activity
 
-            last_acc = acc
+            last_acc, acc = acc, last_acc
             last_t = t
+            m_store = mark()
             
-            # finally sleep according to current sampling rate
-            time.sleep(current_delay / 1000.0) # seconds
+            # finally wait for the deadline of the next sample, current_delay ms after
+            # the deadline of this one, regardless of how long the processing took
+            if idle:
+                # the chip may sleep as well while it is not read
+                self.mma8452q.auto_sleep(True)
+                # sleep until the accelerometer reports a movement, but take a sample at
+                # least every EVENT_IDLE_DELAY ms so that the activity keeps decaying
+                if self.scheduler.wait(period, wait_event=self.wait_for_motion):
+                    # woken up by a movement, continue with the highest sampling rate
+                    current_delay = min_delay
+                    delays[i] = current_delay
+            else:
+                if self.mma8452q.auto_sleep_enabled:
+                    # polling again, every sample has to be a new one
+                    self.mma8452q.auto_sleep(False)
+                self.scheduler.wait(current_delay)
+
+            if profiler is not None:
+                profiler.add_sample(m_start, m_read, m_diff, m_integrate, m_state, m_store, mark(), period, late)
 
-        return ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, last_spike
+        if n_samples < len(out):
+            ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, lateness = \
+                [var[:n_samples] for var in (ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, lateness)]
+        return ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, lateness, last_spike
 
-    def log_data(self, ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states):
+    def log_data(self, chunk):
         """
         Data logger. Logs data into a database or on hdf5 file storage.
+
+        :param chunk: `ringbuffer.Chunk`, every sink releases it when it is done
         """
         if config.LOG_TO_REDIS:
-            threading.Thread(target=self.log_to_redis, \
-                             args=(self.r, ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states)).start()
+            self.log_to_redis(chunk)
         
         if config.LOG_TO_HDF:
-            threading.Thread(target=self.log_to_hdf, \
-                             args=(ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states)).start()            
-
-    def log_to_redis(self, r, ts, ts_realtime, raw_data, acts, diffs, delays, states):
-        for i, t in enumerate(ts):
-            # prepare storage format
-            diff = "{0:.2f}".format(diffs[i])
-            activity = "{0:.4f}".format(acts[i])
-            delay = "{0:.2f}".format(delays[i])
-            state = int(states[i])
-            t = int(t)
-            t_realtime = int(ts_realtime[i])
-
-            res = r.xadd('accel', {"t" : t , "t_realtime" : t_realtime, "x" : raw_data[i, 0], "y" : \
-                                   raw_data[i, 1], "z" : raw_data[i, 2], \
-                        'activity' : activity, 'diff' : diff, 'delay' : delay, 'state' : state})
-        return res     
-            
-    def log_to_hdf(self, ts, ts_realtime, raw_data, acts, diffs, delays, states, verbose=False):
-        variables = (ts, ts_realtime, raw_data, acts, diffs, delays, states)
-        var_strings = ["ts", "ts_realtime", "raw_data", "acts", "diffs", "delays", "states"]
-        with h5py.File(self.H5_FILENAME, 'a') as h5f:
-            if self.H5_INIT == False:
-                self.dataset_name = datetime.datetime.now().strftime("%Y-%m-%d-%HH-%MM-%SS")  
-                if config.VERBOSE_OUTPUT:
-                    logging.info("{}/{}: INIT".format(self.H5_FILENAME, self.dataset_name))
-                grp = h5f.create_group(self.dataset_name)
-                
-                for i, var in enumerate(variables):
-                    str_var = var_strings[i]
-                    if str_var == "raw_data":
-                        for k, str_var in enumerate(['x', 'y', 'z']):
-                            if config.VERBOSE_OUTPUT:
-                                logging.info("{}/{}: CREATE {}".format(self.H5_FILENAME, self.dataset_name, str_var))
-                            grp.create_dataset(str_var, data=var[:, k], compression="gzip", chunks=True, maxshape=(None,)) 
-                    else:   
-                        if config.VERBOSE_OUTPUT:
-                            logging.info("{}/{}: CREATE {}".format(self.H5_FILENAME, self.dataset_name, str_var))
-                        grp.create_dataset(str_var, data=var, compression="gzip", chunks=True, maxshape=(None,)) 
-                
-                self.H5_INIT = True
-            else:
-                for i, var in enumerate(variables):
-                    str_var = var_strings[i]
-                    if str_var == "raw_data":                
-                        for k, str_var in enumerate(['x', 'y', 'z']):
-                            h5f[self.dataset_name][str_var].resize((h5f[self.dataset_name][str_var].shape[0] \
-                                                                    + var[:, k].shape[0]), axis = 0)
-                            h5f[self.dataset_name][str_var][-var[:, k].shape[0]:] = var[:, k]
-                    else:
-                        h5f[self.dataset_name][str_var].resize((h5f[self.dataset_name][str_var].shape[0] \
-                                                                + var.shape[0]), axis = 0)
-                        h5f[self.dataset_name][str_var][-var.shape[0]:] = var                             
-                if config.VERBOSE_OUTPUT:
-                    logging.info("{}/{}: APPEND ... {}".format(self.H5_FILENAME, self.dataset_name, \
-                                                      h5f[self.dataset_name]['diffs'].shape[0]))      
-                
-    def chunkwise_logger(self, n_cycles = 10, t_size = 128):
+            # only queues the chunk, the sink has its own writer thread
+            self.log_to_hdf(chunk)
+
+    def log_to_redis(self, chunk):
+        # the redis stage sends the waiting chunks in one redis pipeline
+        self.pipeline.put('redis', chunk)
+
+    def log_to_hdf(self, chunk):
+        if self.hdf_sink is None:
+            # the run is named after the time of its first chunk
+            self.dataset_name = datetime.datetime.fromtimestamp(self.clock.time()).strftime("%Y-%m-%d-%HH-%MM-%SS")
+            if config.VERBOSE_OUTPUT:
+                logging.info("{}/{}: INIT".format(self.H5_FILENAME, self.dataset_name))
+            # timestamps are stored relative to the first sample
+            t0 = chunk['ts_realtime'][0] if len(chunk) else self.clock.time() * 1000.0
+            self.hdf_sink = HDFSink(self.H5_FILENAME, self.dataset_name).open(t0=t0)
+            self.recorded_runs.append(self.dataset_name)
+        self.pipeline.put('hdf', chunk)
+
+    def display_chunk(self, chunk):
+        # stitch together the object to send to the OLED
+        display_input = {}
+        display_input['timeseries'] = chunk['diffs']
+        display_input['status'] = "{0:.2f}".format(chunk['acts'][-1])
+        display_input['trigger'] = True if int(chunk['states'][-1]) == config.SLEEP_STATE_DEEP else False
+        try:
+            self.oled.draw_display(display_input)
+        finally:
+            chunk.release('display')
+
+    def make_pipeline(self, consumers):
+        """One worker stage with a bounded queue for the display and every sink."""
+        handlers = {'display': (self.display_chunk, False),
+                    'redis': (lambda batch: self.redis_sink.write(batch), True),
+                    'hdf': (lambda batch: self.hdf_sink.write(batch), True)}
+        stages = []
+        for name in consumers:
+            handler, batch = handlers[name]
+            stages.append(Stage(name, handler, maxsize=config.SINK_QUEUE_SIZES[name], policy=config.SINK_POLICIES[name],
+                                batch=batch, on_drop=lambda chunk, name=name: chunk.release(name),
+                                background=self.background_io))
+        return Pipeline(stages)
+
+    def close_sinks(self):
+        """Write the remaining data and close the log files."""
+        # handle everything that is still queued
+        self.pipeline.stop(drain=True)
+        for name, stats in self.pipeline.stats().items():
+            logging.info(f"Stage {name}: {stats}")
+        if config.OLED_DISPLAY:
+            logging.info(f"Display: {self.oled.stats()}")
+        if self.hdf_sink is not None:
+            self.hdf_sink.close()
+            self.hdf_sink = None
+        if config.LOG_TO_REDIS:
+            self.redis_sink.close()
+
+    def consumers(self):
+        """Names of the stages that get every chunk."""
+        consumers = []
+        if config.OLED_DISPLAY:
+            consumers.append('display')
+        if config.LOGGING and config.LOG_TO_REDIS:
+            consumers.append('redis')
+        if config.LOGGING and config.LOG_TO_HDF:
+            consumers.append('hdf')
+        return consumers
+
+    def dispatch(self, chunk):
+        """Hand a published chunk to the display and the sinks."""
+        if config.OLED_DISPLAY:
+            # only the newest chunk is drawn if the display is busy
+            self.pipeline.put('display', chunk)
+
+        if config.LOGGING:
+            # log all data, in order; the sinks do the slow work in the background
+            self.log_data(chunk)
+
+    def chunkwise_logger(self, n_cycles = 10, t_size = 128, ring = None):
+        """
+        Sampling loop, chunk after chunk until stopped.
+
+        :param ring: where the chunks are written, defaults to a new `ringbuffer.ChunkRing`
+            that is shared read-only with the display and the sinks
+        """
+        consumers = self.consumers()
+        self.ring = ChunkRing(config.RING_SLOTS, t_size, consumers) if ring is None else ring
+        self.pipeline = self.make_pipeline(consumers)
+
         # inialize variables for integration
         current_delay = 2.0
         acts = [0.0]
-        raw_data = [0.0, 0.0, 0.0]
+        raw_data = [None]
+        ts_realtime_data = [None]
         last_spike = -1e10
         for i in range(n_cycles): 
             #print(i, "self._run: ", self._run)
             # one cycle of logging
             if self._run:
+                # waits if a consumer still uses the chunk of this slot
+                seq, slot = self.ring.acquire()
                 # run the next chunk with the last values as initial conditions
-                ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, last_spike = self.adaptive_logger(t_size, \
+                ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states, lateness, last_spike = self.adaptive_logger(t_size, \
                                                                                         init_activity = acts[-1], \
                                                                                         init_delay = current_delay, \
                                                                                         init_acc = raw_data[-1], \
                                                                                         last_spike = last_spike, \
-                                                                                        return_delay=True)
-
-                if config.OLED_DISPLAY:
-                    # stitch together the object to send to the OLED interfacer thread
-                    display_input = {}
-                    display_input['timeseries'] = diffs
-                    display_input['status'] = "{0:.2f}".format(acts[-1])
-                    display_input['trigger'] = True if int(states[-1]) == config.SLEEP_STATE_DEEP else False
-                    threading.Thread(target=self.oled.draw_display, args=(display_input,)).start()                
-                    #self.oled.draw_timeseries(diffs, text = "{0:.2f}".format(acts[-1]))
+                                                                                        init_t = ts_realtime_data[-1], \
+                                                                                        return_delay=True, out=slot)
+                if len(ts_data) == 0:
+                    # stopped before the first sample of this chunk
+                    continue
+                chunk = self.ring.publish(len(ts_data))
                 
                 elapsed_time = ts_realtime_data[-1] - ts_realtime_data[0]
                 current_delay = delays[-1]
 
-                if config.LOGGING:
-                    # log all data
-                    threading.Thread(target=self.log_data, args=(ts_data, ts_realtime_data, raw_data, acts, diffs, delays, states)).start()                                                                                        
+                if chunk is not None:
+                    self.dispatch(chunk)
             else:
                 if config.VERBOSE_OUTPUT:
                     logging.info(f"Sleep tracking stopped. Elapsed time: {elapsed_time}")
-                    self.oled.print("Good Morning", draw_frame=1, font='large')
+                    if config.OLED_DISPLAY:
+                        self.oled.print("Good Morning", draw_frame=1, font='large')
                 break                
+        self.close_sinks()
+
+    def process_logger(self, n_cycles = 10, t_size = 128):
+        """
+        Like `chunkwise_logger`, but the sampling runs in a separate process with a higher
+        priority (see acquisition.py). This thread hands the chunks to the display and the
+        sinks and runs the stimulus on the live state of the acquisition process.
+        """
+        proc = AcquisitionProcess(self, t_size)
+        consumers = self.consumers()
+        self.ring = proc.reader(consumers)
+        self.pipeline = self.make_pipeline(consumers)
+        proc.start(n_cycles)
+        # like in adaptive_logger, at most every LIVE_PUSH_INTERVAL
+        push_interval = config.LIVE_PUSH_INTERVAL * 1000.0
+        last_push = -1e18
+        try:
+            while True:
+                item = proc.get(timeout=0.1)
+                t, diff, activity, state = proc.live_state()
+                if t > 0:
+                    self.update_state_variables(diff=diff, activity=activity, state=int(state))
+                    if self.live_channel is not None and t - last_push >= push_interval:
+                        self.live_channel.publish(running=True, t=t, diff=diff, activity=activity, state=int(state))
+                        last_push = t
+                    if config.STIMULUS_ACTIVE:
+                        self.trigger_stimulus()
+                if not self._run:
+                    proc.stop()
+                if item == END:
+                    break
+                if item is None:
+                    if not proc.running():
+                        logging.error("Acquisition process ended unexpectedly")
+                        break
+                    continue
+                seq, n_samples = item
+                self.dispatch(self.ring.publish_seq(seq, n_samples))
+        finally:
+            proc.stop()
+            proc.join()
+            self.acquisition_stats = proc.stats
+            self.close_sinks()
+            self.ring = None
+            proc.close()
 
     def start(self):
+        # the file has to be free for the new run, also from the compaction started by
+        # another logger
+        compaction.stop_compaction()
         self._run = True
-        # kick off a thread that loops
-        self.thread = threading.Thread(target=self.chunkwise_logger,
+        # kick off a thread that loops, the sampling itself runs in a process if configured
+        target = self.process_logger if config.ACQUISITION_PROCESS else self.chunkwise_logger
+        self.thread = threading.Thread(target=target,
                              args=(999999999999, 512))
         self.thread.start()
         logging.info("Sleep tracking started.")
@@ -336,7 +566,22 @@ class SleepLogger:
 
     def stop(self):
         self._run = False
-        #self.thread.join()
+        # the logger finishes the current sample and drains the queues of the sinks
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
         logging.info("Sleep tracking stopped.")
+        if self.live_channel is not None:
+            self.live_channel.publish(running=False, t=self.clock.time() * 1000.0)
+        if config.LOG_TO_HDF and config.HDF_COMPACT_AFTER_STOP and self.recorded_runs:
+            # only the new runs, older runs are compacted by hand
+            compaction.start_compaction(self.H5_FILENAME, self.recorded_runs)
+            self.recorded_runs = []
+        if config.STIMULUS_ACTIVE:
+            # fades out within STIMULUS_FADE
+            self.audiostim.stop_stimulus()
+            logging.info(f"Stimulus: {self.audiostim.stats()}")
         #threading.Thread(target=self.oled.draw_display, args=(dict(text="Stopping"),)).start()      
-        self.oled.print("Stopping ...", clear_display=False)
\ No newline at end of file
+        if config.OLED_DISPLAY:
+            self.oled.print("Stopping ...", clear_display=False)
+            # the render thread shows it with the next frame
+            self.oled.wait(timeout=1.0)
\ No newline at end of file
@@ -1,77 +1,248 @@
 import time
+import wave
+import collections
 import numpy as np
-import pyaudio
 import threading
 import logging
 
+import config
+from waveforms import WaveformBank, beat
+
+# latencies that are kept for the stats
+LATENCY_HISTORY = 100
+
+
+class AudioEngine:
+    def __init__(self, bitrate=48000, channels=1, fade=None):
+        """
+        Plays one looped waveform at a time. The output device pulls small blocks with
+        `render` (in the callback of the sound card), so starting and stopping take effect
+        with the next block, a few ms later, instead of at the end of the waveform.
+        Every start fades in and every stop fades out over `fade` s (STIMULUS_FADE), so
+        there is no click.
+
+        The start latency is the time from `start` until the first block with sound is
+        handed to the device, the stop latency the time from `stop` until the fade out is
+        complete, both plus the output latency of the device.
+        """
+        self.bitrate = bitrate
+        self.channels = channels
+        fade = config.STIMULUS_FADE if fade is None else fade
+        self.fade_step = 1.0 / max(fade * bitrate, 1.0) # gain change per frame
+        self.output_latency = 0.0 # seconds, set by the device
+
+        self.lock = threading.Lock()
+        self.source = None # the waveform as it was given
+        self.waveform = None # (frames, channels)
+        self.next_source = None
+        self.next_waveform = None # played after the current one faded out
+        self.playing = False # the waveform is played or fades in
+        self.gain = 0.0
+        self.pos = 0
+        # monotonic time of the start or stop that did not take effect yet
+        self.start_requested = None
+        self.stop_requested = None
+        self.start_latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.stop_latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.blocks = 0
+
+    def channel_layout(self, waveform):
+        """`waveform` as (frames, channels) of the output."""
+        waveform = np.asarray(waveform, dtype=np.float32)
+        if waveform.ndim == 1:
+            waveform = waveform[:, np.newaxis]
+        if waveform.shape[1] == self.channels:
+            return waveform
+        if self.channels == 1:
+            return waveform.mean(axis=1, keepdims=True)
+        # mono on every channel
+        return np.repeat(waveform[:, :1], self.channels, axis=1)
+
+    def start(self, waveform=None):
+        """Fade in `waveform`, or the last one. Another waveform that is playing fades out
+        first, a start while the same one is playing does nothing."""
+        with self.lock:
+            if waveform is not None and waveform is not self.source:
+                if self.waveform is None:
+                    self.source, self.waveform = waveform, self.channel_layout(waveform)
+                else:
+                    self.next_source, self.next_waveform = waveform, self.channel_layout(waveform)
+            if self.waveform is None or (self.playing and self.next_waveform is None):
+                return
+            self.playing = True
+            self.start_requested, self.stop_requested = time.monotonic(), None
+
+    def stop(self):
+        with self.lock:
+            if not self.playing:
+                return
+            self.playing = False
+            self.next_source = self.next_waveform = None
+            self.start_requested, self.stop_requested = None, time.monotonic()
+
+    def render(self, frames):
+        """The next `frames` frames of the output, float32 of shape (frames, channels)."""
+        now = time.monotonic()
+        with self.lock:
+            self.blocks += 1
+            out = np.zeros((frames, self.channels), dtype=np.float32)
+            if self.next_waveform is not None and self.gain == 0.0:
+                self.source, self.waveform, self.pos = self.next_source, self.next_waveform, 0
+                self.next_source = self.next_waveform = None
+            # a waveform that is replaced fades out first
+            fading_in = self.playing and self.next_waveform is None
+            if self.waveform is None or (self.gain == 0.0 and not fading_in):
+                return out
+            if fading_in and self.start_requested is not None:
+                self.start_latencies.append(now - self.start_requested + self.output_latency)
+                self.start_requested = None
+            step = self.fade_step if fading_in else -self.fade_step
+            gain = np.clip(self.gain + step * np.arange(1, frames + 1, dtype=np.float32), 0.0, 1.0)
+            n = len(self.waveform)
+            indices = (self.pos + np.arange(frames)) % n
+            out[:] = self.waveform[indices] * gain[:, np.newaxis]
+            self.pos = (self.pos + frames) % n
+            self.gain = float(gain[-1])
+            if self.gain == 0.0:
+                self.pos = 0
+                if self.stop_requested is not None:
+                    # until the end of this block
+                    self.stop_latencies.append(now - self.stop_requested + frames / self.bitrate
+                                               + self.output_latency)
+                    self.stop_requested = None
+            return out
+
+    def stats(self):
+        """Mean and largest start and stop latency in ms."""
+        with self.lock:
+            latencies = {'start': list(self.start_latencies), 'stop': list(self.stop_latencies)}
+        stats = {'blocks': self.blocks}
+        for name, values in latencies.items():
+            stats[f'{name}s'] = len(values)
+            stats[f'{name}_latency_mean'] = float(np.mean(values)) * 1000.0 if values else None
+            stats[f'{name}_latency_max'] = float(np.max(values)) * 1000.0 if values else None
+        return stats
+
+
+class PyAudioOutput:
+    def __init__(self, engine, block_frames):
+        """The sound card, it pulls the blocks from the engine in the stream callback."""
+        import pyaudio
+        self.p = pyaudio.PyAudio()
+
+        def callback(in_data, frame_count, time_info, status):
+            return engine.render(frame_count).tobytes(), pyaudio.paContinue
+
+        self.stream = self.p.open(format=pyaudio.paFloat32,
+                                  channels=engine.channels,
+                                  rate=int(engine.bitrate),
+                                  output=True,
+                                  frames_per_buffer=block_frames,
+                                  stream_callback=callback)
+        engine.output_latency = self.stream.get_output_latency()
+        self.stream.start_stream()
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.p.terminate()
+
+
+class NullOutput:
+    def __init__(self, engine, block_frames, filename=None):
+        """
+        Pulls the blocks from the engine in real time like a sound card, without one.
+        With a `filename`, the sound is written to a 16 bit wav file.
+        """
+        self.engine = engine
+        self.block_frames = block_frames
+        self.wav = None
+        if filename is not None:
+            self.wav = wave.open(filename, 'wb')
+            self.wav.setnchannels(engine.channels)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(int(engine.bitrate))
+        self._run = True
+        self.thread = threading.Thread(target=self._pull, name='audio', daemon=True)
+        self.thread.start()
+
+    def _pull(self):
+        interval = self.block_frames / self.engine.bitrate
+        next_block = time.monotonic()
+        while self._run:
+            block = self.engine.render(self.block_frames)
+            if self.wav is not None:
+                self.wav.writeframes((np.clip(block, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+            next_block += interval
+            time.sleep(max(next_block - time.monotonic(), 0))
+
+    def close(self):
+        self._run = False
+        self.thread.join()
+        if self.wav is not None:
+            self.wav.close()
+
+
+def open_output(engine, output=None, block_frames=None):
+    """Output device by name (STIMULUS_OUTPUT): 'pyaudio', 'null' or a .wav file name."""
+    output = config.STIMULUS_OUTPUT if output is None else output
+    block_frames = config.STIMULUS_BLOCK_FRAMES if block_frames is None else block_frames
+    if output == 'pyaudio':
+        return PyAudioOutput(engine, block_frames)
+    if output == 'null':
+        return NullOutput(engine, block_frames)
+    return NullOutput(engine, block_frames, filename=output)
+
+
 class AudioStimulus():
-    def __init__(self, base_fr=40.0, stim_fr=0.8, stim_len=5, bitrate=48000):
-        self.PyAudio = pyaudio.PyAudio
+    def __init__(self, base_fr=40.0, stim_fr=0.8, stim_len=5, bitrate=48000, ramp=0.0, bank=None,
+                 output=None):
+        """
+        The audio stimulus, a looped waveform that is started and stopped within a few
+        ms (see AudioEngine).
+
+        :param output: output device, see `open_output`
+        """
         self.bitrate = bitrate
-        self.isActive = False
         self.base_fr = base_fr
         self.stim_fr = stim_fr
         self.stim_len = stim_len  # second
+        self.ramp = ramp # fade in and out of each loop in seconds
+        self.bank = WaveformBank() if bank is None else bank
 
-        self.SLEEP_AFTER_LOOP = 0.0 # in seconds
+        # computed once, memory-mapped from the waveform bank afterwards
+        self.waveform = self.bank.get('beat', base_fr=self.base_fr, stim_fr=self.stim_fr, stim_len=self.stim_len,
+                                      bitrate=self.bitrate, ramp_in=self.ramp, ramp_out=self.ramp)
 
         logging.info("Initializing audio interface ...")
-        self.p = self.PyAudio()
-        self.stream = self.p.open(format=pyaudio.paFloat32,
-                        channels=1,
-                        rate=int(self.bitrate),
-                        output=True)
-                        
-        logging.info("Generating waveform ...")
-        self.waveform = self.generate_sin_waveform()
+        self.engine = AudioEngine(self.bitrate, channels=1)
+        self.output = open_output(self.engine, output)
         logging.info("AudioStimulus initialized.")
 
+    @property
+    def isActive(self):
+        return self.engine.playing
+
     def terminate_audio_stream(self):
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
-        logging.info("Audio stream terminated.")
+        self.engine.stop()
+        self.output.close()
+        logging.info(f"Audio stream terminated. {self.stats()}")
 
     def generate_sin_waveform(self,):
-        sound_len = self.stim_len  # second
-        waveform = np.ndarray(
-            (int(sound_len * self.bitrate)), dtype=np.float32)
-
-        f1 = self.base_fr
-        f2 = self.base_fr + self.stim_fr
-
-        # generate waveform
-        for i in range(len(waveform)):
-            frac = 1 + i / len(waveform)
-            waveform[i] = np.sin(f1 * i / self.bitrate * 2 * np.pi) + \
-                np.sin(f2 * i / self.bitrate * 2 * np.pi + np.pi)
-        waveform /= np.max(waveform)  # normalize
-        return waveform
-
-    def play_audio(self, waveform):
-        # start loop that generates audio
-        while self.isActive:
-            logging.info("Play stimulus.")
-            self.stream.write(waveform, num_frames=len(waveform))
-            time.sleep(self.SLEEP_AFTER_LOOP)
-
-        self.isActive = False
-        logging.info("Stimulus stopped.")
+        # phase-continuous over the loop and normalized to an absolute peak of 1
+        return beat(self.base_fr, self.stim_fr, self.stim_len, self.bitrate)
 
     def start_stimulus(self):
-        self.isActive = True
-        # kick off a thread that loops
-        x = threading.Thread(target=self.play_audio,
-                             args=(self.waveform,))
-        x.start()
+        logging.info("Play stimulus.")
+        self.engine.start(self.waveform)
 
     def play_waveform(self, waveform):
-        self.isActive = True
-        # kick off a thread that loops
-        x = threading.Thread(target=self.play_audio,
-                             args=(waveform,))
-        x.start()
+        # replaces the waveform that is playing
+        self.engine.start(waveform)
 
     def stop_stimulus(self):
-        self.isActive = False
-        logging.info("Stopping stimulus ...")
\ No newline at end of file
+        self.engine.stop()
+        logging.info("Stopping stimulus ...")
+
+    def stats(self):
+        return self.engine.stats()
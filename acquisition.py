@@ -0,0 +1,189 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import config
+from ringbuffer import ChunkRing, SAMPLE_DTYPE
+
+# live state of the logger in shared memory, written after every sample, and the stop flag
+LIVE_SEQ, LIVE_T, LIVE_DIFF, LIVE_ACTIVITY, LIVE_STATE, LIVE_STOP = range(6)
+LIVE_SIZE = 6
+# announced after the last chunk
+END = (-1, 0)
+
+
+def set_priority(priority=None, nice=None):
+    """Real-time scheduling for the calling process if allowed, otherwise a lower nice value."""
+    priority = config.ACQUISITION_PRIORITY if priority is None else priority
+    nice = config.ACQUISITION_NICE if nice is None else nice
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            logging.info(f"Acquisition process {os.getpid()}: SCHED_FIFO priority {priority}")
+            return
+        except (AttributeError, PermissionError, OSError) as e:
+            logging.warning(f"Real-time priority not available ({e}), run as root for less jitter")
+    if nice:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+            logging.info(f"Acquisition process {os.getpid()}: nice {nice}")
+        except (AttributeError, PermissionError, OSError) as e:
+            logging.warning(f"Nice value {nice} not allowed ({e})")
+
+
+class SharedRingWriter:
+    def __init__(self, buffer, free_slots, chunks):
+        """Writing end of the shared ring in the acquisition process, used like a `ChunkRing`
+        by `SleepLogger.chunkwise_logger`. Published chunks are announced to the main process."""
+        self.buffer = buffer
+        self.n_slots = len(buffer)
+        self.free_slots = free_slots
+        self.chunks = chunks
+        self.next_seq = 0
+        self.acquired = False
+
+    def acquire(self):
+        if not self.acquired:
+            # waits for the main process to release the oldest slot
+            self.free_slots.acquire()
+            self.acquired = True
+        return self.next_seq, self.buffer[self.next_seq % self.n_slots]
+
+    def publish(self, n_samples):
+        self.chunks.put((self.next_seq, n_samples))
+        self.next_seq += 1
+        self.acquired = False
+
+
+class SharedRingReader(ChunkRing):
+    def __init__(self, buffer, consumers, free_slots):
+        """Reading end of the shared ring in the main process. Slots are given back to the
+        acquisition process in order, once all consumers released the oldest chunk."""
+        ChunkRing.__init__(self, buffer.shape[0], buffer.shape[1], consumers, buffer=buffer)
+        self.free_slots = free_slots
+        self.oldest = 0
+
+    def publish_seq(self, seq, n_samples):
+        self.next_seq = seq
+        chunk = self.publish(n_samples)
+        self._free()
+        return chunk
+
+    def ack(self, consumer, seq):
+        ChunkRing.ack(self, consumer, seq)
+        self._free()
+
+    def _free(self):
+        with self.cond:
+            while self.oldest < self.next_seq and not self.holders[self.oldest % self.n_slots]:
+                self.free_slots.release()
+                self.oldest += 1
+
+
+def _acquire(sl, writer, live, done, n_cycles, t_size):
+    """Main function of the acquisition process (forked, `sl` is a copy of the SleepLogger)."""
+    set_priority()
+    # display, stimulus and logging stay in the main process
+    config.OLED_DISPLAY = False
+    config.STIMULUS_ACTIVE = False
+    config.LOGGING = False
+    sl.live_state = live
+    # the viewers are connected to the main process, it publishes the live state
+    sl.live_channel = None
+    sl.profiler = None
+    sl._run = True
+
+    def watch_stop():
+        # polls the flag, a process waiting on a multiprocessing.Event can not exit safely
+        while not live[LIVE_STOP]:
+            time.sleep(0.05)
+        sl._run = False
+    threading.Thread(target=watch_stop, daemon=True).start()
+
+    try:
+        sl.chunkwise_logger(n_cycles, t_size, ring=writer)
+    finally:
+        writer.chunks.put(END)
+        done.put({'missed': sl.scheduler.missed, 'skipped': sl.scheduler.skipped, 'stale_reads': sl.stale_reads})
+
+
+class AcquisitionProcess:
+    def __init__(self, sl, chunk_size, n_slots=None):
+        """
+        Runs the sampling loop of the SleepLogger `sl` in a forked process, so that it does
+        not share the GIL with the sinks, the display, the stimulus and the web interface.
+
+        Samples are written into a ring of chunks in shared memory, the main process gets the
+        sequence numbers of finished chunks and reads them without copies. The current diff,
+        activity and state are published in shared memory after every sample.
+        """
+        self.n_slots = config.RING_SLOTS if n_slots is None else n_slots
+        self.chunk_size = chunk_size
+        ctx = mp.get_context('fork')
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * chunk_size * SAMPLE_DTYPE.itemsize \
+                                              + LIVE_SIZE * 8)
+        self.buffer = np.ndarray((self.n_slots, chunk_size), dtype=SAMPLE_DTYPE, buffer=self.shm.buf)
+        self.live = np.ndarray((LIVE_SIZE,), dtype=np.float64, buffer=self.shm.buf,
+                               offset=self.n_slots * chunk_size * SAMPLE_DTYPE.itemsize)
+        self.live[:] = 0
+        self.free_slots = ctx.Semaphore(self.n_slots)
+        self.chunks = ctx.Queue()
+        self.done = ctx.Queue()
+        self.sl = sl
+        self.ctx = ctx
+        self.process = None
+        self.stats = None
+
+    def reader(self, consumers):
+        return SharedRingReader(self.buffer, consumers, self.free_slots)
+
+    def start(self, n_cycles):
+        writer = SharedRingWriter(self.buffer, self.free_slots, self.chunks)
+        self.process = self.ctx.Process(target=_acquire, name="acquisition",
+                                        args=(self.sl, writer, self.live, self.done,
+                                              n_cycles, self.chunk_size))
+        self.process.start()
+        logging.info(f"Acquisition process {self.process.pid} started")
+
+    def get(self, timeout):
+        """Sequence number and length of the next chunk, `END` after the last one and None on timeout."""
+        try:
+            return self.chunks.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def running(self):
+        return self.process is not None and self.process.is_alive()
+
+    def live_state(self):
+        """Time, diff, activity and state of the last sample, consistent (seqlock)."""
+        while True:
+            seq = self.live[LIVE_SEQ]
+            values = self.live[LIVE_T:LIVE_STOP].copy()
+            if seq % 2 == 0 and self.live[LIVE_SEQ] == seq:
+                return values
+
+    def stop(self):
+        self.live[LIVE_STOP] = 1
+
+    def join(self):
+        try:
+            self.stats = self.done.get(timeout=60)
+        except queue.Empty:
+            logging.warning("Acquisition process did not report back")
+        self.process.join()
+
+    def close(self):
+        # views into the shared memory have to be gone before it can be closed
+        self.buffer = self.live = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        self.shm.unlink()
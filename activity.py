@@ -0,0 +1,160 @@
+import numpy as np
+import h5py
+
+import config
+import storage
+
+
+class ActivityIntegrator:
+    def __init__(self, threshold=None, decay=None, spike_strength=None, decay_delay=None,
+                 lower_bound=None, init_activity=0.0, last_spike=-1e10, last_t=None):
+        """
+        Vectorized version of `SleepLogger.integrate_activity` for offline re-scoring.
+
+        Processes whole arrays of timestamps (ms) and movement magnitudes instead of
+        single samples and gives the same activity trace as the live integrator.
+        The integrator state (activity, time of the last spike, last timestamp)
+        is kept between calls of `integrate`, so a recording can be fed chunk by chunk.
+        Parameters that are not given are taken from `config.py`.
+        """
+        self.threshold = config.ACCELEROMETER_ACTIVITY_THRESHOLD if threshold is None else threshold
+        self.decay = config.ACTIVITY_DECAY_CONSTANT if decay is None else decay
+        self.spike_strength = config.ACTIVITY_SPIKE_STRENGTH if spike_strength is None else spike_strength
+        self.decay_delay = config.ACTIVITY_DECAY_DELAY if decay_delay is None else decay_delay
+        self.lower_bound = config.ACTIVITY_LOWER_BOUND if lower_bound is None else lower_bound
+
+        # state variables, same meaning as in `SleepLogger.adaptive_logger`
+        self.activity = init_activity
+        self.last_spike = last_spike
+        self.last_t = last_t
+
+    def integrate(self, ts, diffs):
+        """Integrate the activity for one chunk of samples.
+
+        :param ts: timestamps of the samples in ms (`ts_realtime`)
+        :param diffs: movement magnitudes of the samples (`diffs`)
+        :return: activity after each sample
+        """
+        ts = np.asarray(ts, dtype=np.float64)
+        diffs = np.asarray(diffs)
+        n = len(ts)
+        acts = np.empty(n)
+        if n == 0:
+            return acts
+
+        spikes = diffs > self.threshold
+        spike_idx = np.flatnonzero(spikes)
+
+        # time of the last spike seen at every sample, constant between two spikes
+        spike_times = np.empty(len(spike_idx) + 1)
+        spike_times[0] = self.last_spike
+        spike_times[1:] = ts[spike_idx]
+        last_spike_t = np.repeat(spike_times, np.diff(spike_idx, prepend=0, append=n))
+
+        # samples that are allowed to decay (given that the activity is above the lower bound)
+        decaying = ts - last_spike_t > self.decay_delay
+        decaying &= ~spikes
+
+        # Activity only decays after a quiet period longer than decay_delay. Between two
+        # spikes without such a period the integrator only sees spikes, so the activity
+        # follows 1 - (1 - a) * (1 - s)^n. We split the chunk into groups that start with
+        # a spike and end with the quiet tail before the next group, and evaluate both
+        # parts in closed form. Only the few groups per night are looped over in Python.
+        if len(spike_idx):
+            # does the segment from a spike to the next one contain decaying samples
+            quiet = np.logical_or.reduceat(decaying, spike_idx)
+            gap = np.empty(len(spike_idx), dtype=bool)
+            gap[0] = True
+            gap[1:] = quiet[:-1]
+            group_starts = spike_idx[gap]
+            # last spike of every group
+            group_ends = spike_idx[np.append(np.flatnonzero(gap)[1:] - 1, len(spike_idx) - 1)]
+        else:
+            group_starts = group_ends = spike_idx
+
+        activity = self._decay_tail(acts, ts, decaying, 0, group_starts[0] if len(group_starts) else n,
+                                    self.activity)
+        q = 1.0 - self.spike_strength
+        for k, (start, end) in enumerate(zip(group_starts, group_ends)):
+            # spikes of the group, the count includes the current sample
+            counts = np.cumsum(spikes[start:end + 1])
+            body = 1.0 - (1.0 - activity) * q ** counts
+            if body[0] < self.lower_bound:
+                # only possible with spike_strength < lower bound, activity restarts from 0
+                body = 1.0 - q ** (counts - 1)
+                if self.spike_strength < self.lower_bound:
+                    body[:] = 0.0
+            body[body < self.lower_bound] = 0.0
+            acts[start:end + 1] = body
+
+            tail_end = group_starts[k + 1] if k + 1 < len(group_starts) else n
+            activity = self._decay_tail(acts, ts, decaying, end + 1, tail_end, body[-1])
+
+        self.activity = activity
+        if len(spike_idx):
+            self.last_spike = ts[spike_idx[-1]]
+        self.last_t = ts[-1]
+        return acts
+
+    def _decay_tail(self, acts, ts, decaying, start, end, activity):
+        """Fill `acts[start:end]` with an exponential decay that starts at `activity`
+        and stops once the lower bound is crossed. Returns the last activity value."""
+        if start >= end:
+            return activity
+        lower_bound = self.lower_bound
+        if activity <= lower_bound:
+            # no decay below the lower bound, values under it are clamped to 0
+            acts[start:end] = 0.0 if activity < lower_bound else activity
+            return acts[end - 1]
+        # integration step of every sample, the first one of a chunk continues from the last chunk
+        dt = np.empty(end - start)
+        dt[1:] = ts[start + 1:end] - ts[start:end - 1]
+        if start > 0:
+            dt[0] = ts[start] - ts[start - 1]
+        else:
+            dt[0] = 0.0 if self.last_t is None else ts[0] - self.last_t
+        decay_factors = np.where(decaying[start:end], 1.0 - dt / self.decay, 1.0)
+        tail = activity * np.cumprod(decay_factors)
+        below = np.flatnonzero(tail <= lower_bound)
+        if len(below):
+            first = below[0]
+            # exactly at the bound the decay stops, below it the activity is set to 0
+            tail[first:] = 0.0 if tail[first] < lower_bound else tail[first]
+        acts[start:end] = tail
+        return tail[-1]
+
+
+def detect_states(acts, deep_threshold=None, wake_threshold=None):
+    """Vectorized version of `SleepLogger.detect_state`."""
+    deep_threshold = config.ACTIVITY_THRESHOLD_DEEP_SLEEP if deep_threshold is None else deep_threshold
+    wake_threshold = config.ACTIVITY_THRESHOLD_WAKE if wake_threshold is None else wake_threshold
+    acts = np.asarray(acts)
+    states = np.full(acts.shape, config.SLEEP_STATE_WAKE, dtype=np.uint8)
+    states[acts < wake_threshold] = config.SLEEP_STATE_LIGHT
+    states[acts < deep_threshold] = config.SLEEP_STATE_DEEP
+    return states
+
+
+def rescore(ts, diffs, chunk_size=2**16, deep_threshold=None, wake_threshold=None, **params):
+    """Recompute activity and sleep states of a whole recording.
+
+    :param ts: `ts_realtime` array of a run in ms
+    :param diffs: `diffs` array of a run
+    :param chunk_size: number of samples processed at once, bounds the memory of temporaries
+    :param params: parameters of `ActivityIntegrator`, defaults are taken from `config.py`
+    :return: acts, states
+    """
+    integrator = ActivityIntegrator(**params)
+    acts = np.empty(len(ts))
+    for i in range(0, len(ts), chunk_size):
+        acts[i:i + chunk_size] = integrator.integrate(ts[i:i + chunk_size], diffs[i:i + chunk_size])
+    states = detect_states(acts, deep_threshold=deep_threshold, wake_threshold=wake_threshold)
+    return acts, states
+
+
+def rescore_run(run_name, filename=config.HDF_FILE, **kwargs):
+    """Load a run from the hdf file and re-score it with the current `config.py` parameters."""
+    with h5py.File(filename, mode='r', libver='latest', swmr=True) as h5f:
+        ts = storage.read_column(h5f[run_name], 'ts_realtime')
+        diffs = storage.read_column(h5f[run_name], 'diffs')
+    return rescore(ts, diffs, **kwargs)
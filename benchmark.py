@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+
+import numpy as np
+
+import config
+import storage
+
+STAGES = ['read', 'diff', 'integrate', 'state', 'store', 'sleep']
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class LoopProfiler:
+    def __init__(self):
+        """
+        Collects timestamps between the stages of every sample of `SleepLogger.adaptive_logger`.
+        Attach it with `sl.profiler = LoopProfiler()` and call `report()` afterwards.
+        """
+        self.marks = []
+        self.chunk_starts = []
+
+    def start_chunk(self):
+        self.chunk_starts.append(len(self.marks))
+
+    def add_sample(self, m_start, m_read, m_diff, m_integrate, m_state, m_store, m_sleep, delay, lateness):
+        self.marks.append((m_start, m_read, m_diff, m_integrate, m_state, m_store, m_sleep, delay, lateness))
+
+    def report(self, min_delay=None):
+        """Latency percentiles of every stage, achieved sampling period and chunk handoff gaps.
+        All durations are in microseconds, periods and delays in milliseconds."""
+        min_delay = config.LOGGER_MIN_DELAY if min_delay is None else min_delay
+        marks = np.array(self.marks)
+        delays = marks[:, 7]
+        durations = np.diff(marks[:, :7], axis=1) * 1e6
+        report = {'samples': len(marks), 'chunks': len(self.chunk_starts), 'stages': {}}
+        for k, stage in enumerate(STAGES):
+            report['stages'][stage] = _stats(durations[:, k])
+        # time spent waiting longer than requested, negative when the deadline
+        # scheduler shortens the wait to make up for the processing time
+        report['stages']['sleep_overshoot'] = _stats(durations[:, 5] - delays * 1e3)
+        report['stages']['total_work'] = _stats(durations[:, :5].sum(axis=1))
+
+        # achieved period between the starts of two samples, compared to the requested delay
+        periods = np.diff(marks[:, 0]) * 1e3
+        requested = delays[:-1]
+        at_min = np.isclose(requested, min_delay)
+        report['rate'] = {
+            'target_delay_ms': min_delay,
+            'target_rate_hz': 1000.0 / min_delay,
+            'samples_at_min_delay': int(at_min.sum()),
+            'period_at_min_delay_ms': _stats(periods[at_min]),
+            'achieved_rate_at_min_delay_hz': float(1000.0 / periods[at_min].mean()) if at_min.any() else None,
+            'period_error_ms': _stats(periods - requested),
+            'mean_relative_period_error': float(np.mean((periods - requested) / requested)) if len(periods) else None,
+            # start of a sample after its scheduled deadline
+            'lateness_ms': _stats(marks[:, 8]),
+        }
+
+        # gap between the end of the last sample of a chunk and the start of the next chunk
+        firsts = np.array(self.chunk_starts[1:], dtype=int)
+        firsts = firsts[(firsts > 0) & (firsts < len(marks))]
+        gaps = (marks[firsts, 0] - marks[firsts - 1, 6]) * 1e3
+        report['handoff'] = {
+            'gap_ms': _stats(gaps),
+            # samples that would have been taken at the current delay during the gaps
+            'samples_lost': float(np.sum(gaps / delays[firsts - 1])),
+        }
+        return report
+
+
+def _stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return None
+    stats = {'mean': float(values.mean()), 'max': float(values.max())}
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        stats[f'p{p:g}'] = float(v)
+    return stats
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpu_load(stop):
+    """Pure Python work that holds the GIL, like the rendering and web requests on the Pi."""
+    while not stop.is_set():
+        sum(i * i for i in range(10000))
+
+
+def jitter_report(filename):
+    """Lateness of the samples and error of the sampling periods of the recorded run, in ms."""
+    import h5py
+    with h5py.File(filename, 'r') as h5f:
+        run = h5f[storage.run_names(h5f)[-1]]
+        lateness, ts, delays = [storage.read_column(run, name) for name in ('lateness', 'ts_realtime', 'delays')]
+    return {'samples': len(ts), 'lateness_ms': _stats(lateness),
+            'period_error_ms': _stats(np.diff(ts) - delays[:-1])}
+
+
+def run_benchmark(duration=60.0, chunk_size=512, latency=0.0, event_rate=1 / 20.0, seed=0,
+                  hardware=False, log_to_hdf=True, fast_read=False, process=False, load=0):
+    """
+    Run the acquisition loop in real time and profile it.
+
+    :param duration: length of the benchmark in seconds
+    :param latency: simulated I2C transaction time in seconds
+    :param event_rate: movements per second of the synthetic sensor, movements
+        drive the logger to its minimum delay
+    :param hardware: use the real accelerometer instead of the simulated one
+    :param log_to_hdf: log the chunks to a temporary hdf file like a normal recording
+    :param fast_read: read only the 8 bit MSBs of the accelerometer
+    :param process: sample in a separate process (`config.ACQUISITION_PROCESS`). The stages
+        of the loop are not profiled then, the jitter is taken from the recorded lateness.
+    :param load: number of threads with pure Python work in the main process during the benchmark
+    """
+    config.OLED_DISPLAY = False
+    config.STIMULUS_ACTIVE = False
+    config.LOG_TO_REDIS = False
+    config.VERBOSE_OUTPUT = False
+    config.LOGGING = log_to_hdf
+    config.LOG_TO_HDF = log_to_hdf
+    config.ACCELEROMETER_FAST_READ = fast_read
+    config.ACQUISITION_PROCESS = process
+    if process:
+        # the jitter is measured on the recorded run
+        log_to_hdf = config.LOGGING = config.LOG_TO_HDF = True
+
+    from SleepLogger import SleepLogger
+    from clock import RealClock
+
+    clock = RealClock()
+    sl = None
+
+    def stop():
+        sl._run = False
+
+    if hardware:
+        bus = None
+    else:
+        from drivers.MMA_sim import SimulatedMMA8452Q, SyntheticMovement
+        source = SyntheticMovement(start=clock.time(), duration=duration, event_rate=event_rate, seed=seed)
+        bus = SimulatedMMA8452Q(source, clock, latency=latency, on_exhausted=stop)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sl = SleepLogger(bus=bus, clock=clock, h5_filename=os.path.join(tmp, 'bench.h5'))
+        stop_load = threading.Event()
+        for _ in range(load):
+            threading.Thread(target=cpu_load, args=(stop_load,), daemon=True).start()
+        sl._run = True
+        if process:
+            # the end of the data is not seen by this copy of the logger
+            threading.Timer(duration, stop).start()
+            sl.process_logger(n_cycles=999999999999, t_size=chunk_size)
+            report = {'rate': {'missed_deadlines': sl.acquisition_stats['missed'],
+                               'skipped_deadlines': sl.acquisition_stats['skipped'],
+                               'stale_reads': sl.acquisition_stats['stale_reads']}}
+        else:
+            sl.profiler = LoopProfiler()
+            if hardware:
+                # no end of data on real hardware
+                threading.Timer(duration, stop).start()
+            sl.chunkwise_logger(n_cycles=999999999999, t_size=chunk_size)
+            report = sl.profiler.report()
+            report['rate']['missed_deadlines'] = sl.scheduler.missed
+            report['rate']['skipped_deadlines'] = sl.scheduler.skipped
+            report['rate']['stale_reads'] = sl.stale_reads
+        stop_load.set()
+        report['pipeline'] = sl.pipeline.stats()
+        if log_to_hdf:
+            report['jitter'] = jitter_report(os.path.join(tmp, 'bench.h5'))
+        # let the logging threads finish before the file is removed
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()
+
+    report['settings'] = dict(duration=duration, chunk_size=chunk_size, latency=latency, event_rate=event_rate,
+                              seed=seed, hardware=hardware, log_to_hdf=log_to_hdf, fast_read=fast_read,
+                              process=process, load=load,
+                              min_delay=config.LOGGER_MIN_DELAY, max_delay=config.LOGGER_MAX_DELAY)
+    report['system'] = dict(revision=git_revision(), python=sys.version.split()[0],
+                            platform=platform.platform(), machine=platform.machine(),
+                            time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    return report
+
+
+def print_report(report):
+    if 'stages' in report:
+        print(f"{report['samples']} samples in {report['chunks']} chunks")
+        print(f"{'stage':<16}" + "".join(f"{'p' + format(p, 'g'):>10}" for p in PERCENTILES) + f"{'max':>10}  [us]")
+        for stage, stats in report['stages'].items():
+            print(f"{stage:<16}" + "".join(f"{stats['p' + format(p, 'g')]:>10.1f}" for p in PERCENTILES)
+                  + f"{stats['max']:>10.1f}")
+    rate = report['rate']
+    if rate.get('achieved_rate_at_min_delay_hz') is not None:
+        print(f"rate at min delay: {rate['achieved_rate_at_min_delay_hz']:.1f} Hz "
+              f"(target {rate['target_rate_hz']:.1f} Hz, {rate['samples_at_min_delay']} samples)")
+    if 'jitter' in report:
+        lateness = report['jitter']['lateness_ms']
+        print(f"lateness of {report['jitter']['samples']} recorded samples: median {lateness['p50']:.3f} ms, "
+              f"p99 {lateness['p99']:.3f} ms, p99.9 {lateness['p99.9']:.3f} ms, max {lateness['max']:.3f} ms")
+    print(f"{rate['missed_deadlines']} missed and {rate['skipped_deadlines']} skipped deadlines")
+    if 'handoff' in report and report['handoff']['gap_ms'] is not None:
+        print(f"chunk handoff: median gap {report['handoff']['gap_ms']['p50']:.2f} ms, "
+              f"{report['handoff']['samples_lost']:.1f} samples lost")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition loop of the sleep logger.")
+    parser.add_argument('-d', '--duration', type=float, default=60.0, help="duration in seconds")
+    parser.add_argument('-c', '--chunk-size', type=int, default=512, help="samples per chunk")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated I2C transaction time in seconds")
+    parser.add_argument('--event-rate', type=float, default=1 / 20.0, help="synthetic movements per second")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hardware', action='store_true', help="use the real accelerometer")
+    parser.add_argument('--no-log', action='store_true', help="do not log to a temporary hdf file")
+    parser.add_argument('--fast-read', action='store_true', help="8 bit fast read mode of the accelerometer")
+    parser.add_argument('--process', action='store_true', help="sample in a separate process")
+    parser.add_argument('--load', type=int, default=0, help="threads with pure Python work during the benchmark")
+    parser.add_argument('-o', '--output', default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    report = run_benchmark(duration=args.duration, chunk_size=args.chunk_size, latency=args.latency,
+                           event_rate=args.event_rate, seed=args.seed, hardware=args.hardware,
+                           log_to_hdf=not args.no_log, fast_read=args.fast_read, process=args.process,
+                           load=args.load)
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,131 @@
+"""
+Catalog of the runs in the hdf file: start, end, number of samples, duration, minutes in
+each sleep state and whether the run is long enough to be shown. It is a small json file
+next to the hdf file (log.h5 -> log_catalog.json), so listing and filtering the runs does
+not open a single run.
+
+The logger adds the run it records and updates it while recording (see sinks.HDFSink),
+runs recorded before are added with a backfill:
+python catalog.py --file log.h5
+"""
+import os
+import json
+import fcntl
+import argparse
+import logging
+
+import numpy as np
+
+import config
+import storage
+import summary
+
+
+def catalog_path(filename):
+    return os.path.splitext(filename)[0] + "_catalog.json"
+
+
+def make_entry(start, end, samples, state_ms, recording=False):
+    """Catalog entry of a run.
+
+    :param start, end: time of the first and last sample in ms
+    :param state_ms: ms spent in each sleep state, by state
+    :param recording: the run is still being recorded
+    """
+    hours = float(end - start) / 3600000.0
+    return {"start": float(start), "end": float(end), "samples": int(samples), "hours": hours,
+            "wake_minutes": state_ms.get(config.SLEEP_STATE_WAKE, 0.0) / 60000.0,
+            "light_minutes": state_ms.get(config.SLEEP_STATE_LIGHT, 0.0) / 60000.0,
+            "deep_minutes": state_ms.get(config.SLEEP_STATE_DEEP, 0.0) / 60000.0,
+            "valid": bool(hours >= config.CATALOG_MIN_HOURS), "recording": recording}
+
+
+def describe_run(grp):
+    """Catalog entry of a finished run, from its summary pyramid if it has one."""
+    n = grp["ts_realtime"].shape[0]
+    if not n:
+        return make_entry(0.0, 0.0, 0, {})
+    start = storage.read_column(grp, "ts_realtime", slice(0, 1))[0]
+    end = storage.read_column(grp, "ts_realtime", slice(n - 1, n))[0]
+    if summary.has_summary(grp):
+        rows = summary.read_level(grp, "10min")
+    else:
+        run = storage.read_run(grp, ["ts_realtime", "diffs", "acts", "states"])
+        rows = summary.summarize(run["ts_realtime"], run["diffs"], run["acts"], run["states"], 600000)
+    state_ms = {state: float(np.sum(rows[field])) for state, field in summary.STATE_FIELDS.items()}
+    return make_entry(start, end, n, state_ms)
+
+
+def load(filename=None):
+    """Catalog of the hdf file, a dict of entries by run name."""
+    filename = config.HDF_FILE if filename is None else filename
+    try:
+        with open(catalog_path(filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f"{catalog_path(filename)} is broken, run a backfill")
+        return {}
+
+
+def update(filename, entries, remove=()):
+    """Add or replace the `entries` (dict by run name) and remove the runs `remove`."""
+    path = catalog_path(filename)
+    # the logger, the compaction and the web interface may update it at the same time
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        runs = load(filename)
+        runs.update(entries)
+        for run_name in remove:
+            runs.pop(run_name, None)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(sorted(runs.items())), f, indent=1)
+        os.replace(tmp_path, path)
+
+
+def list_runs(filename=None, valid=True, newest_first=True):
+    """Names of the runs in the catalog, only the valid ones if `valid`."""
+    runs = [name for name, entry in sorted(load(filename).items()) if entry["valid"] or not valid]
+    return runs[::-1] if newest_first else runs
+
+
+def backfill(filename=None, rebuild=False, recording=False):
+    """Add the runs of the hdf file that are not in the catalog, and remove the runs that
+    are not in the file any more. All runs are described again if `rebuild`.
+
+    :param recording: also describe the runs that are marked as recording again, if the
+        logger is known to be stopped, e.g. it died in the middle of a run
+
+    :return: number of added runs, None if the hdf file was locked (see storage.open_file)
+    """
+    filename = config.HDF_FILE if filename is None else filename
+    runs = load(filename)
+    entries = {}
+    try:
+        with storage.open_file(filename) as h5f:
+            names = storage.run_names(h5f)
+            for run_name in names:
+                entry = runs.get(run_name)
+                if rebuild or entry is None or (recording and entry.get("recording")):
+                    entries[run_name] = describe_run(h5f[run_name])
+    except BlockingIOError:
+        logging.warning(f"{filename} is locked, the catalog is not updated")
+        return None
+    removed = [run_name for run_name in runs if run_name not in names]
+    if entries or removed:
+        update(filename, entries, remove=removed)
+        logging.info(f"{catalog_path(filename)}: {len(entries)} runs added, {len(removed)} removed")
+    return len(entries)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Add the runs of the hdf file to its catalog.")
+    parser.add_argument("-f", "--file", default=config.HDF_FILE, help="hdf file")
+    parser.add_argument("--rebuild", action="store_true", help="describe every run again")
+    parser.add_argument("--recording", action="store_true",
+                        help="describe the runs marked as recording again, only if the logger is not running")
+    args = parser.parse_args()
+    backfill(args.file, rebuild=args.rebuild, recording=args.recording)
@@ -0,0 +1,40 @@
+import time
+import threading
+
+
+class RealClock:
+    """Wall clock of the system, used for normal recordings."""
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock:
+    def __init__(self, start=None):
+        """
+        Simulated clock for replaying recordings faster than real time.
+        Sleeping does not wait but advances the clock immediately.
+
+        :param start: initial time in seconds since the epoch, defaults to now
+        """
+        self.start = time.time() if start is None else start
+        # elapsed time in integer ns, so that even tiny sleeps advance the clock
+        self._elapsed = 0
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.start + self._elapsed / 1e9
+
+    def monotonic(self):
+        return self._elapsed / 1e9
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._elapsed += max(int(round(seconds * 1e9)), 1)
@@ -0,0 +1,305 @@
+"""
+Compaction of finished runs in the hdf file.
+
+At night the runs are written with cheap compression in small chunks (`HDF_COMPRESSION`,
+`HDF_CHUNK_ROWS`). A compaction rewrites a finished run with large chunks for reading and
+strong compression (`HDF_COMPACT_*`) into a side file (log.h5.compact), compares it with
+the original and only then copies it into the hdf file in place of the original. The hdf
+file is only locked for this copy of the compressed chunks, while the run is compressed
+it can be read, e.g. by the web interface. Space of the replaced runs is only given back
+by a repack of the whole file.
+
+After a recording stops, only the recorded run is compacted in the background (see
+`start_compaction`), older runs are compacted by hand.
+
+Usage:
+python compaction.py --file log.h5
+python compaction.py --file log.h5 --repack
+"""
+import os
+import time
+import argparse
+import logging
+import multiprocessing as mp
+
+import numpy as np
+import h5py
+
+import config
+import storage
+import summary
+import catalog
+
+# rows copied and compared at once, bounds the memory on the Pi
+BLOCK_ROWS = 1 << 20
+# prefix of the group a run is swapped in as, not listed as a run
+TMP_PREFIX = "_compact_"
+# prefix of the original of a run while it is swapped out, deleted after the swap
+OLD_PREFIX = "_original_"
+# the run is compressed into this file next to the hdf file
+SIDE_SUFFIX = ".compact"
+
+
+def copy_run(src, dst_parent, dst_name, chunk_rows=None, compression=None, level=None, stop=None):
+    """Copy the run in group `src` with new chunking and compression, values and dtypes unchanged.
+
+    :param stop: Event, the copy is given up between two blocks if it is set
+    :return: the new group, None if it was given up
+    """
+    chunk_rows = config.HDF_COMPACT_CHUNK_ROWS if chunk_rows is None else chunk_rows
+    compression = config.HDF_COMPACT_COMPRESSION if compression is None else compression
+    level = config.HDF_COMPACT_LEVEL if level is None else level
+    dst = dst_parent.create_group(dst_name)
+    dst.attrs.update(src.attrs)
+    for name, dset in src.items():
+        n = dset.shape[0]
+        out = dst.create_dataset(name, shape=dset.shape, dtype=dset.dtype, maxshape=(None,),
+                                 chunks=(max(1, min(chunk_rows, n)),), compression=compression,
+                                 compression_opts=level if compression == "gzip" else None, shuffle=True)
+        out.attrs.update(dset.attrs)
+        for i in range(0, n, BLOCK_ROWS):
+            if stop is not None and stop.is_set():
+                return None
+            out[i:i + BLOCK_ROWS] = dset[i:i + BLOCK_ROWS]
+    dst.attrs["compacted"] = True
+    return dst
+
+
+def same_run(a, b):
+    """Do the groups `a` and `b` hold the same datasets and values?"""
+    if set(a.keys()) != set(b.keys()):
+        return False
+    for name in a:
+        if a[name].shape != b[name].shape or a[name].dtype != b[name].dtype:
+            return False
+        for i in range(0, a[name].shape[0], BLOCK_ROWS):
+            if not np.array_equal(a[name][i:i + BLOCK_ROWS], b[name][i:i + BLOCK_ROWS]):
+                return False
+    return all(k in b.attrs and np.array_equal(a.attrs[k], b.attrs[k]) for k in a.attrs)
+
+
+def _signature(grp):
+    """Shapes and hdf objects of the datasets of a run, they change if the run is rewritten."""
+    return {name: (dset.shape, h5py.h5o.get_info(dset.id).addr) for name, dset in grp.items()}
+
+
+def compact_run(filename, run_name, stop=None, **kwargs):
+    """Rewrite a finished run of the hdf file into a side file and swap it in once it is
+    verified. The hdf file is only opened for writing for the swap.
+
+    :param stop: Event, the compaction is given up if it is set before the swap
+    :return: True if the run was replaced
+    """
+    side_filename = filename + SIDE_SUFFIX
+    try:
+        with storage.open_file(filename) as h5f, h5py.File(side_filename, "w", libver="latest") as side:
+            src = h5f[run_name]
+            signature = _signature(src)
+            before = _storage_size(src)
+            start = time.monotonic()
+            dst = copy_run(src, side, run_name, stop=stop, **kwargs)
+            if dst is None:
+                logging.info(f"{filename}/{run_name}: compaction stopped")
+                return False
+            if not same_run(src, dst):
+                logging.error(f"{run_name}: compacted copy differs from the original, run left as it is")
+                return False
+            if not summary.has_summary(dst):
+                # recorded before the summaries existed
+                summary.build(dst)
+            after = _storage_size(dst)
+        if stop is not None and stop.is_set():
+            return False
+        # readers are kept out from here on, only for copying the compressed chunks
+        with storage.open_file(filename, "a") as h5f:
+            finish_swaps(h5f)
+            if _signature(h5f[run_name]) != signature:
+                logging.warning(f"{filename}/{run_name}: changed while it was compacted, left as it is")
+                return False
+            tmp_name, old_name = TMP_PREFIX + run_name, OLD_PREFIX + run_name
+            with h5py.File(side_filename, "r") as side:
+                side.copy(side[run_name], h5f, name=tmp_name)
+            # the run is always there under one of the names, see `finish_swaps`
+            h5f.move(run_name, old_name)
+            h5f.move(tmp_name, run_name)
+            del h5f[old_name]
+        logging.info(f"{filename}/{run_name}: compacted from {before / 1e6:.1f} MB to "
+                     f"{after / 1e6:.1f} MB in {time.monotonic() - start:.1f} s")
+        return True
+    finally:
+        if os.path.exists(side_filename):
+            os.remove(side_filename)
+
+
+def finish_swaps(h5f):
+    """Clean up after swaps that were interrupted, e.g. by a power cut. A run that is
+    missing is moved back in from its complete copy or from its original, copies that
+    were not swapped in and originals that were replaced are deleted.
+
+    :return: True if something was changed
+    """
+    changed = False
+    for name in list(h5f.keys()):
+        for prefix in (TMP_PREFIX, OLD_PREFIX):
+            if not name.startswith(prefix) or name not in h5f:
+                continue
+            run_name = name[len(prefix):]
+            if run_name not in h5f:
+                # the original was moved aside after the copy was complete, either one
+                # is the whole run, the copy is compressed
+                h5f.move(TMP_PREFIX + run_name if TMP_PREFIX + run_name in h5f else name, run_name)
+                logging.warning(f"{h5f.filename}/{run_name}: restored after an interrupted compaction")
+            for leftover in (TMP_PREFIX + run_name, OLD_PREFIX + run_name):
+                if leftover in h5f:
+                    del h5f[leftover]
+            changed = True
+    return changed
+
+
+def _finish_interrupted_swaps(filename):
+    with storage.open_file(filename) as h5f:
+        interrupted = any(name.startswith((TMP_PREFIX, OLD_PREFIX)) for name in h5f.keys())
+    if interrupted:
+        with storage.open_file(filename, "a") as h5f:
+            finish_swaps(h5f)
+
+
+def pending_runs(h5f):
+    """Runs that were not compacted yet."""
+    return [name for name in storage.run_names(h5f) if not h5f[name].attrs.get("compacted", False)]
+
+
+def compact_file(filename=None, run_names=None, stop=None, **kwargs):
+    """Compact the runs `run_names` (all pending runs if None) of the hdf file, one at a
+    time. Runs that are compacted already are skipped.
+
+    The file must not be recorded to at the same time, the swap fails if it is.
+
+    :param stop: `threading.Event` or `multiprocessing.Event`, checked while copying
+    :return: number of compacted runs
+    """
+    filename = config.HDF_FILE if filename is None else filename
+    _finish_interrupted_swaps(filename)
+    with storage.open_file(filename) as h5f:
+        pending = pending_runs(h5f)
+    run_names = pending if run_names is None else [name for name in run_names if name in pending]
+    n = 0
+    for run_name in run_names:
+        if stop is not None and stop.is_set():
+            break
+        if compact_run(filename, run_name, stop=stop, **kwargs):
+            n += 1
+    return n
+
+
+def repack(filename=None, **kwargs):
+    """Rewrite the whole hdf file to give back the space of replaced and deleted runs.
+    Every run is compacted on the way. The file is only replaced after every run was
+    verified, and must not be in use by the logger."""
+    filename = config.HDF_FILE if filename is None else filename
+    tmp_filename = filename + ".repack"
+    _finish_interrupted_swaps(filename)
+    size = os.path.getsize(filename)
+    with h5py.File(filename, "r") as src, h5py.File(tmp_filename, "w", libver="latest") as dst:
+        for run_name in storage.run_names(src):
+            if src[run_name].attrs.get("compacted", False):
+                src.copy(run_name, dst)
+            else:
+                copy_run(src[run_name], dst, run_name, **kwargs)
+            if not same_run(src[run_name], dst[run_name]):
+                dst.close()
+                os.remove(tmp_filename)
+                raise RuntimeError(f"{run_name}: repacked copy differs from the original, {filename} left as it is")
+            if not summary.has_summary(dst[run_name]):
+                summary.build(dst[run_name])
+    # readers that still have the old file open keep reading it
+    os.replace(tmp_filename, filename)
+    logging.info(f"{filename}: repacked from {size / 1e6:.1f} MB to {os.path.getsize(filename) / 1e6:.1f} MB")
+
+
+def _storage_size(grp):
+    return sum(dset.id.get_storage_size() for dset in grp.values())
+
+
+def _compact_in_background(filename, run_names, stop, retries=30, retry_delay=10.0):
+    # only use the CPU when nothing else needs it
+    os.nice(19)
+    for _ in range(retries):
+        try:
+            compact_file(filename, run_names, stop=stop)
+            # the logger is stopped, runs it did not finish are described again
+            catalog.backfill(filename, recording=True)
+            return
+        except BlockingIOError:
+            # hdf5 locks the file while someone reads it, e.g. the web interface
+            if stop.wait(retry_delay):
+                return
+        except Exception:
+            logging.exception(f"Compaction of {filename} failed")
+            return
+    logging.warning(f"Compaction of {filename} gave up, the file stayed in use")
+
+
+class Compactor:
+    def __init__(self, filename=None, run_names=None):
+        """Compacts runs of the hdf file (all pending runs if `run_names` is None) in a
+        process with the lowest priority. `stop` gives up the run that is being compressed
+        and waits, so the file is free again for the next recording."""
+        self.filename = config.HDF_FILE if filename is None else filename
+        # a fresh process: a forked one would inherit the hdf files the parent has open,
+        # e.g. in a thread of the web interface, and hdf5 refuses to open them again
+        ctx = mp.get_context("spawn")
+        # the process only waits on it with a timeout. The process is not a
+        # daemon, it must not be killed in the middle of a write when the logger exits
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(target=_compact_in_background,
+                                   args=(self.filename, run_names, self.stop_event), name="compaction")
+
+    def start(self):
+        self.process.start()
+        logging.info(f"Compaction of {self.filename} started in process {self.process.pid}")
+        return self
+
+    def running(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.stop_event.set()
+            self.process.join()
+
+
+# the background compaction of this process, any logger stops it before it records
+_compactor = None
+
+
+def start_compaction(filename=None, run_names=None):
+    """Compact the runs `run_names` in the background, after the compaction that is still
+    running was stopped."""
+    global _compactor
+    stop_compaction()
+    _compactor = Compactor(filename, run_names).start()
+    return _compactor
+
+
+def stop_compaction():
+    """Stop the background compaction, e.g. before a recording opens the hdf file."""
+    global _compactor
+    if _compactor is not None:
+        _compactor.stop()
+        _compactor = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Compact the finished runs of the hdf file.")
+    parser.add_argument("-f", "--file", default=config.HDF_FILE, help="hdf file")
+    parser.add_argument("-r", "--run", action="append", help="run to compact, all pending runs if not given")
+    parser.add_argument("--repack", action="store_true",
+                        help="rewrite the whole file to reclaim the space of replaced runs")
+    parser.add_argument("--level", type=int, default=config.HDF_COMPACT_LEVEL, help="gzip level")
+    args = parser.parse_args()
+    if args.repack:
+        repack(args.file, level=args.level)
+    else:
+        compact_file(args.file, run_names=args.run, level=args.level)
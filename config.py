@@ -2,15 +2,30 @@
 # --------------------
 VERBOSE_OUTPUT = True
 STIMULUS_ACTIVE = False
+STIMULUS_OUTPUT = 'pyaudio' # 'pyaudio', 'null' (no sound) or the name of a .wav file
+STIMULUS_BLOCK_FRAMES = 512 # frames the sound card asks for at once, ~11 ms at 48 kHz
+STIMULUS_FADE = 0.02 # fade in and out in seconds when the stimulus starts and stops
 
 # I2C addresses of connected devices.
 # Determine the addresses using sudo i2cdetect -y 1
 I2C_OLED_ADDR = 0x3C
 I2C_ACCEL_ADDR = 0x1D
 ACCELEROMETER_ACTIVITY_THRESHOLD = 12.5
+# Read only the 8 MSBs of each axis: half the bus time per sample. The values are scaled
+# to 12 bit counts, so the threshold above stays valid, but diffs come in steps of 16/3
+ACCELEROMETER_FAST_READ = False
+
+# Event driven acquisition: in quiet periods, sleep until the accelerometer's
+# transient detection reports a movement instead of polling the xyz data
+EVENT_DRIVEN = False
+ACCELEROMETER_TRANSIENT_THRESHOLD = 1 # in units of 0.063g (~65 counts at 2g)
+ACCELEROMETER_TRANSIENT_COUNT = 1 # samples above the threshold before an event
+ACCELEROMETER_INT_PIN = None # BCM pin connected to INT1, None: poll INT_SOURCE via I2C
 
 # oled display
 OLED_DISPLAY = True
+OLED_FPS = 10 # frames per second at most, drawing in between is coalesced
+OLED_HEADLESS = False # draw into memory instead of the display, e.g. without the hardware
 
 # Logging parameters
 LOGGING = True # log activity at all
@@ -18,14 +33,47 @@ LOGGING = True # log activity at all
 LOG_TO_REDIS = False
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
+REDIS_STREAM = 'accel'
+REDIS_ENCODING = 'fields' # 'fields': one entry per sample, 'packed': one binary entry per chunk
+REDIS_STREAM_MAXLEN = 100000 # entries kept in the stream (approximately)
+REDIS_STREAM_RETENTION = None # seconds kept in the stream, replaces REDIS_STREAM_MAXLEN if set
 
 LOG_TO_HDF = True
 HDF_FILE = 'log.h5'
+# rows per hdf chunk, a few logger chunks so that appends touch few hdf chunks
+HDF_CHUNK_ROWS = 4096
+# cheap compression while recording, the runs are compacted later
+HDF_COMPRESSION = 'lzf' # 'lzf', 'gzip' or None
+# compact the new run in a background process when the recording stops (see compaction.py)
+HDF_COMPACT_AFTER_STOP = True
+HDF_COMPACT_CHUNK_ROWS = 65536 # rows per hdf chunk of compacted runs, large for reading
+HDF_COMPACT_COMPRESSION = 'gzip'
+HDF_COMPACT_LEVEL = 9
+# runs shorter than this are not shown by the web interface (see catalog.py)
+CATALOG_MIN_HOURS = 1.0
+CATALOG_UPDATE_INTERVAL = 60.0 # seconds between updates of the recorded run in the catalog
+# sample in a separate process with a higher priority, so that the sinks, the display, the
+# stimulus and the web interface do not cause jitter (Linux only)
+ACQUISITION_PROCESS = False
+ACQUISITION_PRIORITY = 20 # SCHED_FIFO priority (1-99) of the acquisition process, needs root
+ACQUISITION_NICE = -10 # used if real-time scheduling is not allowed, 0: keep
+# chunks in the ring buffer of the logger, the logger waits when all are still in use by the sinks
+RING_SLOTS = 32
+# what the worker of a sink does when its queue is full: 'block' the logger,
+# 'drop_oldest' chunk or 'coalesce' to the newest chunk
+SINK_POLICIES = {'display': 'coalesce', 'redis': 'drop_oldest', 'hdf': 'block'}
+# chunks that can wait for each worker, less than half of RING_SLOTS
+SINK_QUEUE_SIZES = {'display': 1, 'redis': 8, 'hdf': 8}
+
+# seconds between two updates of the live state for the web interface (see live.py)
+LIVE_PUSH_INTERVAL = 0.25
 
 # SLEEP DETECTION ALGO PARAMETERS
 # --------------------
 LOGGER_MIN_DELAY = 2.0
 LOGGER_MAX_DELAY = 200.0
+EVENT_POLL_DELAY = 1000.0 # ms between INT_SOURCE polls without interrupt pin
+EVENT_IDLE_DELAY = 10000.0 # ms between samples while waiting for movement
 
 # Adaptive delay parameters
 DELAY_DIVIDE_BY = 10 
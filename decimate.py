@@ -0,0 +1,120 @@
+"""
+Decimation of time series for the display, the web interface and the plots.
+
+Taking every n-th sample drops the short movement spikes, which are the interesting part
+of a night. The functions here keep them:
+
+- `envelope`: minimum and maximum of equal bins of samples, e.g. one bin per pixel column
+- `minmax_indices`: the rows of the minima and maxima, to select rows of several columns
+- `lttb`: Largest-Triangle-Three-Buckets, a given number of points that keep the shape
+- `StreamingEnvelope`: the envelope over time bins, fed block by block
+
+The input arrays are only read, never modified, and are not copied if they are already
+numpy arrays (a non-contiguous view may be copied by `reshape`).
+"""
+import numpy as np
+
+
+def _split(y, n_bins):
+    """Samples per bin, the bins of equal length as a (bins, samples) view and the
+    shorter last bin."""
+    k = -(-len(y) // n_bins)
+    full = len(y) // k
+    return k, y[:full * k].reshape(full, k), y[full * k:]
+
+
+def envelope(y, n_bins):
+    """Minimum and maximum of `y` in at most `n_bins` bins of consecutive samples.
+    With fewer samples than bins, both are the samples."""
+    y = np.asarray(y)
+    if not len(y):
+        return y[:0].copy(), y[:0].copy()
+    _, blocks, tail = _split(y, n_bins)
+    lo, hi = blocks.min(axis=1), blocks.max(axis=1)
+    if len(tail):
+        lo, hi = np.append(lo, tail.min()), np.append(hi, tail.max())
+    return lo, hi
+
+
+def minmax_indices(y, n_bins):
+    """Sorted indices of the minimum and the maximum of `y` in at most `n_bins` bins,
+    all indices if there are no more than two samples per bin."""
+    y = np.asarray(y)
+    n = len(y)
+    if n <= 2 * n_bins:
+        return np.arange(n)
+    k, blocks, tail = _split(y, n_bins)
+    offsets = np.arange(len(blocks)) * k
+    indices = [offsets + blocks.argmin(axis=1), offsets + blocks.argmax(axis=1)]
+    if len(tail):
+        indices.append([len(blocks) * k + tail.argmin(), len(blocks) * k + tail.argmax()])
+    return np.unique(np.concatenate(indices))
+
+
+def lttb(x, y, n_out):
+    """Indices of `n_out` points of (`x`, `y`) chosen with Largest-Triangle-Three-Buckets:
+    the first and last point and, from each bucket in between, the point that spans the
+    largest triangle with the point chosen before and the mean of the next bucket.
+
+    Only the loop over the buckets is in Python, the points of a bucket are compared at once.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    next_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1])[1:] / counts[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[:n - 1], edges[:-1])[1:] / counts[1:], y[-1])
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # twice the area of the triangles
+        area = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def time_envelope(t, y, t_start, t_end, n_bins):
+    """Minimum and maximum of `y` in `n_bins` equal time bins from `t_start` to `t_end`.
+
+    :return: time of the middle of each bin that has samples, minima, maxima
+    """
+    stream = StreamingEnvelope(t_start, t_end, n_bins)
+    stream.push(t, y)
+    return stream.result()
+
+
+class StreamingEnvelope:
+    def __init__(self, t_start, t_end, n_bins):
+        """
+        Minimum and maximum of a time series in `n_bins` equal time bins from `t_start` to
+        `t_end`, fed block by block with `push`, e.g. while a long run is read in pieces.
+        Only the bins are kept, not the samples. Samples outside go to the first or last bin.
+        """
+        self.t_start = t_start
+        self.n_bins = n_bins
+        self.width = (t_end - t_start) / n_bins if t_end > t_start else 1.0
+        self.lo = np.full(n_bins, np.inf)
+        self.hi = np.full(n_bins, -np.inf)
+
+    def push(self, t, y):
+        """Add samples, `t` sorted ascending."""
+        t, y = np.asarray(t), np.asarray(y)
+        if not len(t):
+            return
+        bins = np.clip(((t - self.t_start) / self.width).astype(np.int64), 0, self.n_bins - 1)
+        # first sample of every bin of the block
+        starts = np.flatnonzero(np.diff(bins, prepend=-1))
+        b = bins[starts]
+        self.lo[b] = np.minimum(self.lo[b], np.minimum.reduceat(y, starts))
+        self.hi[b] = np.maximum(self.hi[b], np.maximum.reduceat(y, starts))
+
+    def result(self):
+        """Time of the middle of each bin that has samples, minima, maxima."""
+        filled = np.flatnonzero(self.hi >= self.lo)
+        return self.t_start + (filled + 0.5) * self.width, self.lo[filled], self.hi[filled]
@@ -1,10 +1,7 @@
-import smbus
 import time
 
 import config
 
-# Get I2C bus
-bus = smbus.SMBus(1)
 # I2C address of the device
 MMA8452Q_DEFAULT_ADDRESS = config.I2C_ACCEL_ADDR
 # MMA8452Q Register Map
@@ -19,17 +16,32 @@ MMA8452Q_REG_SYSMOD = 0x0B # System mode Register
 MMA8452Q_REG_INT_SOURCE = 0x0C # System Interrupt Status Register
 MMA8452Q_REG_WHO_AM_I = 0x0D # Device ID Register
 MMA8452Q_REG_XYZ_DATA_CFG = 0x0E # Data Configuration Register
+MMA8452Q_REG_TRANSIENT_CFG = 0x1D # Transient Configuration Register
+MMA8452Q_REG_TRANSIENT_SRC = 0x1E # Transient Source Register
+MMA8452Q_REG_TRANSIENT_THS = 0x1F # Transient Threshold Register
+MMA8452Q_REG_TRANSIENT_COUNT = 0x20 # Transient Debounce Counter Register
+MMA8452Q_REG_ASLP_COUNT = 0x29 # Auto-Sleep Inactivity Timer Register
 MMA8452Q_REG_CTRL_REG1 = 0x2A # Control Register 1
 MMA8452Q_REG_CTRL_REG2 = 0x2B # Control Register 2
 MMA8452Q_REG_CTRL_REG3 = 0x2C # Control Register 3
 MMA8452Q_REG_CTRL_REG4 = 0x2D # Control Register 4
 MMA8452Q_REG_CTRL_REG5 = 0x2E # Control Register 5
+# MMA8452Q Data Status Register
+MMA8452Q_STATUS_ZYXDR = 0x08 # New X, Y and Z data ready
+MMA8452Q_STATUS_ZYXOW = 0x80 # X, Y and Z data overwritten before it was read
 # MMA8452Q Data Configuration Register
 MMA8452Q_DATA_CFG_HPF_OUT = 0x10 # Output Data High-Pass Filtered
 MMA8452Q_DATA_CFG_FS_2 = 0x00 # Full-Scale Range = 2g
 MMA8452Q_DATA_CFG_FS_4 = 0x01 # Full-Scale Range = 4g
 MMA8452Q_DATA_CFG_FS_8 = 0x02 # Full-Scale Range = 8g
-# MMA8452Q Control Register 1
+# MMA8452Q Transient Configuration Register
+MMA8452Q_TRANSIENT_CFG_ELE = 0x10 # Latch transient events until TRANSIENT_SRC is read
+MMA8452Q_TRANSIENT_CFG_ZTEFE = 0x08 # Z transient event flag enable
+MMA8452Q_TRANSIENT_CFG_YTEFE = 0x04 # Y transient event flag enable
+MMA8452Q_TRANSIENT_CFG_XTEFE = 0x02 # X transient event flag enable
+MMA8452Q_TRANSIENT_SRC_EA = 0x40 # Transient event active
+MMA8452Q_TRANSIENT_THS_G = 0.063 # Transient threshold resolution in g per LSB
+MMA8452Q_ASLP_COUNT_MS = 320 # Auto-sleep inactivity timer resolution in ms per LSB (ODR 800Hz)
 MMA8452Q_ASLP_RATE_50 = 0x00 # Sleep mode rate = 50Hz
 MMA8452Q_ASLP_RATE_12_5 = 0x40 # Sleep mode rate = 12.5Hz
 MMA8452Q_ASLP_RATE_6_25 = 0x80 # Sleep mode rate = 6.25Hz
@@ -47,31 +59,61 @@ MMA8452Q_MODE_REDUCED_NOISE = 0x04 # Reduced Noise Mode
 MMA8452Q_MODE_FAST_READ = 0x02 # Fast Read Mode
 MMA8452Q_MODE_ACTIVE = 0x01 # Active Mode
 MMA8452Q_MODE_STANDBY = 0x00 # Standby Mode
+MMA8452Q_FAST_READ_SCALE = 16 # 8 bit fast read values are scaled to 12 bit counts
+# MMA8452Q Control Register 2
+MMA8452Q_CTRL_REG2_SLPE = 0x04 # Auto-sleep enable
+MMA8452Q_CTRL_REG2_SMODS_LP = 0x18 # Low power oversampling in sleep mode
+# MMA8452Q Control Register 3
+MMA8452Q_CTRL_REG3_WAKE_TRANS = 0x40 # Transient function wakes the device from sleep
+# MMA8452Q Control Register 4 (interrupt enable) and 5 (routing, 1 = INT1, 0 = INT2)
+MMA8452Q_INT_EN_ASLP = 0x80 # Auto-sleep/wake interrupt
+MMA8452Q_INT_EN_TRANS = 0x20 # Transient interrupt
+MMA8452Q_INT_EN_DRDY = 0x01 # Data ready interrupt
+MMA8452Q_INT_CFG_TRANS = 0x20 # Route the transient interrupt to INT1
+# MMA8452Q Interrupt Source Register
+MMA8452Q_SRC_ASLP = 0x80 # Auto-sleep/wake interrupt occurred
+MMA8452Q_SRC_TRANS = 0x20 # Transient interrupt occurred
+MMA8452Q_SRC_DRDY = 0x01 # Data ready interrupt occurred
 class MMA8452Q():
-    def __init__(self):
+    def __init__(self, bus=None, fast_read=False):
+        """Accelerometer on the I2C bus `bus`. Any object with the smbus methods
+        `write_byte_data`, `read_byte_data` and `read_i2c_block_data` can be used,
+        e.g. `drivers.MMA_sim.SimulatedMMA8452Q`. Defaults to I2C bus 1 of the Pi.
+        With `fast_read`, the chip only outputs the 8 MSBs of each axis (see `read_accl_fast`)."""
+        if bus is None:
+            import smbus
+            bus = smbus.SMBus(1)
+        self.bus = bus
+        self.fast_read = fast_read
+        self.sample_period = 1 / 800.0 # seconds between new samples at the output data rate
+        self.ctrl_reg1 = None # set by transient_configuration
+        self.auto_sleep_enabled = False
         self.mode_configuration()
         self.data_configuration()
     def write(self, REGISTER, SETTING):
         #print("Writing: {:08b}".format(SETTING))
-        bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, REGISTER, SETTING)
+        self.bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, REGISTER, SETTING)
     def mode_configuration(self, MODE=None):
         """Select the Control Register-1 configuration of the accelerometer from the given provided values"""
         if MODE == None:
             #MODE_CONFIG = (MMA8452Q_ODR_800 | MMA8452Q_MODE_REDUCED_NOISE | MMA8452Q_MODE_NORMAL | MMA8452Q_MODE_ACTIVE)
             MODE_CONFIG = (MMA8452Q_ODR_800 | MMA8452Q_MODE_NORMAL | MMA8452Q_MODE_ACTIVE)
+            if self.fast_read:
+                MODE_CONFIG |= MMA8452Q_MODE_FAST_READ
         else:
             MODE_CONFIG = (MODE)
         #print("Writing: {:08b}".format(MODE_CONFIG))
-        bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_CTRL_REG1, MODE_CONFIG)
+        self.bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_CTRL_REG1, MODE_CONFIG)
     def data_configuration(self):
         """Select the Data Configuration Register configuration of the accelerometer from the given provided values"""
         DATA_CONFIG = (MMA8452Q_DATA_CFG_FS_2)
         #print("Data: {:08b}".format(DATA_CONFIG))
-        bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_XYZ_DATA_CFG, DATA_CONFIG)
-    def read_accl(self):
+        self.bus.write_byte_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_XYZ_DATA_CFG, DATA_CONFIG)
+    def read_accl(self, out=None):
         """Read data back from MMA8452Q_REG_STATUS(0x00), 7 bytes
-        Status register, X-Axis MSB, X-Axis LSB, Y-Axis MSB, Y-Axis LSB, Z-Axis MSB, Z-Axis LSB"""
-        data = bus.read_i2c_block_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_STATUS, 7)
+        Status register, X-Axis MSB, X-Axis LSB, Y-Axis MSB, Y-Axis LSB, Z-Axis MSB, Z-Axis LSB
+        Returns a dict, or writes x, y, z into `out` and returns it."""
+        data = self.bus.read_i2c_block_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_STATUS, 7)
         # Convert the data
         xAccl = (data[1] * 256 + data[2]) / 16
         if xAccl > 2047 :
@@ -82,4 +124,86 @@ class MMA8452Q():
         zAccl = (data[5] * 256 + data[6]) / 16
         if zAccl > 2047 :
             zAccl -= 4096
+        if out is not None:
+            out[0] = xAccl
+            out[1] = yAccl
+            out[2] = zAccl
+            return out
         return {'x' : xAccl, 'y' : yAccl, 'z' : zAccl}
+    def read_accl_fast(self, out=None):
+        """Read data back from MMA8452Q_REG_STATUS(0x00) in fast read mode, 4 bytes
+        Status register, X-Axis MSB, Y-Axis MSB, Z-Axis MSB
+
+        The 8 bit values are scaled to 12 bit counts, so they can be compared with `read_accl`
+        and `config.ACCELEROMETER_ACTIVITY_THRESHOLD` keeps its meaning (the resolution
+        drops to 16 counts). Without `out`, returns a tuple (x, y, z) or None if the chip has
+        no new sample since the last read. With `out`, the values are written into it and
+        the return value tells whether they are new (ZYXDR)."""
+        data = self.bus.read_i2c_block_data(MMA8452Q_DEFAULT_ADDRESS, MMA8452Q_REG_STATUS, 4)
+        ready = data[0] & MMA8452Q_STATUS_ZYXDR
+        # Convert the data, two's complement
+        x, y, z = data[1], data[2], data[3]
+        if x > 127 :
+            x -= 256
+        if y > 127 :
+            y -= 256
+        if z > 127 :
+            z -= 256
+        if out is None:
+            if not ready:
+                return None
+            return (x * MMA8452Q_FAST_READ_SCALE, y * MMA8452Q_FAST_READ_SCALE, z * MMA8452Q_FAST_READ_SCALE)
+        out[0] = x * MMA8452Q_FAST_READ_SCALE
+        out[1] = y * MMA8452Q_FAST_READ_SCALE
+        out[2] = z * MMA8452Q_FAST_READ_SCALE
+        return bool(ready)
+    def read(self, REGISTER):
+        return self.bus.read_byte_data(MMA8452Q_DEFAULT_ADDRESS, REGISTER)
+    def transient_configuration(self, threshold=1, count=1, aslp_count=10, aslp_rate=MMA8452Q_ASLP_RATE_6_25):
+        """Enable the transient (high-pass filtered motion) detection on all axes with a latched
+        interrupt on INT1. With `auto_sleep`, the chip falls asleep at `aslp_rate` when nothing
+        moves and a transient wakes it up again.
+
+        :param threshold: transient threshold in units of 0.063g
+        :param count: number of samples above the threshold before an event is flagged
+        :param aslp_count: inactivity time before auto-sleep in units of 320ms
+        """
+        # control registers can only be written in standby mode
+        ctrl_reg1 = MMA8452Q_ODR_800 | MMA8452Q_MODE_NORMAL | aslp_rate
+        if self.fast_read:
+            # read_accl_fast relies on the address pointer skipping the LSB registers
+            ctrl_reg1 |= MMA8452Q_MODE_FAST_READ
+        self.write(MMA8452Q_REG_CTRL_REG1, ctrl_reg1 | MMA8452Q_MODE_STANDBY)
+        self.write(MMA8452Q_REG_TRANSIENT_CFG, MMA8452Q_TRANSIENT_CFG_ELE | MMA8452Q_TRANSIENT_CFG_ZTEFE | \
+                   MMA8452Q_TRANSIENT_CFG_YTEFE | MMA8452Q_TRANSIENT_CFG_XTEFE)
+        self.write(MMA8452Q_REG_TRANSIENT_THS, threshold & 0x7F)
+        self.write(MMA8452Q_REG_TRANSIENT_COUNT, count)
+        self.write(MMA8452Q_REG_ASLP_COUNT, aslp_count)
+        # auto-sleep stays off until the logger stops polling, see auto_sleep
+        self.write(MMA8452Q_REG_CTRL_REG2, MMA8452Q_CTRL_REG2_SMODS_LP)
+        self.auto_sleep_enabled = False
+        self.write(MMA8452Q_REG_CTRL_REG3, MMA8452Q_CTRL_REG3_WAKE_TRANS)
+        self.write(MMA8452Q_REG_CTRL_REG4, MMA8452Q_INT_EN_TRANS)
+        self.write(MMA8452Q_REG_CTRL_REG5, MMA8452Q_INT_CFG_TRANS)
+        self.write(MMA8452Q_REG_CTRL_REG1, ctrl_reg1 | MMA8452Q_MODE_ACTIVE)
+        self.ctrl_reg1 = ctrl_reg1
+        # clear events from before
+        self.read(MMA8452Q_REG_TRANSIENT_SRC)
+    def auto_sleep(self, enable):
+        """Switch the auto-sleep of `transient_configuration` on or off. Only on while the
+        samples are not read: asleep, the chip samples at the slow sleep rate and only a
+        transient wakes it, so a polled sample could be old or miss smaller movements."""
+        if enable == self.auto_sleep_enabled or self.ctrl_reg1 is None:
+            return
+        # CTRL_REG2 can only be written in standby mode
+        self.write(MMA8452Q_REG_CTRL_REG1, self.ctrl_reg1 | MMA8452Q_MODE_STANDBY)
+        self.write(MMA8452Q_REG_CTRL_REG2, MMA8452Q_CTRL_REG2_SMODS_LP | (MMA8452Q_CTRL_REG2_SLPE if enable else 0))
+        self.write(MMA8452Q_REG_CTRL_REG1, self.ctrl_reg1 | MMA8452Q_MODE_ACTIVE)
+        self.auto_sleep_enabled = enable
+    def transient_detected(self):
+        """Check the interrupt source for a transient event and clear it. One byte read if nothing happened."""
+        if self.read(MMA8452Q_REG_INT_SOURCE) & MMA8452Q_SRC_TRANS:
+            # reading the transient source clears the latched event and the interrupt
+            self.read(MMA8452Q_REG_TRANSIENT_SRC)
+            return True
+        return False
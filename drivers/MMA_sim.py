@@ -0,0 +1,235 @@
+import numpy as np
+import h5py
+
+import storage
+import drivers.MMA as MMA
+
+MMA8452Q_WHO_AM_I_VALUE = 0x2A
+# Output data rates in Hz selected by the DR bits of CTRL_REG1
+MMA8452Q_ODR_HZ = {MMA.MMA8452Q_ODR_800: 800.0, MMA.MMA8452Q_ODR_400: 400.0, MMA.MMA8452Q_ODR_200: 200.0,
+                   MMA.MMA8452Q_ODR_100: 100.0, MMA.MMA8452Q_ODR_50: 50.0, MMA.MMA8452Q_ODR_12_5: 12.5,
+                   MMA.MMA8452Q_ODR_6_25: 6.25, MMA.MMA8452Q_ODR_1_56: 1.56}
+# Output data rates in Hz while asleep, selected by the ASLP_RATE bits of CTRL_REG1
+MMA8452Q_ASLP_RATE_HZ = {MMA.MMA8452Q_ASLP_RATE_50: 50.0, MMA.MMA8452Q_ASLP_RATE_12_5: 12.5,
+                         MMA.MMA8452Q_ASLP_RATE_6_25: 6.25, MMA.MMA8452Q_ASLP_RATE_1_56: 1.56}
+# SYSMOD register values
+MMA8452Q_SYSMOD_STANDBY = 0x00
+MMA8452Q_SYSMOD_WAKE = 0x01
+MMA8452Q_SYSMOD_SLEEP = 0x02
+
+
+class RecordedMovement:
+    def __init__(self, run_name, filename="log.h5"):
+        """Raw x, y, z values of a recorded run, replayed with their original timing."""
+        with h5py.File(filename, mode='r', libver='latest', swmr=True) as h5f:
+            self.ts = storage.read_column(h5f[run_name], 'ts_realtime') / 1000.0
+            self.xyz = np.stack([h5f[run_name][k][()] for k in ['x', 'y', 'z']], axis=1)
+        self.xyz = np.round(self.xyz).astype(int)
+        self.start = self.ts[0]
+        self.end = self.ts[-1]
+
+    def sample(self, t):
+        """Last recorded value at time `t` (sample and hold)."""
+        i = np.searchsorted(self.ts, t, side='right') - 1
+        i = min(max(i, 0), len(self.ts) - 1)
+        return self.xyz[i]
+
+    def movement(self, t0, t1, threshold):
+        """Did any axis change by more than `threshold` counts between `t0` and `t1`?"""
+        i0, i1 = np.searchsorted(self.ts, [t0, t1], side='right') - 1
+        i0 = max(i0, 0)
+        if i1 <= i0:
+            return False
+        return np.abs(np.diff(self.xyz[i0:i1 + 1], axis=0)).max() > threshold
+
+
+class SyntheticMovement:
+    def __init__(self, start, duration=8 * 3600.0, noise=4.0, event_rate=1 / 300.0,
+                 event_duration=(0.5, 10.0), amplitude=150.0, seed=0):
+        """
+        Synthetic night: sensor noise on top of gravity and randomly placed movements.
+
+        :param start: start time in seconds since the epoch
+        :param duration: length of the night in seconds
+        :param noise: standard deviation of the sensor noise in counts
+        :param event_rate: average number of movements per second
+        :param event_duration: range of movement durations in seconds
+        :param amplitude: standard deviation of the movement in counts
+        """
+        self.rng = np.random.default_rng(seed)
+        self.start = start
+        self.end = start + duration
+        self.noise = noise
+        self.amplitude = amplitude
+        n_events = self.rng.poisson(duration * event_rate)
+        self.event_starts = np.sort(self.rng.uniform(start, self.end, n_events))
+        self.event_ends = self.event_starts + self.rng.uniform(*event_duration, n_events)
+        # 1g on the z axis at the 2g range
+        self.gravity = np.array([0.0, 0.0, 1024.0])
+
+    def sample(self, t):
+        xyz = self.gravity + self.rng.normal(0, self.noise, 3)
+        i = np.searchsorted(self.event_starts, t, side='right') - 1
+        if i >= 0 and t < self.event_ends[i]:
+            xyz += self.rng.normal(0, self.amplitude, 3)
+        return np.clip(np.round(xyz), -2048, 2047).astype(int)
+
+    def movement(self, t0, t1, threshold):
+        """Was there a movement larger than `threshold` counts between `t0` and `t1`?"""
+        if self.amplitude < threshold:
+            return False
+        i = np.searchsorted(self.event_starts, t1, side='right') - 1
+        # the last movement that started before t1 lasted until after t0
+        return i >= 0 and self.event_ends[i] > t0
+
+
+class SimulatedMMA8452Q:
+    def __init__(self, source, clock, latency=0.0, on_exhausted=None):
+        """
+        Simulated I2C bus with a MMA8452Q accelerometer, a drop-in replacement for
+        `smbus.SMBus` in `drivers.MMA.MMA8452Q`. Acceleration values are taken from `source`
+        (`RecordedMovement` or `SyntheticMovement`) at the time of `clock` and encoded
+        into the output registers like the chip does.
+
+        The transient detection and the auto-sleep are simulated as well: with SLPE in
+        CTRL_REG2, the chip falls asleep after ASLP_COUNT x 320 ms without a transient and
+        then only samples at the sleep rate until a transient wakes it up.
+
+        :param latency: duration of a bus transaction in seconds, advances the clock
+        :param on_exhausted: called once when the clock passes the end of the source
+        """
+        self.source = source
+        self.clock = clock
+        self.latency = latency
+        self.on_exhausted = on_exhausted
+        self.exhausted = False
+
+        self.registers = bytearray(0x32)
+        self.registers[MMA.MMA8452Q_REG_WHO_AM_I] = MMA8452Q_WHO_AM_I_VALUE
+        self.last_index = None
+        self.last_transient_check = None
+        self.asleep = False
+        self.inactive_since = None # start of the auto-sleep inactivity timer
+        self.n_transactions = 0
+
+    def write_byte_data(self, addr, register, value):
+        t = self._transaction()
+        self.registers[register] = value & 0xFF
+        if register in (MMA.MMA8452Q_REG_CTRL_REG1, MMA.MMA8452Q_REG_CTRL_REG2):
+            # a new configuration starts awake
+            self.asleep = False
+            self.inactive_since = t
+            self._update_sysmod()
+
+    def read_byte_data(self, addr, register):
+        return self.read_i2c_block_data(addr, register, 1)[0]
+
+    def read_i2c_block_data(self, addr, register, length):
+        t = self._transaction()
+        self._update_sleep(t, self._update_transient(t))
+        if register == MMA.MMA8452Q_REG_STATUS:
+            self._update_output(t)
+        if register == MMA.MMA8452Q_REG_STATUS and self.registers[MMA.MMA8452Q_REG_CTRL_REG1] & MMA.MMA8452Q_MODE_FAST_READ:
+            # fast read mode: the address pointer skips the LSB registers and wraps after Z
+            fast_read = (MMA.MMA8452Q_REG_STATUS, MMA.MMA8452Q_REG_OUT_X_MSB,
+                         MMA.MMA8452Q_REG_OUT_Y_MSB, MMA.MMA8452Q_REG_OUT_Z_MSB)
+            data = [self.registers[fast_read[i % 4]] for i in range(length)]
+        else:
+            data = list(self.registers[register:register + length])
+        if register == MMA.MMA8452Q_REG_STATUS:
+            # reading the data clears the status flags
+            self.registers[MMA.MMA8452Q_REG_STATUS] = 0
+        if register <= MMA.MMA8452Q_REG_TRANSIENT_SRC < register + length:
+            # reading the transient source clears the latched event and its interrupt
+            self.registers[MMA.MMA8452Q_REG_TRANSIENT_SRC] = 0
+            self.registers[MMA.MMA8452Q_REG_INT_SOURCE] &= ~MMA.MMA8452Q_SRC_TRANS & 0xFF
+        return data
+
+    def _transaction(self):
+        self.n_transactions += 1
+        if self.latency:
+            self.clock.sleep(self.latency)
+        t = self.clock.time()
+        if not self.exhausted and t > self.source.end:
+            self.exhausted = True
+            if self.on_exhausted is not None:
+                self.on_exhausted()
+        return t
+
+    def _update_transient(self, t):
+        """Flag a transient event if the source moved more than TRANSIENT_THS since the last
+        transaction. Returns True if it did."""
+        last_check, self.last_transient_check = self.last_transient_check, t
+        if last_check is None or not self.registers[MMA.MMA8452Q_REG_CTRL_REG1] & MMA.MMA8452Q_MODE_ACTIVE:
+            return False
+        cfg = self.registers[MMA.MMA8452Q_REG_TRANSIENT_CFG]
+        axes = cfg & (MMA.MMA8452Q_TRANSIENT_CFG_XTEFE | MMA.MMA8452Q_TRANSIENT_CFG_YTEFE | \
+                      MMA.MMA8452Q_TRANSIENT_CFG_ZTEFE)
+        if not axes:
+            return False
+        # threshold register in units of 0.063g, 1024 counts per g at the 2g range
+        threshold = (self.registers[MMA.MMA8452Q_REG_TRANSIENT_THS] & 0x7F) * MMA.MMA8452Q_TRANSIENT_THS_G * 1024
+        if self.source.movement(last_check, t, threshold):
+            # flag all enabled axes (XTRANSE, YTRANSE, ZTRANSE), the polarity bits are not simulated
+            src = MMA.MMA8452Q_TRANSIENT_SRC_EA
+            for enable, flag in ((MMA.MMA8452Q_TRANSIENT_CFG_XTEFE, 0x02), (MMA.MMA8452Q_TRANSIENT_CFG_YTEFE, 0x08),
+                                 (MMA.MMA8452Q_TRANSIENT_CFG_ZTEFE, 0x20)):
+                if axes & enable:
+                    src |= flag
+            self.registers[MMA.MMA8452Q_REG_TRANSIENT_SRC] = src
+            if self.registers[MMA.MMA8452Q_REG_CTRL_REG4] & MMA.MMA8452Q_INT_EN_TRANS:
+                self.registers[MMA.MMA8452Q_REG_INT_SOURCE] |= MMA.MMA8452Q_SRC_TRANS
+            return True
+        if not cfg & MMA.MMA8452Q_TRANSIENT_CFG_ELE:
+            # without the latch the flags follow the current motion
+            self.registers[MMA.MMA8452Q_REG_TRANSIENT_SRC] = 0
+            self.registers[MMA.MMA8452Q_REG_INT_SOURCE] &= ~MMA.MMA8452Q_SRC_TRANS & 0xFF
+        return False
+
+    def _update_sleep(self, t, moved):
+        """Fall asleep after ASLP_COUNT x 320 ms without a transient, wake up on one."""
+        if not (self.registers[MMA.MMA8452Q_REG_CTRL_REG1] & MMA.MMA8452Q_MODE_ACTIVE
+                and self.registers[MMA.MMA8452Q_REG_CTRL_REG2] & MMA.MMA8452Q_CTRL_REG2_SLPE):
+            self.asleep = False
+        elif moved:
+            # an event of an interrupt function restarts the inactivity timer, it only
+            # wakes the chip if the function is a wake-up source
+            if not self.asleep or self.registers[MMA.MMA8452Q_REG_CTRL_REG3] & MMA.MMA8452Q_CTRL_REG3_WAKE_TRANS:
+                self.asleep = False
+                self.inactive_since = t
+        elif not self.asleep:
+            timeout = self.registers[MMA.MMA8452Q_REG_ASLP_COUNT] * MMA.MMA8452Q_ASLP_COUNT_MS / 1000.0
+            self.asleep = t - self.inactive_since >= timeout
+        self._update_sysmod()
+
+    def _update_sysmod(self):
+        if not self.registers[MMA.MMA8452Q_REG_CTRL_REG1] & MMA.MMA8452Q_MODE_ACTIVE:
+            self.registers[MMA.MMA8452Q_REG_SYSMOD] = MMA8452Q_SYSMOD_STANDBY
+        else:
+            self.registers[MMA.MMA8452Q_REG_SYSMOD] = MMA8452Q_SYSMOD_SLEEP if self.asleep else MMA8452Q_SYSMOD_WAKE
+
+    def _update_output(self, t):
+        """Latch a new sample into the output registers if the output data rate produced one."""
+        ctrl_reg1 = self.registers[MMA.MMA8452Q_REG_CTRL_REG1]
+        if not ctrl_reg1 & MMA.MMA8452Q_MODE_ACTIVE:
+            return
+        if self.asleep:
+            odr = MMA8452Q_ASLP_RATE_HZ[ctrl_reg1 & 0xC0]
+        else:
+            odr = MMA8452Q_ODR_HZ[ctrl_reg1 & 0x38]
+        # a change of the rate always gives a new sample
+        index = (odr, int((t - self.source.start) * odr))
+        if index == self.last_index:
+            return
+        status = MMA.MMA8452Q_STATUS_ZYXDR
+        if self.last_index is not None and index[0] == self.last_index[0] and index[1] > self.last_index[1] + 1:
+            # more than one sample since the last read
+            status |= MMA.MMA8452Q_STATUS_ZYXOW
+        self.last_index = index
+        self.registers[MMA.MMA8452Q_REG_STATUS] |= status
+
+        # 12 bit two's complement values, left justified in MSB and LSB registers
+        for k, value in enumerate(self.source.sample(t)):
+            raw = (int(value) & 0xFFF) << 4
+            self.registers[MMA.MMA8452Q_REG_OUT_X_MSB + 2 * k] = raw >> 8
+            self.registers[MMA.MMA8452Q_REG_OUT_X_LSB + 2 * k] = raw & 0xFF
@@ -1,121 +1,303 @@
-import board
-import digitalio
 from PIL import Image, ImageDraw, ImageFont
-import adafruit_ssd1306
 
+import time
+import logging
 import threading
+import numpy as np
 
 import config
+import decimate
+
+# SSD1306 commands for writing a window of the display
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+FONT_FILE = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
 
-class OLED:
-    def __init__(self):
-        OLED_RESET = digitalio.DigitalInOut(board.D4)
-        self.WIDTH = 128
-        self.HEIGHT = 32 
 
+class SSD1306Device:
+    def __init__(self, width, height):
+        """The SSD1306 on the I2C bus, only the changed bytes are written."""
+        import board
+        import digitalio
+        import adafruit_ssd1306
+        OLED_RESET = digitalio.DigitalInOut(board.D4)
         self.i2c = board.I2C()
-        self.oled = adafruit_ssd1306.SSD1306_I2C(self.WIDTH, self.HEIGHT, \
+        self.oled = adafruit_ssd1306.SSD1306_I2C(width, height, \
                                                  self.i2c, addr=config.I2C_OLED_ADDR, reset=OLED_RESET)
         self.oled.fill(0)
         self.oled.show()
-        self.image = Image.new('1', (self.oled.width, self.oled.height))
-        self.draw = ImageDraw.Draw(self.image)
-        
-        self.font = ImageFont.load_default()
-        self.small_font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 8)
-        self.medium_font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 10)
-        self.large_font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 16)
-        
-        self.draw_text("Sleep Well", clear_display = True, draw_frame = 1, font='large')        
+
+    def write(self, page, column, data):
+        """Write the bytes `data` to `page` from `column` on, one byte per column with
+        the top row in the lowest bit."""
+        for cmd in (SET_COL_ADDR, column, column + len(data) - 1, SET_PAGE_ADDR, page, page):
+            self.oled.write_cmd(cmd)
+        with self.oled.i2c_device as i2c:
+            # 0x40: data follows
+            i2c.write(b'\x40' + data)
+
+
+class MemoryDevice:
+    def __init__(self, width, height):
+        """A display in memory with the page layout of the SSD1306, for tests and for
+        running without the display."""
+        self.width = width
+        self.height = height
+        self.pages = np.zeros((height // 8, width), dtype=np.uint8)
+        self.writes = 0
+        self.bytes_written = 0
+
+    def write(self, page, column, data):
+        self.pages[page, column:column + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.writes += 1
+        self.bytes_written += len(data)
+
+    def pixels(self):
+        """What the display shows, as a (height, width) boolean array."""
+        bits = np.unpackbits(self.pages[:, np.newaxis, :], axis=1, bitorder='little')
+        return bits.reshape(self.height, self.width).astype(bool)
+
+
+class GlyphCache:
+    def __init__(self, font):
+        """Every character of a font is rendered once, text is put together from them."""
+        self.font = font
+        self.height = font.getbbox("Ag")[3]
+        self.glyphs = {}
+
+    def glyph(self, char):
+        if char not in self.glyphs:
+            advance = max(int(round(self.font.getlength(char))), 1)
+            image = Image.new('1', (advance, self.height))
+            ImageDraw.Draw(image).text((0, 0), char, font=self.font, fill=1)
+            self.glyphs[char] = np.array(image, dtype=bool)
+        return self.glyphs[char]
+
+    def render(self, text):
+        """Bitmap of `text` as a boolean array."""
+        if not text:
+            return np.zeros((self.height, 0), dtype=bool)
+        return np.hstack([self.glyph(char) for char in text])
+
+
+def load_font(size):
+    try:
+        return ImageFont.truetype(FONT_FILE, size)
+    except OSError:
+        logging.warning(f"{FONT_FILE} not found, using the default font")
+        return ImageFont.load_default()
+
+
+class OLED:
+    def __init__(self, device=None, fps=None):
+        """
+        The 128x32 OLED display. The drawing methods can be called from any thread, they
+        only queue the drawing. One render thread draws into a framebuffer at most `fps`
+        times per second (OLED_FPS) and sends only the columns of each page that changed
+        since the last frame, so the display keeps the I2C bus, which it shares with the
+        accelerometer, free most of the time. Drawing that starts with clearing the display
+        replaces everything that was not drawn yet (frame coalescing).
+
+        :param device: where the frames go, the SSD1306 by default, a `MemoryDevice` with
+            OLED_HEADLESS
+        """
+        self.WIDTH = 128
+        self.HEIGHT = 32
+        if device is None:
+            device = MemoryDevice(self.WIDTH, self.HEIGHT) if config.OLED_HEADLESS \
+                else SSD1306Device(self.WIDTH, self.HEIGHT)
+        self.device = device
+        self.frame_interval = 1.0 / (config.OLED_FPS if fps is None else fps)
+
+        # only touched by the render thread
+        self.canvas = np.zeros((self.HEIGHT, self.WIDTH), dtype=bool)
+        self.shown = None # bytes of the pages on the display
+
+        self.font = GlyphCache(ImageFont.load_default())
+        self.small_font = GlyphCache(load_font(8))
+        self.medium_font = GlyphCache(load_font(10))
+        self.large_font = GlyphCache(load_font(16))
+
+        self.cond = threading.Condition()
+        self.ops = [] # drawing that is not done yet
+        self.ready = False # the queued drawing is complete and can be shown
+        self.submitted = 0
+        self.presented = 0
+        self.frames = 0
+        self.coalesced = 0
+        self.bytes_sent = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._render, name='oled', daemon=True)
+        self.thread.start()
+
+        self.draw_text("Sleep Well", clear_display = True, draw_frame = 1, font='large')
         self.draw_image()
+
+    def _submit(self, ops, redraw=True):
+        """Queue drawing operations (method, args...) for the render thread."""
+        with self.cond:
+            if ops and ops[0][0] == self._clear and self.ops:
+                # overwritten anyway
+                self.coalesced += 1
+                self.ops = []
+            self.ops.extend(ops)
+            self.submitted += 1
+            if redraw:
+                self.ready = True
+                self.cond.notify_all()
+
+    def _render(self):
+        next_frame = 0.0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.ready or self.closed)
+                if not self.ready:
+                    break
+                ops, self.ops, self.ready = self.ops, [], False
+                submitted = self.submitted
+            try:
+                for op in ops:
+                    op[0](*op[1:])
+                self._present()
+            except Exception as e:
+                logging.error(f"Display: {e}")
+            with self.cond:
+                self.presented = submitted
+                self.cond.notify_all()
+            # the frame rate, drawing that comes in meanwhile is shown with the next frame
+            next_frame = max(next_frame + self.frame_interval, time.monotonic())
+            time.sleep(max(next_frame - time.monotonic(), 0))
+
+    def _present(self):
+        """Send the pages of the framebuffer that changed, only from the first to the last
+        changed column of each page."""
+        pages = np.packbits(self.canvas.reshape(self.HEIGHT // 8, 8, self.WIDTH), axis=1,
+                            bitorder='little')[:, 0, :]
+        changed = np.ones(pages.shape, dtype=bool) if self.shown is None else pages != self.shown
+        for page in np.flatnonzero(changed.any(axis=1)):
+            columns = np.flatnonzero(changed[page])
+            data = pages[page, columns[0]:columns[-1] + 1].tobytes()
+            self.device.write(int(page), int(columns[0]), data)
+            self.bytes_sent += len(data)
+        self.shown = pages
+        self.frames += 1
+
+    def wait(self, timeout=None):
+        """Wait until everything that was drawn is on the display."""
+        with self.cond:
+            submitted = self.submitted
+            return self.cond.wait_for(lambda: self.presented >= submitted, timeout)
+
+    def close(self, timeout=1.0):
+        """Show what is queued and stop the render thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self):
+        return {'frames': self.frames, 'coalesced': self.coalesced, 'bytes_sent': self.bytes_sent}
+
+    # drawing in the render thread
+
+    def _clear(self):
+        self.canvas[:] = False
+
+    def _frame(self, border):
+        self.canvas[:] = True
+        self.canvas[border:self.HEIGHT - border, border:self.WIDTH - border] = False
+
+    def _text(self, text, font, pos):
+        bitmap = font.render(text)
+        text_height, text_width = bitmap.shape
+        if pos == 'center':
+            x, y = self.WIDTH//2 - text_width//2, self.HEIGHT//2 - text_height//2
+        elif pos == 'topright':
+            x, y = self.WIDTH - text_width - 4, 1
+        else:
+            return
+        # clipped to the display
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + text_width, self.WIDTH), min(y + text_height, self.HEIGHT)
+        if x1 > x0 and y1 > y0:
+            self.canvas[y0:y1, x0:x1] |= bitmap[y0 - y:y1 - y, x0 - x:x1 - x]
+
+    def _columns(self, bottom, top):
+        """Fill every column x from the height `bottom[x]` up to `top[x]` in pixels."""
+        rows = np.arange(self.HEIGHT)[:, np.newaxis]
+        y_top = np.rint(self.HEIGHT - top)
+        y_bottom = np.rint(self.HEIGHT - bottom)
+        self.canvas[:, :len(top)] |= (rows >= y_top) & (rows <= y_bottom)
+
+    # drawing from any thread
+
+    def _font(self, font):
+        if font is None:
+            return self.font
+        return {'large': self.large_font, 'medium': self.medium_font, 'small': self.small_font}[font]
+
     def clear_display(self, redraw=False):
-        self.draw.rectangle((0, 0, self.oled.width, self.oled.height * 2), outline=0, fill=0)
-        if redraw:
-            self.draw_image()
+        self._submit([(self._clear,)], redraw=redraw)
+
     def draw_image(self):
-        self.oled.image(self.image)
-        self.oled.show()   
-        
+        self._submit([])
+
     def draw_text(self, text, clear_display = False, font=None, pos='center', \
                   draw_frame = None, redraw = False):
-        # clear display
+        ops = []
         if clear_display:
-            self.clear_display()
-        if font is None:
-            font = self.font
-        elif font == "large":
-            font = self.large_font
-        elif font == "medium":
-            font = self.medium_font            
-        elif font == "small":
-            font = self.small_font
-            
+            ops.append((self._clear,))
         if draw_frame is not None:
-            self.draw_frame(border = draw_frame)
-            
-        text_width, text_height = self.draw.textsize(text, font=font)
-        if pos == 'center':
-            self.draw.text((self.oled.width//2 - text_width//2, self.oled.height//2 - text_height//2),
-                  text, font=font, fill=255)
-        elif pos == 'topright':
-            self.draw.text((self.oled.width - text_width - 4, 1),
-                  text, font=font, fill=255)
-        if redraw:
-            self.draw_image()
-     
+            ops.append((self._frame, int(draw_frame)))
+        ops.append((self._text, str(text), self._font(font), pos))
+        self._submit(ops, redraw=redraw)
+
     def draw_frame(self, border = 1):
-        BORDER = border
-        self.draw.rectangle((0, 0, self.oled.width, self.oled.height), outline=255, fill=255)
-        self.draw.rectangle((BORDER, BORDER, self.oled.width - BORDER - 1, \
-                             self.oled.height - BORDER - 1), outline=0, fill=0)        
-    
-    def draw_timeseries(self, data, text=None, clear_display = True, redraw = True):
-        # subsample if data length is n times the display width
-        n_data_windows = len(data)//self.WIDTH
-        if n_data_windows > 1:
-            data = data[::n_data_windows]
-            
-        # data must be maximum 128 steps long            
-        data = data[-self.WIDTH:]
-    
-        
-        if max(data) > 20: # diffs larger than noise:
-            data /= max(data)
-            data *= self.HEIGHT # scale data to 32 pixels
+        self._submit([(self._frame, border)], redraw=False)
+
+    def _timeseries_ops(self, data, text=None, clear_display=True):
+        # minimum and maximum of the samples of each pixel column, every n-th sample would
+        # miss the spikes. New arrays, the data is shared with the loggers
+        low, high = decimate.envelope(data, self.WIDTH)
+
+        # scale to pixels
+        peak = high.max() if len(high) else 0
+        if peak > 20: # diffs larger than noise:
+            scale = self.HEIGHT / peak # scale data to 32 pixels
+        elif peak > 0:
+            scale = self.HEIGHT / 3 / peak # if just noise, draw low amplitude
         else:
-            data /= max(data)
-            data *= self.HEIGHT / 3 # if just noise, draw low amplitude
-        
-        if clear_display:
-            self.clear_display()
-        for x in range(len(data)-1):
-            self.draw.line((x, self.HEIGHT - data[x], x+1, self.HEIGHT - data[x+1]), fill=1)
-            #self.draw.point((x, self.HEIGHT - data[x]), fill=1)
+            scale = 0
+
+        # down or up to the previous column, so the trace is connected
+        bottom = np.minimum(low, np.concatenate([low[:1], high[:-1]])) * scale
+        top = np.maximum(high, np.concatenate([high[:1], low[:-1]])) * scale
+        ops = [(self._clear,)] if clear_display else []
+        ops.append((self._columns, bottom, top))
         if text is not None:
-            self.draw_text(text, font=self.small_font, clear_display = False, pos='topright')
-        
-        if redraw:    
-            self.draw_image()
+            ops.append((self._text, str(text), self.small_font, 'topright'))
+        return ops
+
+    def draw_timeseries(self, data, text=None, clear_display = True, redraw = True):
+        self._submit(self._timeseries_ops(data, text, clear_display), redraw=redraw)
 
     def draw_display(self, content):
+        ops = []
         if "timeseries" in content and "status" in content:
-            timeseries = content['timeseries']
-            status = content['status']
-            self.draw_timeseries(timeseries, text=status, clear_display = True, redraw = False)
+            ops += self._timeseries_ops(content['timeseries'], text=content['status'], clear_display=True)
 
         if "trigger" in content:
             trigger = content['trigger']
             if trigger:
-                self.draw_text("STIMULUS", font='medium')
-        
+                ops.append((self._text, "STIMULUS", self.medium_font, 'center'))
+
         if "text" in content:
-            self.draw_text(content["text"], font='medium', clear_display=True, draw_frame=True)
-        self.draw_image()
-    
+            ops += [(self._clear,), (self._frame, 1), (self._text, str(content["text"]), self.medium_font, 'center')]
+        self._submit(ops)
+
     def print(self, text, **kwargs):
         args = dict(text=text)
         args['redraw'] = kwargs['redraw'] if 'redraw' in kwargs else True
         args['clear_display'] = kwargs['clear_display'] if 'clear_display' in kwargs else True
         args.update(kwargs)
-        #threading.Thread(target=self.draw_text, args=(args,)).start()
-        self.draw_text(**args)
\ No newline at end of file
+        self.draw_text(**args)
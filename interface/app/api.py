@@ -0,0 +1,157 @@
+import os
+import gzip
+import json
+import hashlib
+import datetime
+
+import numpy as np
+from flask import request, make_response, abort, Response, jsonify
+
+from app import app
+from app.get_data import H5_FILE
+from app.runcache import source_key, minute_rows
+import storage
+import summary
+import catalog
+import live
+import decimate
+
+# columns of the run payloads, from the rows of the summary pyramid
+COLUMNS = [('t', '<f8'), ('act_mean', '<f4'), ('diff_min', '<f4'), ('diff_max', '<f4'), ('diff_mean', '<f4'),
+           ('state', 'u1'), ('spikes', '<u4'), ('n', '<u4')]
+# responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def _columns(rows):
+    """Columns of the payload from summary rows, `state` is the state most time was spent in."""
+    columns = {name: rows[name] for name, _ in COLUMNS if name in rows.dtype.names}
+    columns['state'] = summary.dominant_state(rows) if len(rows) else np.zeros(0)
+    return {name: np.asarray(columns[name]).astype(dtype) for name, dtype in COLUMNS}
+
+
+def _respond(body, mimetype, etag, last_modified=None, headers=None):
+    """Response with an ETag (and Last-Modified), 304 if the client has it already,
+    gzip compressed if the client accepts it."""
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # clients check with the server before using their copy
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    for key, value in (headers or {}).items():
+        response.headers[key] = value
+    response = response.make_conditional(request)
+    if response.status_code == 200 and len(body) >= GZIP_MIN_BYTES \
+            and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _etag(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@app.route('/api/runs')
+def api_runs():
+    """Catalog of the runs, newest first. ?all=1 also lists the runs that are too short."""
+    catalog.backfill(H5_FILE)
+    path = catalog.catalog_path(H5_FILE)
+    entries = catalog.load(H5_FILE)
+    valid = not request.args.get('all')
+    runs = [dict(name=name, **entries[name]) for name in catalog.list_runs(H5_FILE, valid=valid)]
+    last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc) \
+        if os.path.exists(path) else None
+    return _respond(json.dumps({'runs': runs}), 'application/json', _etag(runs), last_modified)
+
+
+@app.route('/api/runs/<name>')
+def api_run(name):
+    """
+    Columns of one run at one level of its summary pyramid.
+
+    ?level=1s|10s|1min|10min, defaults to 1min
+    ?since=<ms> only the bins from this time on. The last bin of a run that is recorded
+        is still filling up, so polling with `since` set to the `t` of the last bin
+        returns it again with the new bins.
+    ?format=binary the columns one after the other as little-endian arrays, the
+        X-Columns header lists their names, dtypes and lengths, e.g. for typed arrays.
+    ?points=<n> at most about n bins for a chart, the bins with the smallest and largest
+        maximum diff of every n/2 bins, so no spike is lost
+    """
+    level = request.args.get('level', '1min')
+    if level not in dict(summary.SUMMARY_LEVELS):
+        abort(400, f"Unknown level {level}")
+    since = request.args.get('since', type=float)
+    binary = request.args.get('format') == 'binary'
+    points = request.args.get('points', type=int)
+    entry = catalog.load(H5_FILE).get(name, {})
+
+    with storage.open_file(H5_FILE) as h5f:
+        if name not in storage.run_names(h5f):
+            abort(404)
+        grp = h5f[name]
+        # a new version of the run has a new key, nothing is read if the client is up to date
+        etag = _etag(source_key(grp), level, since, binary, points)
+        if request.if_none_match.contains(etag):
+            return _respond(b'', 'application/json', etag)
+        if summary.has_summary(grp):
+            rows = summary.read_level(grp, level, t_start=since)
+        elif level == '1min':
+            rows = minute_rows(grp)
+            if since is not None:
+                rows = rows[rows['t'] >= np.floor(since / 60000.0) * 60000.0]
+        else:
+            abort(404, f"{name} has no summary pyramid, only level 1min")
+
+    if points:
+        rows = rows[decimate.minmax_indices(rows['diff_max'], max(points // 2, 1))]
+    columns = _columns(rows)
+    last_modified = datetime.datetime.fromtimestamp(entry['end'] / 1000.0, datetime.timezone.utc) \
+        if entry.get('end') else None
+    meta = {'run': name, 'level': level, 'recording': entry.get('recording', False),
+            'rows': len(rows), 'next_since': float(columns['t'][-1]) if len(rows) else since}
+    if binary:
+        header = ','.join(f"{key}:{array.dtype.str}:{len(array)}" for key, array in columns.items())
+        body = b''.join(array.tobytes() for array in columns.values())
+        return _respond(body, 'application/octet-stream', etag, last_modified,
+                        headers={'X-Columns': header, 'X-Meta': json.dumps(meta)})
+    payload = dict(meta, columns={key: array.tolist() for key, array in columns.items()})
+    return _respond(json.dumps(payload, separators=(',', ':')), 'application/json', etag, last_modified)
+
+
+@app.route('/api/live')
+def api_live():
+    """
+    Server-sent events with the newest state of the logger (see live.py), e.g.
+    new EventSource('/api/live?interval=0.5'). A viewer gets at most one update every
+    `interval` seconds and skips the updates it was too slow for.
+    """
+    interval = max(request.args.get('interval', 0.25, type=float), 0.05)
+    subscriber = live.channel.subscribe(interval)
+
+    def stream():
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                update = subscriber.next(timeout=15.0)
+                if update is None:
+                    # keeps the connection open
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"id: {update['seq']}\ndata: {json.dumps(update)}\n\n"
+        finally:
+            # the viewer went away
+            live.channel.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/live/stats')
+def api_live_stats():
+    """Number of published updates and the lag of every connected viewer."""
+    return jsonify(live.channel.stats())
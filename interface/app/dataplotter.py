@@ -1,75 +1,164 @@
 import os
-import numpy as np
-import datetime
+import glob
+import hashlib
+import logging
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../'))
+import storage
+import summary
+import query
+import decimate
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.dates as mdates
-import h5py
 import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('PS')
 
-STATIC_IMAGES_DIR = '../app/static/images/'
+from app.runcache import source_key
+
+STATIC_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'images')
+# pixels of the plot area, the data is reduced to one value range per pixel column
+WIDTH_PX = 1400
+SPIKE_THRESHOLD = 17
+# samples read at once from runs without a summary pyramid
+BLOCK_ROWS = 1 << 18
 
 
 def plot_last_runs(nRuns=3, filename="../../log.h5"):
-    with h5py.File(filename, mode='r') as h5f:
-        runs = list(h5f.keys())
+    with storage.open_file(filename) as h5f:
+        runs = storage.run_names(h5f)
     runs = runs[-nRuns:][::-1]
     for r in runs:
         plot_recording(runName=r, filename=filename)
     return runs
 
 
+def load_plot_data(grp, width_px=WIDTH_PX):
+    """Timestamps, activity range and maximum diff of a run at the resolution of the plot."""
+    n = grp['ts_realtime'].shape[0]
+    if n == 0:
+        # a run that was just started, an empty chart
+        t, low, high = decimate.time_envelope([], [], 0.0, 0.0, width_px)
+        return t, low, high, high
+    t_start, t_end = [storage.read_column(grp, 'ts_realtime', slice(i, i + 1))[0] for i in (0, n - 1)]
+    acts = decimate.StreamingEnvelope(t_start, t_end, width_px)
+    diffs = decimate.StreamingEnvelope(t_start, t_end, width_px)
+    if summary.has_summary(grp):
+        # a few bins per pixel column, the finest level would be read for nothing
+        rows = summary.read_level(grp, summary.choose_level(t_start, t_end, 8 * width_px))
+        acts.push(rows['t'], rows['act_mean'])
+        diffs.push(rows['t'], rows['diff_max'])
+    else:
+        # only a block of samples is in memory at a time
+        for i in range(0, n, BLOCK_ROWS):
+            block = slice(i, min(i + BLOCK_ROWS, n))
+            ts = storage.read_column(grp, 'ts_realtime', block)
+            acts.push(ts, storage.read_column(grp, 'acts', block))
+            diffs.push(ts, storage.read_column(grp, 'diffs', block))
+    t, low, high = acts.result()
+    _, _, diff_max = diffs.result()
+    return t, low, high, diff_max
+
+
+def render(filename, run_name, image_path, width_px=WIDTH_PX, spike_threshold=SPIKE_THRESHOLD):
+    """Plot the activity of a run into a png file, runs in a worker process of `ChartRenderer`."""
+    with storage.open_file(filename) as h5f:
+        t, low, high, diff_max = load_plot_data(h5f[run_name], width_px)
+    times = query.local_datetimes(t)
+
+    fig = plt.figure(figsize=(width_px / 100.0, 4), dpi=100)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_title(run_name)
+
+    ax.fill_between(times, low, high, color='k', lw=2)
+    ax.fill_between(times, 0, high, color='C0', alpha=0.4, label='state')
+
+    # one line per pixel column with a spike
+    ax.vlines(times[diff_max > spike_threshold], 0,
+              1, color='red', zorder=1, alpha=0.3)
+
+    ax.set_ylim(0, 1)
+
+    hours = mdates.HourLocator(interval=1)
+    h_fmt = mdates.DateFormatter('%H:%M:%S')
+    ax.xaxis.set_tick_params(rotation=90)
+    ax.xaxis.set_major_locator(hours)
+    ax.xaxis.set_major_formatter(h_fmt)
+
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+
+    # readers never see half a file
+    tmp_path = image_path + '.tmp.png'
+    plt.savefig(tmp_path, bbox_inches='tight')
+    plt.close(fig)
+    os.replace(tmp_path, image_path)
+    return image_path
+
+
 def plot_recording(rInd=-1, runName=None, filename="../../log.h5"):
+    """Render a run in the calling thread, see `ChartRenderer` for the web interface."""
     if runName is None:
-        with h5py.File(filename, mode='r') as h5f:
-            runs = list(h5f.keys())
+        with storage.open_file(filename) as h5f:
+            runs = storage.run_names(h5f)
         runName = runs[rInd]
+    logging.info(f"Rendering {runName}")
+    return render(filename, runName, os.path.join(STATIC_IMAGES_DIR, "{}.png".format(runName)))
 
-    image_dir = os.path.join(STATIC_IMAGES_DIR, "{}.png".format(runName))
-    if os.path.isfile(image_dir):
-        print("File {} exists...".format(image_dir))
-    else:
-        with h5py.File(filename, mode='r') as h5f:
-            runs = list(h5f.keys())
-            if runName is None:
-                runName = runs[rInd]
-            print("Rendering {}".format(runName))
-
-            ts = h5f[runName]['ts_realtime'][()]
-            diffs = h5f[runName]['diffs'][()]
-            acts = h5f[runName]['acts'][()]
-
-        times = []
-        for i, milli in enumerate(ts):
-            times.append(datetime.datetime.fromtimestamp(milli/1000.0))
-        times = np.array(times)
-
-        fig = plt.figure(figsize=(14, 4), dpi=100)
-        plt.title(runName)
-        ax = fig.add_subplot(1, 1, 1)
-
-        ax.plot(times, acts, c='k', lw=3)
-        ax.fill_between(times, 0, acts, color='C0', alpha=0.4, label='state')
-
-        thr = 17
-        ax.vlines(times[np.argwhere(diffs > thr)], 0,
-                  1, color='red', zorder=1, alpha=0.3)
-
-        ax.set_ylim(0, 1)
-
-        hours = mdates.HourLocator(interval=1)
-        h_fmt = mdates.DateFormatter('%H:%M:%S')
-        ax.xaxis.set_tick_params(rotation=90)
-        ax.xaxis.set_major_locator(hours)
-        ax.xaxis.set_major_formatter(h_fmt)
-
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        # ax.spines['bottom'].set_visible(False)
-        ax.spines['left'].set_visible(False)
-        #ax.tick_params(direction='out', length=4, width=1, colors='k', labelsize=6)
-
-        # plt.grid()
-        # plt.show()
-        plt.savefig(image_dir, bbox_inches='tight')
-        plt.close(fig)
+
+class ChartRenderer:
+    def __init__(self, filename="../../log.h5", image_dir=STATIC_IMAGES_DIR, workers=1):
+        """
+        Renders the charts of the runs in a process pool, web requests never wait for it.
+
+        The images are named after the run and a hash of the run's version (see
+        `runcache.source_key`) and of the plot parameters, so a run that grows or is
+        rewritten is rendered again. Until the new image is ready, the last image of the
+        run is served.
+        """
+        self.filename = filename
+        self.image_dir = image_dir
+        os.makedirs(image_dir, exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'))
+        self.pending = {} # image path: future
+        self.lock = threading.Lock()
+
+    def image_path(self, run_name, width_px=WIDTH_PX, spike_threshold=SPIKE_THRESHOLD):
+        with storage.open_file(self.filename) as h5f:
+            key = source_key(h5f[run_name])
+        version = hashlib.sha1(repr((key, width_px, spike_threshold)).encode()).hexdigest()[:16]
+        return os.path.join(self.image_dir, f"{run_name}-{version}.png")
+
+    def chart(self, run_name, width_px=WIDTH_PX, spike_threshold=SPIKE_THRESHOLD):
+        """
+        Path of the newest image of the run and if it is up to date. A render job is
+        queued if it is not. The path is None if the run was never rendered.
+        """
+        path = self.image_path(run_name, width_px, spike_threshold)
+        if os.path.isfile(path):
+            return path, True
+        with self.lock:
+            if path not in self.pending:
+                future = self.pool.submit(render, self.filename, run_name, path, width_px, spike_threshold)
+                self.pending[path] = future
+                future.add_done_callback(lambda future: self._done(run_name, path, future))
+        return self.newest(run_name), False
+
+    def newest(self, run_name):
+        images = glob.glob(os.path.join(self.image_dir, f"{run_name}-*.png"))
+        images = [image for image in images if not image.endswith('.tmp.png')]
+        return max(images, key=os.path.getmtime) if images else None
+
+    def _done(self, run_name, path, future):
+        with self.lock:
+            self.pending.pop(path, None)
+        if future.exception() is not None:
+            logging.error(f"Rendering {run_name} failed: {future.exception()}")
+            return
+        # older versions of the run
+        for image in glob.glob(os.path.join(self.image_dir, f"{run_name}-*.png")):
+            if image != path and not image.endswith('.tmp.png'):
+                os.remove(image)
@@ -1,76 +1,76 @@
 import os
 import numpy as np
-import datetime
 import matplotlib.dates as mdates
-from scipy import signal
 import pandas as pd
-import h5py
-import dill
+from dateutil.tz import tzlocal
+
+# storage.py of the logger, reads every layout of the runs
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../'))
+import storage
+import summary
+import catalog
+import query
+import decimate
+from app.runcache import RunCache, minute_rows, MINUTE
 
 H5_FILE = '../../log.h5'
 DATA_DIR = '../../data/'#os.path.join(STATIC_IMAGES_DIR, "{}.png".format(runName))
 PROCESSED_DATA_DIR = '../../data/processed/'##os.path.join(DATA_DIR, "/processed/")
 
-def get_run_names(nruns=1, filename=H5_FILE):
-    with h5py.File(filename, mode='r') as h5f:
-        runs = list(h5f.keys())
-    #runs = runs[-nruns:][::-1]
-
-    # reverse order so we start with the newest recording
-    runs = runs[::-1]
-    return runs
+# per minute data of the runs, memory-mapped
+_cache = None
+# runs recorded before the catalog existed are added once
+_backfilled = False
+
+def get_run_names(nruns=None, filename=H5_FILE):
+    """Names of the newest `nruns` runs that are long enough, from the catalog of the file."""
+    global _backfilled
+    if not _backfilled:
+        # adds the runs that are not in the catalog yet, once it was not locked
+        _backfilled = catalog.backfill(filename) is not None
+    # newest recording first
+    runs = catalog.list_runs(filename)
+    return runs if nruns is None else runs[:int(nruns)]
 
 def get_runs(nruns=5, h5_filename=H5_FILE, run_name = None):
 
     if run_name is None:
-        runs = get_run_names(h5_filename)
+        runs = get_run_names(nruns, h5_filename)
     else:
         runs = [run_name]
-        
-    n_valid_runs = 0
-    nruns = int(nruns)
+
     data = {}
 
     for run_name in runs:
         print("Loading run {}".format(run_name))
-        # only return nruns runs
-        if n_valid_runs >= nruns:
-            break
-        else:
-            df = load_run_data(run_name, h5_filename)
-
-            # check if data is long enough
-            if not df.index[0] < df.index[-1] - datetime.timedelta(hours=1):
-                print(f"{run_name} is too short: {df.index[0]} until {df.index[-1]}")
-                continue
-            else:
-                n_valid_runs += 1
-
-            data[run_name] = {}
-            # get activity spikes
-            diff_thrs = 15
-            spike_list = df[df['diffs'].gt(diff_thrs)].index.strftime('%H:%M:%S').tolist()
-
-            # get deep sleep duration
-            sleep_duration, deep_duration, light_duration = get_sleep_stage_durations(df)
-
-            # time in HH:MM:SS
-            t = df.index.strftime('%H:%M:%S')
-
-            # activity
-            activity = df['data']
-
-            # states
-            states = df['states']
-            
-            # pack data
-            data[run_name]['deep_duration'] = deep_duration
-            data[run_name]['light_duration'] = light_duration
-            data[run_name]['sleep_duration'] = sleep_duration
-            data[run_name]['t'] = t
-            data[run_name]['activity'] = activity
-            data[run_name]['states'] = states
-            data[run_name]['spikes'] = spike_list
+        df = load_run_data(run_name, h5_filename)
+
+        data[run_name] = {}
+        # get activity spikes
+        diff_thrs = 15
+        spike_list = df[df['diffs'].gt(diff_thrs)].index.strftime('%H:%M:%S').tolist()
+
+        # get deep sleep duration
+        sleep_duration, deep_duration, light_duration = get_sleep_stage_durations(df)
+
+        # time in HH:MM:SS
+        t = df.index.strftime('%H:%M:%S')
+
+        # activity
+        activity = df['data']
+
+        # states
+        states = df['states']
+        
+        # pack data
+        data[run_name]['deep_duration'] = deep_duration
+        data[run_name]['light_duration'] = light_duration
+        data[run_name]['sleep_duration'] = sleep_duration
+        data[run_name]['t'] = t
+        data[run_name]['activity'] = activity
+        data[run_name]['states'] = states
+        data[run_name]['spikes'] = spike_list
 
     return data
 
@@ -89,43 +89,48 @@ def process_data(t, data, diffs, states):
     df.index = pd.to_datetime(df.index)
     return df
 
-def get_data_from_run(rInd=-1, runName=None, filename=H5_FILE):
-    if runName is None:
-        with h5py.File(filename, mode='r') as h5f:
-            runs = list(h5f.keys())
-        runName = runs[rInd]
+def minutes_to_pandas(rows):
+    """DataFrame with one row per minute from the per minute rows of a run (see runcache.py).
+    Minutes without samples get the values of the next minute, like `process_data`.
+
+    The state of a minute is the state most of the minute was spent in, not the state of
+    its last sample as in `process_data`; the summary rows only keep the time per state."""
+    if not len(rows):
+        return pd.DataFrame({'data': [], 'diffs': [], 'states': []}, index=pd.DatetimeIndex([], name='t'))
+    minute = (rows['t'] - rows['t'][0]) // MINUTE
+    fill = np.searchsorted(minute, np.arange(minute[-1] + 1))
+    t = rows['t'][0] + np.arange(minute[-1] + 1) * MINUTE
+    # local time without time zone, like datetime.fromtimestamp
+    index = pd.to_datetime(t, unit='ms', utc=True).tz_convert(tzlocal()).tz_localize(None)
+    return pd.DataFrame({'data': rows['act_mean'][fill].astype(np.float64),
+                         'diffs': rows['diff_max'][fill].astype(np.float64),
+                         'states': summary.dominant_state(rows)[fill]},
+                        index=pd.DatetimeIndex(index, name='t'))
 
-    with h5py.File(filename, mode='r') as h5f:
-        runs = list(h5f.keys())
+def get_data_from_run(rInd=-1, runName=None, filename=H5_FILE):
+    with storage.open_file(filename) as h5f:
         if runName is None:
-            runName = runs[rInd]
+            runName = storage.run_names(h5f)[rInd]
         print("Getting data from {}".format(runName))
+        rows = minute_rows(h5f[runName])
+    return minutes_to_pandas(rows)
 
-        ts = h5f[runName]['ts_realtime'][()]
-        diffs = h5f[runName]['diffs'][()]
-        acts = h5f[runName]['acts'][()]
-        states = h5f[runName]['states'][()]
-    
-    # convert loaded data into datetime
-    times = []
-    for i, milli in enumerate(ts):
-        times.append(datetime.datetime.fromtimestamp(milli/1000.0))
-    times = np.array(times)
-    df = process_data(times, acts, diffs, states)
-    return df
+def get_time_range(start, end, filename=H5_FILE):
+    """Samples of every run between two naive local `datetime.datetime`s, e.g. 03:00 to
+    04:00 of last night, as a DataFrame per run. Only the rows of the range are read."""
+    data = query.query(query.local_time_ms(start), query.local_time_ms(end), filename)
+    return {run_name: pd.DataFrame({'data': run['acts'], 'diffs': run['diffs'], 'states': run['states']},
+                                   index=pd.DatetimeIndex(query.local_datetimes(run['ts_realtime']), name='t'))
+            for run_name, run in data.items()}
 
 def load_run_data(run_name, h5_filename):
-    # check if preprocessed data is already available
-    data_filename = os.path.join(PROCESSED_DATA_DIR, f"{run_name}.dill")
-    if os.path.isfile(data_filename):
-        print(f"File {data_filename} exists...")
-        df = dill.load(open(data_filename, "br+"))
-    else:
-        df = get_data_from_run(runName=run_name, filename=h5_filename)
-        #df = process_data(t, activity, diffs)
-        print(f"Saving {data_filename}.")
-        dill.dump(df, open(data_filename, "bw+"))    
-    return df
+    # the cache checks if the run changed since it was cached
+    global _cache
+    if _cache is None:
+        _cache = RunCache(PROCESSED_DATA_DIR)
+    with storage.open_file(h5_filename) as h5f:
+        rows = _cache.minutes(h5f[run_name], run_name)
+    return minutes_to_pandas(rows)
 
 
 
@@ -144,6 +149,6 @@ def get_sleep_stage_durations(df):
     return sleep_duration, deep_duration, light_duration
 
 def downsample_data(t, data, steps=100):
-    t_resampled = signal.resample(t, steps)
-    data_resampled = signal.resample(data, steps)
-    return t_resampled, data_resampled
+    # points of the original data that keep the shape, not a resampled signal
+    indices = decimate.lttb(t, data, steps)
+    return np.asarray(t)[indices], np.asarray(data)[indices]
@@ -1,10 +1,11 @@
 import logging
 
-from flask import render_template, request
+from flask import render_template, request, send_file, Response, abort
 from app import app
 
 #from app.dataplotter import plot_last_runs, plot_recording
-from app.get_data import get_runs, get_run_names
+from app.dataplotter import ChartRenderer
+from app.get_data import get_runs, get_run_names, H5_FILE
 
 # some_file.py
 import sys
@@ -21,6 +22,11 @@ except ImportError:
             return 2
 
 sl = None
+renderer = None
+
+# shown until the chart of a run is rendered
+CHART_PLACEHOLDER = '<svg xmlns="http://www.w3.org/2000/svg" width="1400" height="400">' \
+    '<text x="700" y="200" text-anchor="middle" font-family="sans-serif" fill="#888">rendering {}...</text></svg>'
 
 @app.route('/')
 @app.route('/index')
@@ -60,7 +66,35 @@ def stop():
         sl.stop()
         sl = None
         # process newest dataset
-        _ = get_runs(nruns=1)
+        try:
+            _ = get_runs(nruns=1)
+        except BlockingIOError:
+            # the compaction of the run swaps it in, it is loaded with the next page
+            logging.warning("log file locked, the newest run is loaded later")
         return render_template('tracker.html', status = "stopped")
     else:
-        return render_template('tracker.html', status = "is not running")
\ No newline at end of file
+        return render_template('tracker.html', status = "is not running")
+
+@app.route('/chart/<run_name>')
+def chart(run_name):
+    """Chart of a run. Never waits for the rendering: until the image of the newest
+    version of the run is ready, the previous image or a placeholder (202) is returned."""
+    global renderer
+    if renderer is None:
+        renderer = ChartRenderer(H5_FILE)
+    try:
+        path, _ = renderer.chart(run_name)
+    except KeyError:
+        abort(404)
+    if path is None:
+        return Response(CHART_PLACEHOLDER.format(run_name), status=202, mimetype='image/svg+xml',
+                        headers={'Retry-After': '1', 'Cache-Control': 'no-store'})
+    response = send_file(path, mimetype='image/png', max_age=0)
+    response.cache_control.no_cache = True
+    return response
+
+@app.errorhandler(BlockingIOError)
+def file_locked(e):
+    """The hdf file stayed locked, e.g. by a compaction, the client tries again."""
+    return Response("The log file is busy, try again in a moment.", status=503,
+                    mimetype='text/plain', headers={'Retry-After': '2'})
@@ -0,0 +1,110 @@
+import os
+import json
+import logging
+
+import numpy as np
+import h5py
+
+# get_data.py puts the logger's directory on the path
+import storage
+import summary
+
+CACHE_MAX_BYTES = 200 * 1000 * 1000
+MINUTE = 60000
+
+
+def minute_rows(grp, start=0):
+    """Per minute rows (`summary.SUMMARY_DTYPE`) of a run from row `start` on. They come from
+    the summary pyramid, or are computed from the samples for runs without one."""
+    if summary.has_summary(grp):
+        return grp[summary.dataset_name('1min')][start:]
+    run = storage.read_run(grp, ['ts_realtime', 'diffs', 'acts', 'states'])
+    if not len(run['ts_realtime']):
+        return np.zeros(0, dtype=summary.SUMMARY_DTYPE)
+    return summary.summarize(run['ts_realtime'], run['diffs'], run['acts'], run['states'], MINUTE)[start:]
+
+
+def source_key(grp):
+    """What the cached rows of a run depend on: the number of samples and the hdf objects
+    they are read from, which change when the run is rewritten (compaction, rescoring)."""
+    names = ['ts_realtime', 'diffs', 'acts', 'states']
+    if summary.has_summary(grp):
+        names.append(summary.dataset_name('1min'))
+    return {'n': int(grp['ts_realtime'].shape[0]),
+            'objects': {name: int(h5py.h5o.get_info(grp[name].id).addr) for name in names}}
+
+
+class RunCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        """
+        Per minute rows of the runs as .npy files that are memory-mapped when read.
+
+        Every file has a .json file with the `source_key` of the run it was made from. A run
+        that has grown since, e.g. the one that is recorded, is extended from its last minute
+        on, a run that was rewritten is read again. The least recently used files are removed
+        when the cache gets larger than `max_bytes`.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def paths(self, run_name):
+        base = os.path.join(self.directory, run_name)
+        return base + '.npy', base + '.json'
+
+    def minutes(self, grp, run_name):
+        """Per minute rows of the run in the hdf group `grp`, read-only."""
+        rows_path, key_path = self.paths(run_name)
+        key = source_key(grp)
+        cached = self._cached_key(key_path)
+        if cached == key:
+            rows = np.load(rows_path, mmap_mode='r')
+            # last use for the eviction
+            os.utime(rows_path)
+            return rows
+        if cached is not None and cached['objects'] == key['objects'] and cached['n'] < key['n'] \
+                and summary.has_summary(grp):
+            # the last minute may have been incomplete, it is read again
+            old = np.load(rows_path)
+            start = max(len(old) - 1, 0)
+            rows = np.concatenate([old[:start], minute_rows(grp, start)])
+        else:
+            rows = minute_rows(grp)
+        self._store(rows_path, key_path, rows, key)
+        self.evict()
+        return np.load(rows_path, mmap_mode='r')
+
+    def _cached_key(self, key_path):
+        try:
+            with open(key_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, rows_path, key_path, rows, key):
+        # readers that still map the old file keep their copy
+        tmp_path = rows_path + '.tmp.npy'
+        np.save(tmp_path, rows)
+        os.replace(tmp_path, rows_path)
+        with open(key_path, 'w') as f:
+            json.dump(key, f)
+
+    def evict(self):
+        """Remove the least recently used runs until the cache fits into `max_bytes`."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            logging.info(f"Cache: removing {path}")
+            for p in (path, path[:-len('.npy')] + '.json'):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
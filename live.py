@@ -0,0 +1,86 @@
+import time
+import threading
+
+
+class Subscriber:
+    __slots__ = ('channel', 'interval', 'seq', 'sent', 'last_sent', 'lag_max')
+
+    def __init__(self, channel, interval):
+        self.channel = channel
+        self.interval = interval # seconds between two updates at most
+        self.seq = 0 # sequence number of the last update it got
+        self.sent = 0 # updates it got
+        self.last_sent = 0.0 # monotonic time of the last update
+        self.lag_max = 0 # most updates skipped at once
+
+    def next(self, timeout=None):
+        """Newest update this subscriber did not get yet, waits at most `timeout` seconds.
+        Updates that came in the meantime are skipped, None if there was none."""
+        wait = self.last_sent + self.interval - time.monotonic()
+        if wait > 0:
+            # throttled
+            time.sleep(wait)
+        update = self.channel.wait(self.seq, timeout)
+        if update is None:
+            return None
+        self.lag_max = max(self.lag_max, update['seq'] - self.seq - 1)
+        self.seq = update['seq']
+        self.sent += 1
+        self.last_sent = time.monotonic()
+        return update
+
+    def stats(self):
+        """Updates the subscriber got, how many it was behind at most and is behind now,
+        and the age of the newest update in ms."""
+        return {'sent': self.sent, 'lag': self.channel.seq - self.seq, 'lag_max': self.lag_max,
+                'age_ms': (time.monotonic() - self.last_sent) * 1000.0 if self.sent else None}
+
+
+class LiveChannel:
+    def __init__(self):
+        """
+        Newest state of the logger for any number of viewers, e.g. the browsers connected
+        to the web interface.
+
+        The logger publishes a few times per second and never waits: it only replaces the
+        newest update. Every subscriber gets the newest update when it asks for the next
+        one, updates it was too slow for are skipped (coalesced), so a slow viewer can
+        neither block the logger nor hold up the others.
+        """
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.latest = None
+        self.subscribers = []
+
+    def publish(self, **values):
+        with self.cond:
+            self.seq += 1
+            self.latest = dict(values, seq=self.seq)
+            self.cond.notify_all()
+
+    def wait(self, seq, timeout=None):
+        """First update after `seq`, None on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seq, timeout):
+                return None
+            return self.latest
+
+    def subscribe(self, interval=0.0):
+        subscriber = Subscriber(self, interval)
+        with self.cond:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.cond:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def stats(self):
+        with self.cond:
+            subscribers = list(self.subscribers)
+        return {'published': self.seq, 'subscribers': [subscriber.stats() for subscriber in subscribers]}
+
+
+# the channel of the logger in this process
+channel = LiveChannel()
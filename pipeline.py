@@ -0,0 +1,158 @@
+import time
+import logging
+import threading
+import collections
+
+POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+class Stage:
+    def __init__(self, name, handler, maxsize=8, policy='block', batch=False, on_drop=None, background=True):
+        """
+        Long-lived worker thread with a bounded queue, e.g. for a sink of the logger.
+
+        What happens when the queue is full depends on the policy:
+        'block' waits until the worker took an item, 'drop_oldest' drops the oldest waiting
+        item and 'coalesce' only keeps the newest item (e.g. for the display).
+
+        :param handler: called with every item in the worker thread, or with a list of all
+            waiting items if `batch` is set
+        :param on_drop: called with every item that is dropped by the policy or by `stop`
+        :param background: if False, `put` calls the handler immediately
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, use one of {', '.join(POLICIES)}")
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch = batch
+        self.on_drop = on_drop
+        self.background = background
+
+        self.queue = collections.deque() # (item, time it was queued)
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # statistics
+        self.started = time.monotonic()
+        self.max_depth = 0
+        self.n_processed = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+        self.n_blocked = 0 # puts that had to wait for the worker
+        self.blocked_time = 0.0
+        self.latency_sum = 0.0 # seconds from put until the handler returned
+        self.latency_max = 0.0
+
+        self.thread = None
+        if self.background:
+            self.thread = threading.Thread(target=self._worker, name=f"Stage-{name}", daemon=True)
+            self.thread.start()
+
+    def put(self, item):
+        if not self.background:
+            self._handle([(item, time.monotonic())])
+            return
+        dropped = []
+        with self.cond:
+            if self.closed:
+                raise RuntimeError(f"Stage {self.name} is stopped")
+            if self.policy == 'coalesce':
+                dropped.extend(entry[0] for entry in self.queue)
+                self.queue.clear()
+            elif len(self.queue) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    dropped.append(self.queue.popleft()[0])
+                else:
+                    self.n_blocked += 1
+                    start = time.monotonic()
+                    while len(self.queue) >= self.maxsize:
+                        self.cond.wait()
+                    self.blocked_time += time.monotonic() - start
+            self.queue.append((item, time.monotonic()))
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+        self._drop(dropped)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                if self.batch:
+                    entries = list(self.queue)
+                    self.queue.clear()
+                else:
+                    entries = [self.queue.popleft()]
+                # wake up a blocked put
+                self.cond.notify_all()
+            self._handle(entries)
+
+    def _handle(self, entries):
+        try:
+            if self.batch:
+                self.handler([item for item, _ in entries])
+            else:
+                self.handler(entries[0][0])
+        except Exception:
+            self.n_errors += 1
+            logging.exception(f"Stage {self.name} failed")
+        done = time.monotonic()
+        for _, queued in entries:
+            latency = done - queued
+            self.latency_sum += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+        self.n_processed += len(entries)
+
+    def _drop(self, items):
+        for item in items:
+            self.n_dropped += 1
+            if self.on_drop is not None:
+                self.on_drop(item)
+
+    def stop(self, drain=True, timeout=None):
+        """Stop the worker after it handled the waiting items, or drop them if not `drain`."""
+        with self.cond:
+            self.closed = True
+            dropped = []
+            if not drain:
+                dropped = [entry[0] for entry in self.queue]
+                self.queue.clear()
+            self.cond.notify_all()
+        self._drop(dropped)
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        """Queue depth, throughput and latency of the stage, latencies in ms."""
+        elapsed = time.monotonic() - self.started
+        return {'policy': self.policy, 'depth': len(self.queue), 'max_depth': self.max_depth,
+                'processed': self.n_processed, 'dropped': self.n_dropped, 'errors': self.n_errors,
+                'blocked': self.n_blocked, 'blocked_ms': self.blocked_time * 1000.0,
+                'throughput_per_s': self.n_processed / elapsed if elapsed > 0 else None,
+                'latency_mean_ms': self.latency_sum / self.n_processed * 1000.0 if self.n_processed else None,
+                'latency_max_ms': self.latency_max * 1000.0}
+
+
+class Pipeline:
+    def __init__(self, stages=()):
+        """Named stages that are fed with the same chunks and stopped together."""
+        self.stages = {stage.name: stage for stage in stages}
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def put(self, name, item):
+        self.stages[name].put(item)
+
+    def stop(self, drain=True, timeout=None):
+        for stage in self.stages.values():
+            stage.stop(drain=drain, timeout=timeout)
+
+    def stats(self):
+        return {name: stage.stats() for name, stage in self.stages.items()}
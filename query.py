@@ -0,0 +1,95 @@
+"""
+Time-range queries over the recorded runs, e.g. 03:00-04:00 of last night, without reading
+the whole night.
+
+The rows of a time range are found with the summary pyramid as a coarse index (the number
+of samples of every minute) and a binary search over the timestamps of one minute, or with
+a binary search over `ts_realtime` on disk for runs without a pyramid. Only the hdf chunks
+of the range are read.
+"""
+import time
+
+import numpy as np
+
+import config
+import storage
+import summary
+import catalog
+
+
+def _bisect(grp, t, lo, hi):
+    """First row in [lo, hi) with a timestamp >= `t`, reading single timestamps."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if storage.read_column(grp, "ts_realtime", slice(mid, mid + 1))[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def find_row(grp, t):
+    """First row of the run in `grp` with a timestamp >= `t` (ms)."""
+    n = grp["ts_realtime"].shape[0]
+    if not summary.has_summary(grp):
+        return _bisect(grp, t, 0, n)
+    level = grp[summary.dataset_name("1min")]
+    bins = level.fields("t")[()]
+    # first row of every minute
+    first = np.concatenate([[0], np.cumsum(level.fields("n")[()], dtype=np.int64)])
+    i = np.searchsorted(bins, np.floor(t / 60000.0) * 60000.0)
+    if i == len(bins):
+        # after the summary, which can be behind the samples of the run that is recorded
+        return _bisect(grp, t, int(first[-1]), n)
+    lo, hi = int(first[i]), int(first[i + 1])
+    # only the timestamps of this minute are read
+    return lo + int(np.searchsorted(storage.read_column(grp, "ts_realtime", slice(lo, hi)), t))
+
+
+def run_range(grp, t_start=None, t_end=None):
+    """Rows of the run in `grp` from `t_start` up to but excluding `t_end` (ms), as a slice."""
+    start = 0 if t_start is None else find_row(grp, t_start)
+    end = grp["ts_realtime"].shape[0] if t_end is None else find_row(grp, t_end)
+    return slice(start, max(start, end))
+
+
+def read_range(grp, t_start=None, t_end=None, names=("ts_realtime", "diffs", "acts", "states")):
+    """Dict of float64 arrays of the datasets `names` between `t_start` and `t_end` (ms)."""
+    rows = run_range(grp, t_start, t_end)
+    return {name: storage.read_column(grp, name, rows) for name in names}
+
+
+def query(t_start, t_end, filename=None, names=("ts_realtime", "diffs", "acts", "states")):
+    """Samples between `t_start` and `t_end` (ms) of every run that overlaps the range.
+    The runs are found in the catalog of the file (see catalog.py).
+
+    :return: dict of dicts of arrays (see `read_range`) by run name
+    """
+    filename = config.HDF_FILE if filename is None else filename
+    runs = [name for name, entry in catalog.load(filename).items()
+            if entry["start"] < t_end and (entry["end"] >= t_start or entry["recording"])]
+    data = {}
+    if not runs:
+        return data
+    with storage.open_file(filename) as h5f:
+        for run_name in runs:
+            if run_name in h5f:
+                data[run_name] = read_range(h5f[run_name], t_start, t_end, names)
+    return data
+
+
+def local_datetimes(ts):
+    """`datetime64[ms]` in local time without time zone (like `datetime.fromtimestamp`) of
+    timestamps in ms. The offset to UTC is looked up once per hour, not per sample."""
+    ts = np.asarray(ts, dtype=np.float64)
+    if not len(ts):
+        return ts.astype("datetime64[ms]")
+    hours = np.floor(ts / 3600000.0)
+    unique_hours, index = np.unique(hours, return_inverse=True)
+    offsets = np.array([time.localtime(h * 3600.0).tm_gmtoff for h in unique_hours]) * 1000.0
+    return np.round(ts + offsets[index]).astype(np.int64).astype("datetime64[ms]")
+
+
+def local_time_ms(dt):
+    """Timestamp in ms of a naive local `datetime.datetime`."""
+    return time.mktime(dt.timetuple()) * 1000.0 + dt.microsecond / 1000.0
@@ -0,0 +1,74 @@
+import time
+import argparse
+import logging
+
+import config
+from clock import VirtualClock
+from drivers.MMA_sim import SimulatedMMA8452Q, RecordedMovement, SyntheticMovement
+
+
+def replay(source, output, chunk_size=512, latency=0.0, event_driven=False, fast_read=False):
+    """
+    Run the sleep logger on a simulated accelerometer with a virtual clock.
+
+    The samples go through the normal `SleepLogger.chunkwise_logger` path, including
+    adaptive sampling, the activity integrator and logging to `output`, but sleeping
+    only advances the virtual clock, so a whole night takes seconds.
+
+    :param source: `RecordedMovement` or `SyntheticMovement` that provides the x, y, z values
+    :param output: hdf file the replayed run is written to
+    :param latency: simulated duration of an I2C transaction in seconds
+    :param event_driven: use the accelerometer's transient detection in quiet periods
+    :param fast_read: read only the 8 bit MSBs of the accelerometer
+    :return: the SleepLogger after the replay
+    """
+    # no hardware or servers in a replay
+    config.OLED_DISPLAY = False
+    config.STIMULUS_ACTIVE = False
+    config.LOG_TO_REDIS = False
+    config.VERBOSE_OUTPUT = False
+    config.EVENT_DRIVEN = event_driven
+    config.ACCELEROMETER_INT_PIN = None
+    config.ACCELEROMETER_FAST_READ = fast_read
+
+    from SleepLogger import SleepLogger
+
+    clock = VirtualClock(start=source.start)
+    sl = None
+
+    def stop():
+        sl._run = False
+
+    bus = SimulatedMMA8452Q(source, clock, latency=latency, on_exhausted=stop)
+    sl = SleepLogger(bus=bus, clock=clock, h5_filename=output, background_io=False)
+    sl._run = True
+
+    t_start = time.time()
+    sl.chunkwise_logger(n_cycles=999999999999, t_size=chunk_size)
+    elapsed = time.time() - t_start
+    logging.info(f"Replayed {(clock.time() - source.start) / 3600.0:.2f} h in {elapsed:.2f} s "
+                 f"({bus.n_transactions} bus transactions) into {output}/{sl.dataset_name}")
+    return sl
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description="Replay a recorded or synthetic night through the sleep logger.")
+    parser.add_argument('-r', '--run', default=None, help="name of the recorded run to replay")
+    parser.add_argument('-f', '--file', default=config.HDF_FILE, help="hdf file with the recorded run")
+    parser.add_argument('-s', '--synthetic', type=float, default=None, metavar='HOURS',
+                        help="replay a synthetic night of this length instead of a recording")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic night")
+    parser.add_argument('-o', '--output', default='replay.h5', help="hdf file the replay is logged to")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated I2C transaction time in seconds")
+    parser.add_argument('--event-driven', action='store_true', help="wait for transient interrupts when quiet")
+    parser.add_argument('--fast-read', action='store_true', help="8 bit fast read mode of the accelerometer")
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        source = SyntheticMovement(start=time.time(), duration=args.synthetic * 3600.0, seed=args.seed)
+    else:
+        if args.run is None:
+            parser.error("either --run or --synthetic is required")
+        source = RecordedMovement(args.run, filename=args.file)
+    replay(source, args.output, latency=args.latency, event_driven=args.event_driven, fast_read=args.fast_read)
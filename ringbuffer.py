@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+
+import numpy as np
+
+# one row per sample, a chunk of the ring buffer is an array of these
+SAMPLE_DTYPE = np.dtype([('ts', '<f8'), ('ts_realtime', '<f8'), ('raw', '<f8', (3,)), ('acts', '<f8'),
+                         ('diffs', '<f8'), ('delays', '<f8'), ('states', '<f8'), ('lateness', '<f8')])
+
+
+class Chunk:
+    """A published chunk of samples: a read-only view into the ring buffer and its sequence number."""
+    __slots__ = ('ring', 'seq', 'data')
+
+    def __init__(self, ring, seq, data):
+        self.ring = ring
+        self.seq = seq
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def release(self, consumer):
+        """Tell the ring buffer that `consumer` is done with this chunk."""
+        self.ring.ack(consumer, self.seq)
+
+
+class ChunkRing:
+    def __init__(self, n_slots, chunk_size, consumers=(), buffer=None):
+        """
+        Preallocated ring buffer of chunks for the acquisition loop.
+
+        The logger writes a chunk into the slot returned by `acquire` and hands it to the
+        consumers (sinks, display) with `publish`, as a read-only view with a sequence number.
+        A slot is only written again after every consumer released its chunk, so nothing is
+        allocated per chunk and a consumer that falls behind makes `acquire` wait.
+
+        :param n_slots: number of chunks in the ring
+        :param chunk_size: maximum number of samples per chunk
+        :param consumers: names of the consumers that have to release every chunk
+        :param buffer: array with `SAMPLE_DTYPE` and shape (n_slots, chunk_size) to use,
+            e.g. in shared memory, allocated if None
+        """
+        self.n_slots = n_slots
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros((n_slots, chunk_size), dtype=SAMPLE_DTYPE) if buffer is None else buffer
+        self.consumers = tuple(consumers)
+        self.seqs = [-1] * n_slots # sequence number of the chunk in each slot
+        self.holders = [set() for _ in range(n_slots)] # consumers that did not release the slot yet
+        self.next_seq = 0
+        self.cond = threading.Condition()
+
+        self.n_waits = 0 # acquires that had to wait for a consumer
+        self.wait_time = 0.0 # seconds spent waiting in total
+
+    def acquire(self, warn_after=1.0):
+        """Writable slot for the next chunk, waits until all consumers released the chunk
+        that used it before. Returns the sequence number and the slot."""
+        with self.cond:
+            index = self.next_seq % self.n_slots
+            if self.holders[index]:
+                self.n_waits += 1
+                start = time.monotonic()
+                warned = False
+                while self.holders[index]:
+                    if not self.cond.wait(warn_after) and not warned:
+                        logging.warning(f"Ring buffer full, waiting for {', '.join(sorted(self.holders[index]))} "
+                                        f"to release chunk {self.seqs[index]}")
+                        warned = True
+                self.wait_time += time.monotonic() - start
+            return self.next_seq, self.buffer[index]
+
+    def publish(self, n_samples):
+        """Hand the first `n_samples` of the acquired slot to the consumers."""
+        with self.cond:
+            seq = self.next_seq
+            index = seq % self.n_slots
+            self.seqs[index] = seq
+            self.holders[index] = set(self.consumers)
+            self.next_seq += 1
+        data = self.buffer[index, :n_samples]
+        data.flags.writeable = False
+        return Chunk(self, seq, data)
+
+    def ack(self, consumer, seq):
+        with self.cond:
+            index = seq % self.n_slots
+            if self.seqs[index] == seq:
+                self.holders[index].discard(consumer)
+                if not self.holders[index]:
+                    self.cond.notify_all()
+
+    def lag(self, consumer):
+        """Number of published chunks that `consumer` did not release yet."""
+        with self.cond:
+            return sum(consumer in holders for holders in self.holders)
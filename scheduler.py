@@ -0,0 +1,59 @@
+class DeadlineScheduler:
+    def __init__(self, clock):
+        """
+        Sampling scheduler that works with absolute deadlines on the monotonic clock.
+
+        Every sample is due one period after the deadline of the previous sample, no matter
+        how long the processing of the previous sample took, so the sampling period is the
+        requested one and sleep overshoot does not add up. If the loop falls behind by more
+        than a period, the missed slots are skipped instead of sampled in a burst.
+
+        Timestamps are derived from the monotonic clock and anchored to the wall clock once,
+        so wall clock jumps (e.g. NTP on the Pi) do not corrupt the integration steps.
+        """
+        self.clock = clock
+        self.wall_anchor = clock.time()
+        self.monotonic_anchor = clock.monotonic()
+        self.deadline = None
+
+        self.missed = 0 # samples that started after their deadline had passed
+        self.skipped = 0 # deadlines that were dropped because the loop fell behind
+
+    def time_ms(self):
+        """Current time in ms since the epoch, monotonic."""
+        return int(round((self.wall_anchor + self.clock.monotonic() - self.monotonic_anchor) * 1000))
+
+    def lateness(self):
+        """Time in ms since the deadline of the current sample."""
+        if self.deadline is None:
+            self.deadline = self.clock.monotonic()
+        return (self.clock.monotonic() - self.deadline) * 1000.0
+
+    def wait(self, period, wait_event=None):
+        """Sleep until the deadline of the next sample, `period` ms after the current one.
+
+        :param wait_event: optional function that blocks for at most the given number of
+            seconds and returns True if an event happened. The next sample is then due
+            immediately and the deadlines continue from there.
+        :return: True if woken up by an event
+        """
+        period = period / 1000.0
+        if self.deadline is None:
+            self.deadline = self.clock.monotonic()
+        self.deadline += period
+        now = self.clock.monotonic()
+        if now < self.deadline:
+            if wait_event is not None:
+                if wait_event(self.deadline - now):
+                    self.deadline = self.clock.monotonic()
+                    return True
+                now = self.clock.monotonic()
+            if now < self.deadline:
+                self.clock.sleep(self.deadline - now)
+        else:
+            self.missed += 1
+            if now - self.deadline > period:
+                # do not catch up with a burst of samples
+                self.skipped += int((now - self.deadline) / period)
+                self.deadline = now
+        return False
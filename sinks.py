@@ -0,0 +1,221 @@
+import time
+import logging
+
+import numpy as np
+
+import config
+import storage
+import summary
+import catalog
+from storage import HDF_DATASETS
+
+
+def chunk_column(chunk, name):
+    """Column of a `ringbuffer.Chunk` by hdf dataset name."""
+    if name in ('x', 'y', 'z'):
+        return chunk['raw'][:, 'xyz'.index(name)]
+    return chunk[name]
+
+
+class HDFSink:
+    def __init__(self, filename, run_name, chunk_rows=None, compression=None, consumer='hdf'):
+        """
+        Single long-lived writer of a run in the hdf file.
+
+        The file is opened once, the datasets of the run are created with the compact layout
+        of `storage.py` and the file is switched to SWMR (single writer, multiple reader) mode, so that the web interface can read the
+        run while it is recorded. The summary pyramid of the run (see summary.py) is
+        extended with every write and the run's entry in the catalog (see catalog.py) is
+        updated every `CATALOG_UPDATE_INTERVAL` seconds. `write` appends a batch of chunks with one resize and write
+        per dataset, it is called by the 'hdf' stage of the logger's pipeline.
+
+        :param chunk_rows: rows per hdf chunk of the datasets, defaults to `config.HDF_CHUNK_ROWS`
+        :param compression: hdf filter of the datasets, defaults to `config.HDF_COMPRESSION`
+        :param consumer: name this sink releases the chunks of the ring buffer with
+        """
+        self.filename = filename
+        self.consumer = consumer
+        self.run_name = run_name
+        self.chunk_rows = config.HDF_CHUNK_ROWS if chunk_rows is None else chunk_rows
+        self.compression = config.HDF_COMPRESSION if compression is None else compression
+        self.h5f = None
+        self.n_rows = 0 # rows written so far
+        self.n_writes = 0 # batches written
+
+    def open(self, t0=None):
+        """:param t0: time in ms the timestamps of the run are stored relative to, e.g. the
+            first sample, attributes can not be added once SWMR mode is on. Defaults to now."""
+        t0 = time.time() * 1000.0 if t0 is None else t0
+        # SWMR needs the latest file format
+        self.h5f = storage.open_file(self.filename, 'a')
+        self.grp = storage.create_run(self.h5f, self.run_name, t0, self.chunk_rows, self.compression)
+        self.datasets = [self.grp[name] for name in HDF_DATASETS]
+        summary.create_datasets(self.grp, self.compression)
+        self.summary = summary.SummaryBuilder(self.grp)
+        self.catalog_time = 0.0
+        self.update_catalog(recording=True)
+        try:
+            # no new groups or datasets after this
+            self.h5f.swmr_mode = True
+            self.swmr = True
+            logging.info(f"{self.filename}/{self.run_name}: opened for writing (SWMR)")
+        except RuntimeError:
+            # files created by older versions have an old superblock, convert them with
+            # h5repack --low=2 to read runs while they are recorded
+            self.swmr = False
+            logging.warning(f"{self.filename} does not support SWMR, the run can not be read until it is finished")
+        return self
+
+    def write(self, batch):
+        """Append a list of `ringbuffer.Chunk`s and release them."""
+        n = sum(len(chunk) for chunk in batch)
+        start = self.n_rows
+        try:
+            columns = {}
+            for name in HDF_DATASETS:
+                if len(batch) == 1:
+                    columns[name] = chunk_column(batch[0], name)
+                else:
+                    columns[name] = np.concatenate([chunk_column(chunk, name) for chunk in batch])
+            # all columns are encoded before any is written, a batch that does not fit is
+            # not written at all and the datasets keep the same length
+            encoded = [storage.encode(self.grp, name, columns[name]) for name in HDF_DATASETS]
+            for dset, values in zip(self.datasets, encoded):
+                dset.resize((start + n,))
+                dset[start:] = values
+            self.summary.append(columns['ts_realtime'], columns['diffs'], columns['acts'], columns['states'])
+        finally:
+            for chunk in batch:
+                chunk.release(self.consumer)
+        # make the new rows visible to readers
+        self.h5f.flush()
+        self.n_rows += n
+        self.n_writes += 1
+        if time.monotonic() - self.catalog_time > config.CATALOG_UPDATE_INTERVAL:
+            self.update_catalog(recording=True)
+        if config.VERBOSE_OUTPUT:
+            logging.info(f"{self.filename}/{self.run_name}: APPEND ... {self.n_rows}")
+
+    def update_catalog(self, recording):
+        builder = self.summary
+        start = self.grp.attrs['t0'] if builder.first_t is None else builder.first_t
+        end = start if builder.last_t is None else builder.last_t
+        entry = catalog.make_entry(start, end, builder.n_samples, builder.state_ms, recording=recording)
+        try:
+            catalog.update(self.filename, {self.run_name: entry})
+        except OSError as e:
+            # the catalog can be rebuilt from the runs, the recording goes on
+            logging.warning(f"{catalog.catalog_path(self.filename)} not updated: {e}")
+        self.catalog_time = time.monotonic()
+
+    def close(self):
+        if self.h5f is None:
+            return
+        self.update_catalog(recording=False)
+        self.h5f.close()
+        self.h5f = None
+        logging.info(f"{self.filename}/{self.run_name}: closed after {self.n_rows} rows in {self.n_writes} writes")
+
+
+# binary layout of a sample in packed redis entries
+REDIS_PACKED_DTYPE = np.dtype([('t', '<i8'), ('t_realtime', '<i8'), ('x', '<i2'), ('y', '<i2'), ('z', '<i2'),
+                               ('activity', '<f4'), ('diff', '<f4'), ('delay', '<f4'), ('state', 'u1'),
+                               ('lateness', '<f4')])
+
+
+def unpack_redis_entry(fields):
+    """Samples of a packed stream entry as a structured array with `REDIS_PACKED_DTYPE`."""
+    return np.frombuffer(fields[b'data'], dtype=REDIS_PACKED_DTYPE)
+
+
+class RedisSink:
+    def __init__(self, client=None, stream=None, encoding=None, maxlen=None, retention=None, consumer='redis'):
+        """
+        Writes the chunks to a redis stream, one pipeline and round trip per batch of chunks.
+        It is called by the 'redis' stage of the logger's pipeline, which drops the oldest
+        chunks if the server is too slow, so the logger never waits for redis.
+
+        :param client: redis client, defaults to a client with a connection pool for
+            `config.REDIS_HOST`. Anything with `pipeline()`, `xadd` and `xtrim` works.
+        :param encoding: 'fields' for one entry per sample with text fields, 'packed' for one
+            entry per chunk with the samples in binary (see `unpack_redis_entry`)
+        :param maxlen: trim the stream to about this many entries
+        :param retention: trim entries older than this many seconds instead, based on the
+            sample times, so the clocks of the Pi and the server should agree
+        :param consumer: name this sink releases the chunks of the ring buffer with
+        """
+        if client is None:
+            import redis
+            pool = redis.ConnectionPool(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+            client = redis.Redis(connection_pool=pool)
+        self.client = client
+        self.stream = config.REDIS_STREAM if stream is None else stream
+        self.encoding = config.REDIS_ENCODING if encoding is None else encoding
+        if self.encoding not in ('fields', 'packed'):
+            raise ValueError(f"Unknown redis encoding {self.encoding}")
+        self.maxlen = config.REDIS_STREAM_MAXLEN if maxlen is None else maxlen
+        self.retention = config.REDIS_STREAM_RETENTION if retention is None else retention
+        self.consumer = consumer
+
+        self.n_chunks = 0 # chunks sent
+        self.n_samples = 0 # samples sent
+        self.n_dropped = 0 # samples lost because the server failed
+        self.n_errors = 0
+
+    def write(self, batch):
+        """Send a list of `ringbuffer.Chunk`s in one pipeline and release them."""
+        n = sum(len(chunk) for chunk in batch)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for chunk in batch:
+                self._add(pipe, chunk)
+            # trim once per batch instead of with every entry
+            if self.retention:
+                pipe.xtrim(self.stream, minid=int(batch[-1]['ts_realtime'][-1] - self.retention * 1000.0),
+                           approximate=True)
+            elif self.maxlen:
+                pipe.xtrim(self.stream, maxlen=self.maxlen, approximate=True)
+            pipe.execute()
+        except Exception as e:
+            self.n_errors += 1
+            self.n_dropped += n
+            if self.n_errors == 1 or self.n_errors % 100 == 0:
+                logging.warning(f"Redis stream {self.stream}: {e} ({self.n_dropped} samples dropped)")
+            return
+        finally:
+            for chunk in batch:
+                chunk.release(self.consumer)
+        self.n_chunks += len(batch)
+        self.n_samples += n
+
+    def _add(self, pipe, chunk):
+        ts, ts_realtime, raw_data, acts, diffs, delays, states, lateness = \
+            [chunk[name] for name in ('ts', 'ts_realtime', 'raw', 'acts', 'diffs', 'delays', 'states', 'lateness')]
+        if self.encoding == 'packed':
+            samples = np.empty(len(ts), dtype=REDIS_PACKED_DTYPE)
+            samples['t'] = ts
+            samples['t_realtime'] = ts_realtime
+            samples['x'] = raw_data[:, 0]
+            samples['y'] = raw_data[:, 1]
+            samples['z'] = raw_data[:, 2]
+            samples['activity'] = acts
+            samples['diff'] = diffs
+            samples['delay'] = delays
+            samples['state'] = states
+            samples['lateness'] = lateness
+            pipe.xadd(self.stream, {'n': len(samples), 'data': samples.tobytes()})
+        else:
+            # format every column at once, same text as one xadd per sample used to send
+            columns = zip(ts.astype(np.int64).tolist(), ts_realtime.astype(np.int64).tolist(),
+                          raw_data[:, 0].tolist(), raw_data[:, 1].tolist(), raw_data[:, 2].tolist(),
+                          np.char.mod("%.4f", acts).tolist(), np.char.mod("%.2f", diffs).tolist(),
+                          np.char.mod("%.2f", delays).tolist(), states.astype(np.int64).tolist(),
+                          np.char.mod("%.2f", lateness).tolist())
+            for t, t_realtime, x, y, z, activity, diff, delay, state, late in columns:
+                pipe.xadd(self.stream, {"t" : t , "t_realtime" : t_realtime, "x" : x, "y" : y, "z" : z,
+                                        'activity' : activity, 'diff' : diff, 'delay' : delay, 'state' : state,
+                                        'lateness' : late})
+
+    def close(self):
+        if self.n_dropped:
+            logging.warning(f"Redis stream {self.stream}: {self.n_dropped} samples dropped")
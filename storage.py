@@ -0,0 +1,111 @@
+import time
+
+import numpy as np
+import h5py
+
+# datasets of a run
+HDF_DATASETS = ["ts", "ts_realtime", "x", "y", "z", "acts", "diffs", "delays", "states", "lateness"]
+
+# Storage layout of a run, saved in the 'layout' attribute of its group. Runs without
+# the attribute have layout 1, where every dataset is float64.
+# Layout 2 stores the raw axes as int16, the states as uint8, the activity, delays and
+# lateness as float32 and `ts_realtime` as int32 ticks of `TS_TICK_MS` since the int64
+# ms in the 't0' attribute of the group. Datasets with a 'scale' attribute hold integers
+# that are multiplied with it, e.g. the diffs are thirds of the summed axis changes.
+LAYOUT_VERSION = 2
+TS_TICK_MS = 0.1 # int32 ticks cover 59 hours
+LAYOUT_DTYPES = {"ts": np.float32, "ts_realtime": np.int32, "x": np.int16, "y": np.int16, "z": np.int16,
+                 "acts": np.float32, "diffs": np.int16, "delays": np.float32, "states": np.uint8,
+                 "lateness": np.float32}
+LAYOUT_SCALES = {"ts_realtime": TS_TICK_MS, "diffs": 1 / 3.0}
+# seconds a blocked open of the hdf file is retried, e.g. while a compaction swaps a run in
+OPEN_TIMEOUT = 5.0
+
+
+def open_file(filename, mode="r", timeout=None):
+    """Open the hdf file, for reading in SWMR mode.
+
+    HDF5 locks the file: it can not be opened at all while it is open for writing without
+    SWMR (a compaction swapping a run in), and not for writing while it is read. The open
+    is retried for `timeout` s (OPEN_TIMEOUT) before the BlockingIOError is raised.
+    """
+    deadline = time.monotonic() + (OPEN_TIMEOUT if timeout is None else timeout)
+    while True:
+        try:
+            if mode == "r":
+                return h5py.File(filename, mode="r", libver="latest", swmr=True)
+            return h5py.File(filename, mode, libver="latest")
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_names(h5f):
+    """Names of the runs in an open hdf file, oldest first. Groups starting with '_' are
+    not runs, e.g. a run that is being compacted (see compaction.py)."""
+    return [name for name in h5f.keys() if not name.startswith("_")]
+
+
+def layout_version(grp):
+    """Storage layout of the run in the hdf group `grp`."""
+    return int(grp.attrs.get("layout", 1))
+
+
+def create_run(h5f, run_name, t0, chunk_rows, compression="gzip"):
+    """Create the group and the empty datasets of a run with the current layout.
+
+    :param t0: time in ms the timestamps of the run are stored relative to
+    :return: the group
+    """
+    grp = h5f.create_group(run_name)
+    grp.attrs["layout"] = LAYOUT_VERSION
+    grp.attrs["t0"] = np.int64(np.floor(t0))
+    for name in HDF_DATASETS:
+        # shuffle puts the bytes of the values next to each other, they compress much better
+        dset = grp.create_dataset(name, shape=(0,), dtype=LAYOUT_DTYPES[name], maxshape=(None,),
+                                  chunks=(chunk_rows,), compression=compression, shuffle=True)
+        if name in LAYOUT_SCALES:
+            dset.attrs["scale"] = LAYOUT_SCALES[name]
+    return grp
+
+
+def encode(grp, name, values):
+    """Values of a dataset as they are stored in a layout 2 run.
+
+    Raises an OverflowError instead of wrapping around if an integer dataset can not hold
+    the values, e.g. timestamps more than 59 hours after the start of the run.
+    """
+    if name == "ts_realtime":
+        values = values - grp.attrs["t0"]
+    if name in LAYOUT_SCALES:
+        values = np.rint(values / LAYOUT_SCALES[name])
+    dtype = np.dtype(LAYOUT_DTYPES[name])
+    if dtype.kind in "iu" and len(values):
+        info = np.iinfo(dtype)
+        lo, hi = np.min(values), np.max(values)
+        if lo < info.min or hi > info.max:
+            raise OverflowError(f"{grp.name}/{name}: values from {lo} to {hi} do not fit into {dtype}")
+    return values.astype(dtype)
+
+
+def read_column(grp, name, selection=slice(None)):
+    """Dataset `name` of the run in the hdf group `grp` as float64, for every layout.
+
+    :param selection: slice or index array of the rows to read
+    """
+    dset = grp[name]
+    values = dset[selection]
+    if dset.dtype == np.float64:
+        return values
+    values = values.astype(np.float64)
+    if "scale" in dset.attrs:
+        values *= dset.attrs["scale"]
+    if name == "ts_realtime":
+        values += grp.attrs["t0"]
+    return values
+
+
+def read_run(grp, names=HDF_DATASETS):
+    """Dict of float64 arrays of the datasets `names` of a run."""
+    return {name: read_column(grp, name) for name in names}
@@ -0,0 +1,162 @@
+"""
+Summary pyramid of a run: the samples aggregated into bins of 1 s, 10 s, 1 min and 10 min,
+stored next to the datasets of the run as 'summary_1s', 'summary_10s' and so on.
+
+Every row holds the minimum, maximum and mean diff, the mean activity, the time spent in
+each sleep state and the number of spikes of one bin, so a night can be shown at any zoom
+level by reading a few kilobytes. The bins are aligned to the wall clock.
+
+The pyramid of the run that is recorded is extended with every write of `sinks.HDFSink`,
+runs recorded before get one when they are compacted (see compaction.py).
+"""
+import numpy as np
+
+import config
+import storage
+
+# name and width in ms of the levels, finest first
+SUMMARY_LEVELS = [("1s", 1000), ("10s", 10000), ("1min", 60000), ("10min", 600000)]
+SUMMARY_DTYPE = np.dtype([("t", "<i8"), ("n", "<u4"), ("diff_min", "<f4"), ("diff_max", "<f4"),
+                          ("diff_mean", "<f4"), ("act_mean", "<f4"), ("wake_ms", "<f4"),
+                          ("light_ms", "<f4"), ("deep_ms", "<f4"), ("spikes", "<u4")])
+# time in state fields by state
+STATE_FIELDS = {config.SLEEP_STATE_WAKE: "wake_ms", config.SLEEP_STATE_LIGHT: "light_ms",
+                config.SLEEP_STATE_DEEP: "deep_ms"}
+CHUNK_ROWS = 1024
+
+
+def dataset_name(level):
+    return "summary_" + level
+
+
+def has_summary(grp):
+    return all(dataset_name(level) in grp for level, _ in SUMMARY_LEVELS)
+
+
+def create_datasets(grp, compression=None):
+    """Empty summary datasets in the group of a run, before the file switches to SWMR mode."""
+    for level, _ in SUMMARY_LEVELS:
+        grp.create_dataset(dataset_name(level), shape=(0,), dtype=SUMMARY_DTYPE, maxshape=(None,),
+                           chunks=(CHUNK_ROWS,), compression=compression, shuffle=True)
+
+
+def summarize(ts, diffs, acts, states, width, last_t=None, last_state=None, threshold=None):
+    """
+    Bins of one level for a block of samples.
+
+    Every sample holds its state until the next one, the time between two samples is
+    counted in the bin of the later one.
+
+    :param ts: `ts_realtime` of the samples in ms
+    :param last_t: time of the sample before the block, if any
+    :param last_state: state of the sample before the block
+    :param threshold: diffs above this are spikes, defaults to `ACCELEROMETER_ACTIVITY_THRESHOLD`
+    :return: array of `SUMMARY_DTYPE`, one row per bin with samples
+    """
+    threshold = config.ACCELEROMETER_ACTIVITY_THRESHOLD if threshold is None else threshold
+    bins = np.floor(ts / width).astype(np.int64)
+    starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+    rows = np.zeros(len(starts), dtype=SUMMARY_DTYPE)
+    rows["t"] = bins[starts] * width
+    rows["n"] = np.diff(starts, append=len(ts))
+    rows["diff_min"] = np.minimum.reduceat(diffs, starts)
+    rows["diff_max"] = np.maximum.reduceat(diffs, starts)
+    rows["diff_mean"] = np.add.reduceat(diffs, starts) / rows["n"]
+    rows["act_mean"] = np.add.reduceat(acts, starts) / rows["n"]
+    rows["spikes"] = np.add.reduceat((diffs > threshold).astype(np.uint32), starts)
+
+    dt = np.diff(ts, prepend=ts[0] if last_t is None else last_t)
+    held = np.empty(len(states))
+    held[0] = states[0] if last_state is None else last_state
+    held[1:] = states[:-1]
+    for state, field in STATE_FIELDS.items():
+        rows[field] = np.add.reduceat(np.where(held == state, dt, 0.0), starts)
+    return rows
+
+
+def merge(a, b):
+    """Row of a bin from two rows of the same bin."""
+    row = np.zeros((), dtype=SUMMARY_DTYPE)
+    row["t"] = a["t"]
+    row["n"] = a["n"] + b["n"]
+    row["diff_min"] = min(a["diff_min"], b["diff_min"])
+    row["diff_max"] = max(a["diff_max"], b["diff_max"])
+    for field in ("diff_mean", "act_mean"):
+        row[field] = (a[field] * float(a["n"]) + b[field] * float(b["n"])) / float(row["n"])
+    for field in list(STATE_FIELDS.values()) + ["spikes"]:
+        row[field] = a[field] + b[field]
+    return row
+
+
+class SummaryBuilder:
+    def __init__(self, grp, threshold=None):
+        """
+        Extends the summary datasets of the run in `grp` with blocks of samples. The last
+        row of every level is the bin that is still filling up, it is rewritten until the
+        samples move on to the next bin.
+        """
+        self.datasets = [(grp[dataset_name(level)], width) for level, width in SUMMARY_LEVELS]
+        self.threshold = threshold
+        self.open_rows = [None] * len(self.datasets) # last row of each level
+        self.last_t = None
+        self.last_state = None
+        # totals of the run so far
+        self.first_t = None
+        self.n_samples = 0
+        self.state_ms = {state: 0.0 for state in STATE_FIELDS}
+
+    def append(self, ts, diffs, acts, states):
+        if not len(ts):
+            return
+        for i, (dset, width) in enumerate(self.datasets):
+            rows = summarize(ts, diffs, acts, states, width, self.last_t, self.last_state, self.threshold)
+            if i == 0:
+                for state, field in STATE_FIELDS.items():
+                    self.state_ms[state] += float(np.sum(rows[field]))
+            start = dset.shape[0]
+            open_row = self.open_rows[i]
+            if open_row is not None and open_row["t"] == rows["t"][0]:
+                rows[0] = merge(open_row, rows[0])
+                start -= 1
+            dset.resize((start + len(rows),))
+            dset[start:] = rows
+            self.open_rows[i] = rows[-1].copy()
+        if self.first_t is None:
+            self.first_t = ts[0]
+        self.n_samples += len(ts)
+        self.last_t = ts[-1]
+        self.last_state = states[-1]
+
+
+def build(grp, block_rows=1 << 20):
+    """Add the summary pyramid to a finished run that has none, in blocks of samples."""
+    create_datasets(grp, compression="gzip")
+    builder = SummaryBuilder(grp)
+    for i in range(0, grp["ts_realtime"].shape[0], block_rows):
+        block = slice(i, i + block_rows)
+        builder.append(*[storage.read_column(grp, name, block) for name in ("ts_realtime", "diffs", "acts", "states")])
+
+
+def choose_level(t_start, t_end, max_rows):
+    """Finest level with at most `max_rows` bins between `t_start` and `t_end` (ms)."""
+    for level, width in SUMMARY_LEVELS:
+        if (t_end - t_start) / width <= max_rows:
+            return level
+    return SUMMARY_LEVELS[-1][0]
+
+
+def read_level(grp, level, t_start=None, t_end=None):
+    """Rows of a level, only the bins from `t_start` to `t_end` (ms) if given."""
+    dset = grp[dataset_name(level)]
+    if t_start is None and t_end is None:
+        return dset[()]
+    t = dset.fields("t")[()]
+    i0 = 0 if t_start is None else np.searchsorted(t, t_start, side="right") - 1
+    i1 = len(t) if t_end is None else np.searchsorted(t, t_end, side="right")
+    return dset[max(i0, 0):i1]
+
+
+def dominant_state(rows):
+    """State the most time was spent in, for every row."""
+    states = np.array(list(STATE_FIELDS.keys()))
+    return states[np.argmax(np.stack([rows[field] for field in STATE_FIELDS.values()]), axis=0)]
@@ -0,0 +1,181 @@
+import os
+import csv
+import argparse
+import itertools
+import logging
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import h5py
+
+import config
+import storage
+from activity import rescore
+
+# activity model parameters in config.py and their names in activity.rescore
+PARAMETERS = {
+    'ACCELEROMETER_ACTIVITY_THRESHOLD': 'threshold',
+    'ACTIVITY_DECAY_CONSTANT': 'decay',
+    'ACTIVITY_SPIKE_STRENGTH': 'spike_strength',
+    'ACTIVITY_DECAY_DELAY': 'decay_delay',
+    'ACTIVITY_LOWER_BOUND': 'lower_bound',
+    'ACTIVITY_THRESHOLD_DEEP_SLEEP': 'deep_threshold',
+    'ACTIVITY_THRESHOLD_WAKE': 'wake_threshold',
+}
+RESULT_COLUMNS = ['samples', 'hours', 'deep_minutes', 'light_minutes', 'wake_minutes']
+
+# arrays of all runs in the worker processes, views into shared memory
+_runs = {}
+_shms = []
+
+
+def make_grid(grid):
+    """Expand a dict of parameter lists into a list of complete parameter sets.
+    Parameters that are not part of the grid keep their value from `config.py`."""
+    for name in grid:
+        if name not in PARAMETERS:
+            raise ValueError(f"Unknown parameter {name}, choose from {list(PARAMETERS)}")
+    names = list(PARAMETERS)
+    values = [grid[name] if name in grid else [getattr(config, name)] for name in names]
+    return [dict(zip(names, [float(v) for v in combination])) for combination in itertools.product(*values)]
+
+
+def param_key(run_name, params):
+    return (run_name,) + tuple(repr(float(params[name])) for name in PARAMETERS)
+
+
+def load_done(output):
+    """Keys of all (run, parameter set) combinations that are already in the output table."""
+    done = set()
+    if os.path.isfile(output):
+        with open(output, newline='') as f:
+            for row in csv.DictReader(f):
+                done.add(param_key(row['run'], row))
+    return done
+
+
+def share_runs(filename, run_names=None):
+    """Load `ts_realtime` and `diffs` of every run once into shared memory blocks.
+
+    :return: list of shared memory blocks (to be closed and unlinked by the caller)
+        and a dict with the name, shape and dtype of every array for the workers
+    """
+    shms = []
+    layout = {}
+    with h5py.File(filename, mode='r', libver='latest', swmr=True) as h5f:
+        run_names = storage.run_names(h5f) if run_names is None else run_names
+        for run_name in run_names:
+            layout[run_name] = {}
+            for var in ['ts_realtime', 'diffs']:
+                dataset = h5f[run_name][var]
+                shm = shared_memory.SharedMemory(create=True, size=max(dataset.size * 8, 1))
+                shms.append(shm)
+                array = np.ndarray(dataset.shape, dtype=np.float64, buffer=shm.buf)
+                if dataset.size:
+                    if dataset.dtype == np.float64:
+                        dataset.read_direct(array)
+                    else:
+                        # compact layout, decoded to float64 like the old one
+                        array[:] = storage.read_column(h5f[run_name], var)
+                layout[run_name][var] = (shm.name, dataset.shape, array.dtype.str)
+    return shms, layout
+
+
+def _attach_runs(layout):
+    """Pool initializer: map the shared arrays into this worker process without copying."""
+    for run_name, variables in layout.items():
+        _runs[run_name] = {}
+        for var, (name, shape, dtype) in variables.items():
+            shm = shared_memory.SharedMemory(name=name)
+            _shms.append(shm)
+            _runs[run_name][var] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def score_run(run_name, params):
+    """Re-score one run with one parameter set and sum up the time spent in each sleep state."""
+    ts = _runs[run_name]['ts_realtime']
+    diffs = _runs[run_name]['diffs']
+    kwargs = {PARAMETERS[name]: value for name, value in params.items()}
+    _, states = rescore(ts, diffs, **kwargs)
+
+    # every sample holds its state until the next one
+    durations = np.bincount(states[:-1], weights=np.diff(ts), minlength=3) / 60000.0
+    result = dict(run=run_name, **params)
+    result['samples'] = len(ts)
+    result['hours'] = (ts[-1] - ts[0]) / 3600000.0 if len(ts) else 0.0
+    result['deep_minutes'] = durations[config.SLEEP_STATE_DEEP]
+    result['light_minutes'] = durations[config.SLEEP_STATE_LIGHT]
+    result['wake_minutes'] = durations[config.SLEEP_STATE_WAKE]
+    return result
+
+
+def _score_task(task):
+    return score_run(*task)
+
+
+def sweep(grid, filename=config.HDF_FILE, output='sweep.csv', run_names=None, processes=None):
+    """Evaluate every parameter set of `grid` on every run of the hdf file with a process pool.
+
+    Results are appended to the csv table `output` as they arrive. Combinations of run
+    and parameters that are already in the table are skipped, so a sweep can be extended
+    or resumed by running it again.
+
+    :param grid: dict of config.py parameter names and lists of values
+    :return: number of newly evaluated combinations
+    """
+    done = load_done(output)
+    with h5py.File(filename, mode='r', libver='latest', swmr=True) as h5f:
+        run_names = storage.run_names(h5f) if run_names is None else run_names
+    parameter_sets = make_grid(grid)
+    tasks = [(run_name, params) for params in parameter_sets for run_name in run_names
+             if param_key(run_name, params) not in done]
+    logging.info(f"Sweep: {len(parameter_sets)} parameter sets, {len(run_names)} runs, "
+                 f"{len(tasks)} new evaluations")
+    if not tasks:
+        return 0
+
+    # only load the runs that still have work to do
+    needed = sorted(set(run_name for run_name, _ in tasks), key=run_names.index)
+    shms, layout = share_runs(filename, needed)
+    write_header = not os.path.isfile(output)
+    try:
+        with open(output, 'a', newline='') as f, \
+             Pool(processes, initializer=_attach_runs, initargs=(layout,)) as pool:
+            writer = csv.DictWriter(f, fieldnames=['run'] + list(PARAMETERS) + RESULT_COLUMNS)
+            if write_header:
+                writer.writeheader()
+            for i, result in enumerate(pool.imap_unordered(_score_task, tasks)):
+                writer.writerow(result)
+                # keep finished results if the sweep is interrupted
+                f.flush()
+                if config.VERBOSE_OUTPUT:
+                    print(f"\r{i + 1}/{len(tasks)} evaluations done", end='\r')
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return len(tasks)
+
+
+def parse_grid(items):
+    """Parse command line parameters of the form NAME=value1,value2,..."""
+    grid = {}
+    for item in items:
+        name, values = item.split('=')
+        grid[name] = [float(v) for v in values.split(',')]
+    return grid
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description="Sweep the activity model parameters over all recorded runs.")
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help="parameter grid, e.g. -p ACTIVITY_DECAY_CONSTANT=60000,120000")
+    parser.add_argument('-f', '--file', default=config.HDF_FILE, help="hdf file with the recorded runs")
+    parser.add_argument('-o', '--output', default='sweep.csv', help="csv table with the results")
+    parser.add_argument('-r', '--run', action='append', default=None, help="only use these runs")
+    parser.add_argument('-n', '--processes', type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    sweep(parse_grid(args.param), filename=args.file, output=args.output,
+          run_names=args.run, processes=args.processes)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the modules are imported from the repository root, like the scripts do
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import config
+
+
+@pytest.fixture(autouse=True)
+def restore_config():
+    """replay and the tests change the settings in config, every test starts with the defaults."""
+    saved = dict(vars(config))
+    yield
+    for name in set(vars(config)) - set(saved):
+        delattr(config, name)
+    for name, value in saved.items():
+        setattr(config, name, value)
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+import storage
+from activity import rescore_run
+from replay import replay
+from drivers.MMA_sim import SyntheticMovement
+
+
+@pytest.mark.parametrize("event_driven", [False, True])
+def test_rescore_matches_the_live_integrator(tmp_path, event_driven):
+    filename = str(tmp_path / "replay.h5")
+    source = SyntheticMovement(start=1.7e9, duration=2 * 3600, seed=4)
+    logger = replay(source, filename, event_driven=event_driven)
+    with storage.open_file(filename) as f:
+        run = storage.read_run(f[logger.dataset_name], ["acts", "states"])
+
+    acts, states = rescore_run(logger.dataset_name, filename)
+    # the activity is stored as float32
+    assert np.allclose(acts, run["acts"], rtol=1e-5, atol=1e-7)
+    assert np.array_equal(states, run["states"])
+    # the night went through more than one state
+    assert len(np.unique(states)) > 1
@@ -0,0 +1,69 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+import compaction
+import storage
+from replay import replay
+from drivers.MMA_sim import SyntheticMovement
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """hdf file with a replayed run, its name and its values."""
+    filename = str(tmp_path / "log.h5")
+    logger = replay(SyntheticMovement(start=1.7e9, duration=900, seed=2), filename)
+    with storage.open_file(filename) as f:
+        run = storage.read_run(f[logger.dataset_name])
+    return filename, logger.dataset_name, run
+
+
+def assert_same_run(filename, run_name, run):
+    with storage.open_file(filename) as f:
+        assert storage.run_names(f) == [run_name]
+        after = storage.read_run(f[run_name])
+    for name, values in run.items():
+        assert np.array_equal(after[name], values), name
+
+
+def test_compaction_keeps_the_values(recorded):
+    filename, run_name, run = recorded
+    assert compaction.compact_file(filename) == 1
+    assert_same_run(filename, run_name, run)
+    with storage.open_file(filename) as f:
+        grp = f[run_name]
+        assert grp.attrs["compacted"]
+        assert grp["ts_realtime"].compression == "gzip"
+        assert list(f.keys()) == [run_name]
+    assert not os.path.exists(filename + compaction.SIDE_SUFFIX)
+    # nothing left to do
+    assert compaction.compact_file(filename) == 0
+
+
+@pytest.mark.parametrize("original", ["moved aside", "deleted"])
+def test_interrupted_swap_is_finished(recorded, original):
+    filename, run_name, run = recorded
+    # a swap that stopped after the copy was complete and the run was gone
+    with h5py.File(filename, "a", libver="latest") as f:
+        compaction.copy_run(f[run_name], f, compaction.TMP_PREFIX + run_name)
+        if original == "deleted":
+            del f[run_name]
+        else:
+            f.move(run_name, compaction.OLD_PREFIX + run_name)
+    assert compaction.compact_file(filename) == 0
+    assert_same_run(filename, run_name, run)
+    with storage.open_file(filename) as f:
+        assert list(f.keys()) == [run_name] and f[run_name].attrs["compacted"]
+
+
+def test_swap_interrupted_before_the_move_keeps_the_original(recorded):
+    filename, run_name, run = recorded
+    # a copy that was not swapped in yet
+    with h5py.File(filename, "a", libver="latest") as f:
+        f.create_group(compaction.TMP_PREFIX + run_name)
+    assert compaction.compact_file(filename) == 1
+    assert_same_run(filename, run_name, run)
+    with storage.open_file(filename) as f:
+        assert list(f.keys()) == [run_name]
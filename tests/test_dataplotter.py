@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+
+import storage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "interface"))
+from app import dataplotter
+
+
+def test_empty_run_renders(tmp_path):
+    filename = str(tmp_path / "log.h5")
+    with storage.open_file(filename, "a") as f:
+        storage.create_run(f, "run", 1.7e12, chunk_rows=16)
+    with storage.open_file(filename) as f:
+        t, low, high, diff_max = dataplotter.load_plot_data(f["run"])
+    assert len(t) == len(low) == len(high) == len(diff_max) == 0
+    image = str(tmp_path / "run.png")
+    assert dataplotter.render(filename, "run", image) == image
+    assert os.path.getsize(image) > 0
+
+
+def test_plot_data_has_one_bin_per_pixel_column(tmp_path):
+    filename = str(tmp_path / "log.h5")
+    n = 5000
+    with storage.open_file(filename, "a") as f:
+        grp = storage.create_run(f, "run", 1.7e12, chunk_rows=1024)
+        columns = {"ts_realtime": 1.7e12 + np.arange(n) * 100.0, "acts": np.linspace(0, 1, n),
+                   "diffs": np.where(np.arange(n) == 1234, 30.0, 1.0)}
+        for name in storage.HDF_DATASETS:
+            grp[name].resize((n,))
+            grp[name][:] = storage.encode(grp, name, columns.get(name, np.zeros(n)))
+    with storage.open_file(filename) as f:
+        t, low, high, diff_max = dataplotter.load_plot_data(f["run"], width_px=100)
+    assert len(t) == 100
+    # the single spike is kept
+    assert np.count_nonzero(diff_max > dataplotter.SPIKE_THRESHOLD) == 1
@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+
+from drivers.OLED import OLED, MemoryDevice
+
+
+def make_oled(fps=50):
+    device = MemoryDevice(128, 32)
+    oled = OLED(device=device, fps=fps)
+    assert oled.wait(2.0)
+    return oled, device
+
+
+def test_only_changed_columns_are_written():
+    oled, device = make_oled()
+    # the splash screen is the first frame, all four pages
+    assert device.writes == 4 and device.bytes_written == 4 * 128
+    assert np.array_equal(device.pixels(), oled.canvas)
+
+    oled.print("12:34")
+    assert oled.wait(2.0)
+    writes, sent = device.writes, device.bytes_written
+    oled.print("12:35")
+    assert oled.wait(2.0)
+    # only the columns of the last digit changed
+    assert 0 < device.bytes_written - sent < 128
+    assert np.array_equal(device.pixels(), oled.canvas)
+
+    # the same frame again costs nothing
+    writes, sent = device.writes, device.bytes_written
+    oled.print("12:35")
+    assert oled.wait(2.0)
+    assert (device.writes, device.bytes_written) == (writes, sent)
+    oled.close()
+
+
+def test_timeseries_matches_the_display():
+    oled, device = make_oled()
+    data = np.zeros(1000)
+    data[500] = 100.0
+    oled.draw_timeseries(data, text="deep")
+    assert oled.wait(2.0)
+    pixels = device.pixels()
+    assert np.array_equal(pixels, oled.canvas)
+    # the single spike reaches the top of the display in its column, 8 samples per column
+    assert list(np.flatnonzero(pixels[0])) == [500 // 8]
+    oled.close()
+
+
+def test_frame_rate_is_limited():
+    fps = 10
+    oled, device = make_oled(fps=fps)
+    frames = oled.frames
+    start = time.monotonic()
+    for i in range(50):
+        oled.draw_timeseries(np.sin(np.arange(500) / 20.0 + i) * 50 + 50)
+        time.sleep(0.002)
+    assert oled.wait(2.0)
+    elapsed = time.monotonic() - start
+    drawn = oled.frames - frames
+    # the drawing in between was coalesced into fewer frames
+    assert drawn <= elapsed * fps + 2
+    assert oled.coalesced > 0
+    # and the last one is shown
+    assert np.array_equal(device.pixels(), oled.canvas)
+    oled.close()
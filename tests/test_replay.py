@@ -0,0 +1,68 @@
+import numpy as np
+
+import config
+import storage
+from replay import replay
+from drivers.MMA_sim import SyntheticMovement
+
+# half an hour of a synthetic night
+START = 1.7e9
+DURATION = 1800
+
+
+def replay_night(tmp_path, source=None, **kwargs):
+    filename = str(tmp_path / "replay.h5")
+    if source is None:
+        source = SyntheticMovement(start=START, duration=DURATION, seed=1)
+    logger = replay(source, filename, **kwargs)
+    with storage.open_file(filename) as f:
+        grp = f[logger.dataset_name]
+        return {name: storage.read_column(grp, name) for name in ("x", "y", "z", "delays", "ts_realtime")}
+
+
+def test_event_driven_idles_when_quiet(tmp_path):
+    source = SyntheticMovement(start=START, duration=DURATION, event_rate=0.0, seed=1)
+    run = replay_night(tmp_path, source=source, event_driven=True)
+    # the delay grows to LOGGER_MAX_DELAY as usual, from then on one sample every EVENT_IDLE_DELAY
+    idle = np.flatnonzero(run["delays"] == config.EVENT_IDLE_DELAY)
+    assert len(idle) and np.all(run["delays"][idle[0]:] == config.EVENT_IDLE_DELAY)
+    assert np.allclose(np.diff(run["ts_realtime"][idle[0]:]), config.EVENT_IDLE_DELAY, atol=1.0)
+    assert len(run["delays"]) < idle[0] + DURATION * 1000 / config.EVENT_IDLE_DELAY + 1
+
+
+def test_event_driven_wakes_up_on_movement(tmp_path):
+    source = SyntheticMovement(start=START, duration=DURATION, seed=1)
+    run = replay_night(tmp_path, source=source, event_driven=True)
+    delays, t = run["delays"], run["ts_realtime"]
+    # a wait that was cut short by a movement is stored as LOGGER_MIN_DELAY
+    woken = np.flatnonzero((delays[1:] == config.LOGGER_MIN_DELAY)
+                           & (delays[:-1] == config.EVENT_IDLE_DELAY)) + 1
+    assert len(woken)
+    # the next sample is taken within a poll of the start of a movement ...
+    starts = source.event_starts * 1000.0
+    since_start = t[woken + 1] - starts[np.searchsorted(starts, t[woken + 1]) - 1]
+    assert np.all((since_start >= 0) & (since_start <= config.EVENT_POLL_DELAY + 1.0))
+    # ... and the one after it LOGGER_MIN_DELAY later
+    assert np.allclose(t[woken + 2] - t[woken + 1], config.LOGGER_MIN_DELAY, atol=1.0)
+
+
+def test_fast_read_with_event_driven(tmp_path):
+    run = replay_night(tmp_path, event_driven=True, fast_read=True)
+    # 1 g is 1024 counts, the sensor lies flat
+    assert abs(run["z"].mean() - 1024) < 50
+    assert abs(run["x"].mean()) < 50 and abs(run["y"].mean()) < 50
+    # the transient detection still lets the logger idle
+    assert (run["delays"] == config.EVENT_IDLE_DELAY).any()
+
+
+def test_event_driven_polls_new_samples(tmp_path):
+    # movements above the activity threshold but below the transient threshold
+    source = SyntheticMovement(start=START, duration=DURATION, amplitude=40.0, event_rate=1 / 120.0,
+                               event_duration=(5.0, 20.0), seed=3)
+    run = replay_night(tmp_path, source=source, event_driven=True)
+    xyz = np.stack([run["x"], run["y"], run["z"]], axis=1)
+    polled = run["delays"][1:] < config.EVENT_IDLE_DELAY
+    assert polled.sum() > 1000
+    # the chip only sleeps while the logger idles, a polled sample is never the last one again
+    repeated = np.all(xyz[1:] == xyz[:-1], axis=1)
+    assert repeated[polled].mean() < 0.01
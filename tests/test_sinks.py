@@ -0,0 +1,101 @@
+import numpy as np
+
+from ringbuffer import ChunkRing
+from sinks import RedisSink, unpack_redis_entry
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def xadd(self, stream, fields):
+        self.commands.append(('xadd', stream, fields))
+
+    def xtrim(self, stream, **kwargs):
+        self.commands.append(('xtrim', stream, kwargs))
+
+    def execute(self):
+        if self.client.fail:
+            raise ConnectionError("server down")
+        self.client.round_trips += 1
+        self.client.commands += self.commands
+
+
+class FakeRedis:
+    """Records what a pipeline sends instead of talking to a server."""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.round_trips = 0
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def make_chunks(ring, n_chunks, n_samples):
+    chunks = []
+    for c in range(n_chunks):
+        _, slot = ring.acquire()
+        i = np.arange(n_samples) + c * n_samples
+        slot['ts'][:n_samples] = i * 10.0
+        slot['ts_realtime'][:n_samples] = 1.7e12 + i * 10.0
+        slot['raw'][:n_samples] = np.stack([i, -i, 1024 + i], axis=1)
+        slot['acts'][:n_samples] = i / 100.0
+        slot['diffs'][:n_samples] = i * 0.5
+        slot['delays'][:n_samples] = 10.0
+        slot['states'][:n_samples] = i % 3
+        slot['lateness'][:n_samples] = 0.25
+        chunks.append(ring.publish(n_samples))
+    return chunks
+
+
+def test_fields_one_round_trip_per_batch():
+    ring = ChunkRing(4, 16, consumers=('redis',))
+    client = FakeRedis()
+    sink = RedisSink(client=client, stream='accel', encoding='fields', maxlen=1000, retention=0)
+    sink.write(make_chunks(ring, 2, 16))
+
+    assert client.round_trips == 1
+    adds = [c for c in client.commands if c[0] == 'xadd']
+    trims = [c for c in client.commands if c[0] == 'xtrim']
+    assert len(adds) == 32
+    assert trims == [('xtrim', 'accel', {'maxlen': 1000, 'approximate': True})]
+    # the same text as one xadd per sample
+    assert adds[3][2] == {'t': 30, 't_realtime': int(1.7e12) + 30, 'x': 3.0, 'y': -3.0, 'z': 1027.0,
+                          'activity': '0.0300', 'diff': '1.50', 'delay': '10.00', 'state': 0,
+                          'lateness': '0.25'}
+    assert sink.n_chunks == 2 and sink.n_samples == 32
+    assert ring.lag('redis') == 0
+
+
+def test_packed_entry_per_chunk():
+    ring = ChunkRing(4, 16, consumers=('redis',))
+    client = FakeRedis()
+    sink = RedisSink(client=client, stream='accel', encoding='packed', maxlen=0, retention=60)
+    chunks = make_chunks(ring, 2, 16)
+    expected = [chunk.data.copy() for chunk in chunks]
+    sink.write(chunks)
+
+    adds = [c for c in client.commands if c[0] == 'xadd']
+    assert len(adds) == 2
+    for (_, _, fields), chunk in zip(adds, expected):
+        samples = unpack_redis_entry({k.encode(): v for k, v in fields.items()})
+        assert fields['n'] == 16
+        assert np.array_equal(samples['t_realtime'], chunk['ts_realtime'])
+        assert np.array_equal(samples['z'], chunk['raw'][:, 2])
+        assert np.allclose(samples['activity'], chunk['acts'])
+        assert np.array_equal(samples['state'], chunk['states'])
+    # trimmed by the time of the newest sample
+    assert client.commands[-1] == ('xtrim', 'accel', {'minid': int(expected[-1]['ts_realtime'][-1] - 60000),
+                                                      'approximate': True})
+
+
+def test_failed_batch_is_dropped_and_released():
+    ring = ChunkRing(2, 8, consumers=('redis',))
+    sink = RedisSink(client=FakeRedis(fail=True), stream='accel', encoding='fields', maxlen=10)
+    sink.write(make_chunks(ring, 2, 8))
+
+    assert sink.n_errors == 1 and sink.n_dropped == 16 and sink.n_samples == 0
+    # the logger can reuse the slots
+    assert ring.lag('redis') == 0
@@ -0,0 +1,72 @@
+import time
+import wave
+
+import numpy as np
+
+from Stimulus import AudioEngine, NullOutput
+
+
+def test_fade_in_and_out():
+    # 1000 Hz and 10 ms fades, the gain changes by 0.1 per frame
+    engine = AudioEngine(bitrate=1000, channels=1, fade=0.01)
+    engine.start(np.ones(100, dtype=np.float32))
+    block = engine.render(20)[:, 0]
+    assert np.allclose(block[:10], np.arange(1, 11) / 10.0)
+    assert np.all(block[10:] == 1.0)
+
+    engine.stop()
+    block = engine.render(20)[:, 0]
+    assert np.allclose(block[:10], np.arange(9, -1, -1) / 10.0)
+    assert np.all(block[10:] == 0.0)
+    assert not engine.render(20).any()
+    stats = engine.stats()
+    assert stats['starts'] == 1 and stats['stops'] == 1
+
+
+def test_blocks_are_full_frames():
+    engine = AudioEngine(bitrate=1000, channels=2, fade=0.0)
+    waveform = np.arange(7, dtype=np.float32)
+    # silent until started
+    assert engine.render(5).shape == (5, 2)
+    engine.start(waveform)
+    # blocks longer than the waveform loop over it
+    block = engine.render(16)
+    assert block.shape == (16, 2) and block.dtype == np.float32
+    assert np.array_equal(block[:, 0], np.tile(waveform, 3)[:16])
+    assert np.array_equal(block[:, 0], block[:, 1])
+    # and continue where the last block ended
+    assert np.array_equal(engine.render(3)[:, 0], waveform[2:5])
+
+
+def test_replaced_waveform_fades_out_first():
+    engine = AudioEngine(bitrate=1000, channels=1, fade=0.01)
+    engine.start(np.ones(50, dtype=np.float32))
+    engine.render(20)
+    engine.start(np.full(50, -1.0, dtype=np.float32))
+    out = engine.render(10)[:, 0]
+    assert np.all(out >= 0.0) and out[-1] == 0.0
+    out = engine.render(20)[:, 0]
+    assert np.allclose(out[:10], -np.arange(1, 11) / 10.0)
+
+
+def test_null_output_pulls_in_real_time(tmp_path):
+    filename = str(tmp_path / "stimulus.wav")
+    engine = AudioEngine(bitrate=8000, channels=1, fade=0.005)
+    output = NullOutput(engine, block_frames=80, filename=filename)
+    engine.start(np.full(800, 0.5, dtype=np.float32))
+    time.sleep(0.2)
+    engine.stop()
+    time.sleep(0.05)
+    output.close()
+
+    with wave.open(filename) as f:
+        frames = f.getnframes()
+        samples = np.frombuffer(f.readframes(frames), dtype='<i2')
+    # whole blocks at about the bit rate
+    assert frames % 80 == 0
+    assert 0.15 * 8000 <= frames <= 0.4 * 8000
+    assert samples.max() == int(0.5 * 32767)
+    assert samples[-1] == 0
+    stats = engine.stats()
+    assert stats['starts'] == 1 and stats['stops'] == 1
+    assert stats['start_latency_max'] < 50.0
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import storage
+from ringbuffer import ChunkRing
+from sinks import HDFSink
+
+T0 = 1.7e12
+# the last ms the int32 ticks of a run can hold
+MAX_SPAN = np.iinfo(np.int32).max * storage.TS_TICK_MS
+
+
+def test_timestamps_round_trip(tmp_path):
+    with storage.open_file(str(tmp_path / "log.h5"), "a") as f:
+        grp = storage.create_run(f, "run", T0, chunk_rows=16)
+        ts = T0 + np.array([0.0, 0.1, 12.3, 3600e3, MAX_SPAN - 1.0])
+        grp["ts_realtime"].resize((len(ts),))
+        grp["ts_realtime"][:] = storage.encode(grp, "ts_realtime", ts)
+        assert np.allclose(storage.read_column(grp, "ts_realtime"), ts, rtol=0, atol=0.05)
+
+
+def test_timestamps_beyond_the_span_raise(tmp_path):
+    with storage.open_file(str(tmp_path / "log.h5"), "a") as f:
+        grp = storage.create_run(f, "run", T0, chunk_rows=16)
+        with pytest.raises(OverflowError):
+            storage.encode(grp, "ts_realtime", T0 + np.array([0.0, MAX_SPAN + 1.0]))
+        with pytest.raises(OverflowError):
+            storage.encode(grp, "ts_realtime", np.array([T0 - MAX_SPAN - 1.0]))
+
+
+def test_sink_skips_a_batch_that_does_not_fit(tmp_path):
+    ring = ChunkRing(2, 8, consumers=('hdf',))
+    sink = HDFSink(str(tmp_path / "log.h5"), "run", chunk_rows=8, compression="lzf").open(t0=T0)
+    for offset in (0.0, MAX_SPAN + 1.0):
+        _, slot = ring.acquire()
+        slot['ts_realtime'] = T0 + offset + np.arange(8) * 10.0
+        slot['raw'] = [0, 0, 1024]
+        chunk = ring.publish(8)
+        if offset:
+            with pytest.raises(OverflowError):
+                sink.write([chunk])
+        else:
+            sink.write([chunk])
+    sink.close()
+
+    assert ring.lag('hdf') == 0
+    with storage.open_file(str(tmp_path / "log.h5")) as f:
+        # the columns have the same length, nothing of the second batch was written
+        assert {len(f["run"][name]) for name in storage.HDF_DATASETS} == {8}
+        assert storage.read_column(f["run"], "ts_realtime")[-1] == T0 + 70.0
@@ -0,0 +1,147 @@
+"""
+Waveforms of the audio stimulus and a bank that keeps them on disk.
+
+Every waveform is made to be played in a loop: the frequencies are rounded to a whole
+number of cycles per loop, so there is no phase jump where the loop starts again, and the
+pink noise is made in the frequency domain, which makes it periodic. Waveforms are
+normalized to an absolute peak of `peak`.
+
+- `beat`: two sines of `base_fr` and `base_fr + stim_fr` Hz, summed into one channel (the
+  listener hears a beat of `stim_fr` Hz) or one per ear with `binaural`
+- `pink_bursts`: bursts of pink noise of `burst_len` s every `period` s
+- `ramped`: any of the above with a raised cosine fade in and out over the loop
+
+`WaveformBank.get` computes a waveform once and memory-maps it from an .npy file named
+after its parameters afterwards (data/waveforms/ by default).
+"""
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+
+# changes the keys of the bank if the synthesis changes
+SYNTHESIS_VERSION = 1
+BANK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "waveforms")
+
+
+def loop_frequency(fr, n, bitrate):
+    """`fr` rounded to a whole number of cycles in `n` samples."""
+    cycles = max(int(round(fr * n / bitrate)), 1)
+    looped = cycles * bitrate / n
+    if abs(looped - fr) > 1e-9:
+        logging.info(f"{fr} Hz played as {looped} Hz to loop without a phase jump")
+    return looped
+
+
+def normalize(waveform, peak=1.0):
+    """Scale to an absolute peak of `peak`, in place."""
+    top = np.max(np.abs(waveform)) if waveform.size else 0.0
+    if top > 0:
+        waveform *= peak / top
+    return waveform
+
+
+def beat(base_fr=40.0, stim_fr=0.8, stim_len=5, bitrate=48000, binaural=False, peak=1.0):
+    """Sines of `base_fr` and `base_fr + stim_fr` Hz, float32 of shape (samples,), or
+    (samples, 2) with one sine per channel if `binaural`."""
+    n = int(stim_len * bitrate)
+    t = np.arange(n) / bitrate
+    f1 = loop_frequency(base_fr, n, bitrate)
+    f2 = loop_frequency(base_fr + stim_fr, n, bitrate)
+    # the second sine starts in opposite phase, so the sum starts silent
+    left = np.sin(2 * np.pi * f1 * t)
+    right = np.sin(2 * np.pi * f2 * t + np.pi)
+    waveform = np.stack([left, right], axis=1) if binaural else left + right
+    return normalize(waveform.astype(np.float32), peak)
+
+
+def pink_noise(n, seed=0):
+    """`n` samples of pink (1/f) noise that can be looped, float64 with zero mean."""
+    rng = np.random.default_rng(seed)
+    spectrum = np.fft.rfft(rng.standard_normal(n))
+    f = np.arange(len(spectrum), dtype=np.float64)
+    f[0] = np.inf
+    # 1/f power, 1/sqrt(f) amplitude
+    spectrum /= np.sqrt(f)
+    return np.fft.irfft(spectrum, n)
+
+
+def raised_cosine(n):
+    """Fade from 0 to 1 in `n` samples."""
+    return 0.5 - 0.5 * np.cos(np.pi * (np.arange(n) + 0.5) / max(n, 1))
+
+
+def pink_bursts(burst_len=0.05, period=1.0, ramp=0.005, stim_len=5, bitrate=48000, seed=0, peak=1.0):
+    """Pink noise bursts of `burst_len` s, the first at the start of the loop and then one
+    every `period` s, each faded in and out over `ramp` s. Silence in between."""
+    n = int(stim_len * bitrate)
+    waveform = np.zeros(n, dtype=np.float32)
+    burst = int(burst_len * bitrate)
+    fade = min(int(ramp * bitrate), burst // 2)
+    gate = np.ones(burst)
+    gate[:fade] = raised_cosine(fade)
+    gate[burst - fade:] = raised_cosine(fade)[::-1]
+    starts = (np.arange(0, stim_len, period) * bitrate).astype(np.int64)
+    starts = starts[starts + burst <= n]
+    noise = pink_noise(n, seed)
+    # all bursts at once: rows of sample indices
+    rows = starts[:, np.newaxis] + np.arange(burst)
+    waveform[rows] = noise[rows] * gate
+    return normalize(waveform, peak)
+
+
+def ramped(waveform, ramp_in=0.5, ramp_out=0.5, bitrate=48000):
+    """Fade the waveform in over `ramp_in` s and out over `ramp_out` s, in place."""
+    n_in, n_out = int(ramp_in * bitrate), int(ramp_out * bitrate)
+    envelope = np.ones(len(waveform), dtype=np.float32)
+    envelope[:n_in] = raised_cosine(n_in)
+    if n_out:
+        envelope[len(waveform) - n_out:] = np.minimum(envelope[len(waveform) - n_out:], raised_cosine(n_out)[::-1])
+    waveform *= envelope if waveform.ndim == 1 else envelope[:, np.newaxis]
+    return waveform
+
+
+SYNTHESIZERS = {"beat": beat, "pink_bursts": pink_bursts}
+
+
+def synthesize(kind, ramp_in=0.0, ramp_out=0.0, **params):
+    """Waveform of the synthesizer `kind` (see SYNTHESIZERS), ramped if `ramp_in` or
+    `ramp_out` is given in s."""
+    waveform = SYNTHESIZERS[kind](**params)
+    if ramp_in or ramp_out:
+        ramped(waveform, ramp_in, ramp_out, params.get("bitrate", 48000))
+    return waveform
+
+
+class WaveformBank:
+    def __init__(self, directory=BANK_DIR):
+        """
+        Waveforms as .npy files named after their kind and a hash of their parameters.
+        A waveform is computed the first time it is asked for and memory-mapped from then
+        on, next to every file a .json file lists the parameters.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, kind, params):
+        parts = json.dumps(dict(params, kind=kind, version=SYNTHESIS_VERSION), sort_keys=True)
+        return f"{kind}-{hashlib.sha1(parts.encode()).hexdigest()[:16]}"
+
+    def get(self, kind, **params):
+        """Read-only waveform, see `synthesize` for the parameters."""
+        path = os.path.join(self.directory, self.key(kind, params) + ".npy")
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass
+        logging.info(f"Generating {kind} waveform {params} ...")
+        waveform = synthesize(kind, **params)
+        # other processes never see half a file
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, waveform)
+        os.replace(tmp_path, path)
+        with open(path[:-len(".npy")] + ".json", "w") as f:
+            json.dump(dict(params, kind=kind, version=SYNTHESIS_VERSION), f, sort_keys=True)
+        return np.load(path, mmap_mode="r")